@@ -30,65 +30,33 @@ you have 200 ids avalilables for enroll
 Each time you executes this enroll script, enrollid is autoincrement for a free number
 
 '''
-import FPS, sys
+import fps
 
-def LegacyEnroll(fps):
+
+def say(message):
+    print(message)
+
+
+def LegacyEnroll(scanner):
     '''
     Enroll test
     '''
-    
-    enrollid=0
-    okid=False
-    #search for a free enrollid, you have max 200
-    while not okid and enrollid < 200:
-        okid = fps.CheckEnrolled(enrollid)
-        if not okid:
-            enrollid+=1
-    if enrollid <200:
-        #press finger to Enroll enrollid
-        print 'Press finger to Enroll %s' % str(enrollid)
-        fps.EnrollStart(enrollid)
-        while not fps.IsPressFinger():
-            FPS.delay(1)
-        iret = 0
-        if fps.CaptureFinger(True):
-            #remove finger
-            print 'remove finger'
-            fps.Enroll1()
-            while not fps.IsPressFinger():
-                FPS.delay(1)
-            #Press same finger again
-            print 'Press same finger again'
-            while not fps.IsPressFinger():
-                FPS.delay(1)
-            if fps.CaptureFinger(True):
-                #remove finger
-                print 'remove finger'
-                fps.Enroll2()
-                while not fps.IsPressFinger():
-                    FPS.delay(1)
-                #Press same finger again
-                print 'press same finger yet again'
-                while not fps.IsPressFinger():
-                    FPS.delay(1)
-                if fps.CaptureFinger(True):
-                    #remove finger
-                    iret = fps.Enroll3()
-                    if iret == 0:
-                        print 'Enrolling Successfull'
-                    else:
-                        print 'Enrolling Failed with error code: %s' % str(iret)
-                else:
-                    print 'Failed to capture third finger'
-            else:
-                print 'Failed to capture second finger'
-        else:
-            print 'Failed to capture first finger'
+    # picks the lowest free enrollid, waits for the finger to be pressed and
+    # removed between the three captures
+    result = scanner.enroll(prompt=say)
+    for stage, seconds in result.timings:
+        print('%s: %.2f s' % (stage, seconds))
+    if result.stage is None:
+        print('Enrolling Successfull (id %s)' % result.ID)
+    elif result.stage == 'start' and result.code == 1:
+        print('Failed: enroll storage is full')
+    elif result.code is None:
+        print('Failed: timed out at %s' % result.stage)
     else:
-        print 'Failed: enroll storage is full'
+        print('Enrolling Failed at %s with error code: %s' % (result.stage,
+                                                              result.code))
 
 if __name__ == '__main__':
-    fps = FPS.FPS_GT511C3(device_name='/dev/ttyAMA0',baud=9600,timeout=2,is_com=False) #settings for raspberry pi GPIO
-    fps.Open()
-    if fps.SetLED(True):
-        LegacyEnroll(fps)
+    scanner = fps.FPS_GT511C3(device_name='/dev/ttyAMA0',baud=9600,timeout=2) #settings for raspberry pi GPIO
+    LegacyEnroll(scanner)
+    scanner.close()
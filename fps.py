@@ -11,10 +11,26 @@ Modified on 28/02/2016 by github.com/jtorniainen
 '''
 
 import os
+import bisect
+import collections
+import functools
+import json
+import logging
+import mmap
+import struct
+import queue
+import threading
+from concurrent.futures import Future
 import serial
 from serial.tools import list_ports
-import binascii
 import time
+from enum import IntEnum
+
+
+# The driver logs connection events here; packets go to log.wire
+log = logging.getLogger('fps')
+# Every packet written and read, at DEBUG, when serial_dbg is set
+wire_log = logging.getLogger('fps.wire')
 
 
 def debug_msg(message, tag='Generic'):
@@ -24,6 +40,19 @@ def debug_msg(message, tag='Generic'):
     print('[{}][{}] {}'.format(time.asctime()[11:-5], tag, message))
 
 
+class _Hex(object):
+    '''
+    Formats bytes as hex only if the log record is actually emitted
+    '''
+    __slots__ = ('data',)
+
+    def __init__(self, data):
+        self.data = data
+
+    def __str__(self):
+        return ' '.join('%02x' % ch for ch in bytearray(self.data))
+
+
 def serial_ports():
     '''
     Returns a generator for all available serial ports
@@ -41,11 +70,54 @@ def devices(index=None):
     return portList if index is None else portList[index]
 
 
-class Packet:
+def _byte_view(buf):
+    '''
+    Returns a flat unsigned byte memoryview of buf (bytearray, memoryview,
+    contiguous numpy.uint8 array, ...)
+    '''
+    view = memoryview(buf)
+    if view.ndim != 1 or view.format != 'B':
+        view = view.cast('B')
+    return view
+
+
+def _data_view(buf, length):
+    '''
+    Returns a writable byte memoryview over the first length bytes of buf
+    Raises: ValueError if buf is read-only or too small
+    '''
+    view = _byte_view(buf)
+    if view.readonly or len(view) < length:
+        raise ValueError('Need a writable buffer of {} bytes'.format(length))
+    return view[:length]
+
+
+def _synchronized(method):
+    '''
+    Runs a FPS_GT511C3 method with the device lock held, so the command and
+    response exchange of one thread never interleaves with another's
+    '''
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self._lock:
+            try:
+                return method(self, *args, **kwargs)
+            except BaseException:
+                # Responses that will never be read must not be charged to
+                # the next commands (see Metrics)
+                if self.metrics is not None:
+                    self._inflight.clear()
+                raise
+    return wrapper
+
+
+class Packet(object):
 
     '''
         Generic Internal Packet Class
     '''
+    __slots__ = ()
+
     COMMAND_START_CODE_1 = 0x55
     # Static byte to mark the beginning of a command packet    -    never
     # changes
@@ -72,10 +144,10 @@ class Packet:
         return w & 0x00FF
 
     def CalculateCheckSum(self, bytearr):
-        return sum(map(ord, bytes(bytearr)))
+        return sum(bytearray(bytearr))
 
     def serializeToSend(self, bytearr):
-        return ' '.join(binascii.hexlify(ch) for ch in bytes(bytearr))
+        return ' '.join('%02x' % ch for ch in bytearray(bytearr))
 
 
 class Command_Packet(Packet):
@@ -85,7 +157,6 @@ class Command_Packet(Packet):
         Used to build the serial message
     '''
 
-    command = bytearray(2)
     cmd = ''
     commands = {
         # Default value for enum. Scanner will return error if sent this.
@@ -141,39 +212,52 @@ class Command_Packet(Packet):
             Command Packet Constructor
         '''
         commandName = args[0]
-        kwargs.setdefault('serial_dbg', True)
+        kwargs.setdefault('serial_dbg', False)
         self.serial_dbg = kwargs['serial_dbg']
         if self.serial_dbg:
-            print 'Command: %s' % commandName
+            wire_log.debug('Command: %s', commandName)
         self.cmd = self.commands[commandName]
+        self.commandName = commandName
+        self.Parameter = bytearray(4)
+
+    serial_dbg = False
 
-    serial_dbg = True
-    Parameter = bytearray(4)
+    # Start codes, device ID, parameter, command and checksum
+    PACKET = struct.Struct('<BBBBIHH')
+    # Per command: (command code, checksum of the fixed bytes), filled in
+    # below the class
+    _encoding = {}
+
+    @classmethod
+    def PackInto(cls, buf, commandName, parameter=0):
+        '''
+        Encodes a command packet into the first 12 bytes of buf
+        Only the 4 parameter bytes are summed per call; the checksum of the
+        start codes, device ID and command is precomputed
+        '''
+        code, chksum = cls._encoding[commandName]
+        chksum += ((parameter & 0xFF) + ((parameter >> 8) & 0xFF) +
+                   ((parameter >> 16) & 0xFF) + ((parameter >> 24) & 0xFF))
+        cls.PACKET.pack_into(buf, 0, cls.COMMAND_START_CODE_1,
+                             cls.COMMAND_START_CODE_2,
+                             cls.COMMAND_DEVICE_ID_1, cls.COMMAND_DEVICE_ID_2,
+                             parameter & 0xFFFFFFFF, code, chksum & 0xFFFF)
+
+    @classmethod
+    def Pack(cls, commandName, parameter=0):
+        '''
+        Returns the 12 bytes of a command packet as a new bytes object
+        '''
+        buf = bytearray(12)
+        cls.PackInto(buf, commandName, parameter)
+        return bytes(buf)
 
     def GetPacketBytes(self):
         '''
         Returns the 12 bytes of the generated command packet
-        remember to call delete on the returned array
         '''
-
-        self.command[0] = self.GetLowByte(self.cmd)
-        self.command[1] = self.GetHighByte(self.cmd)
-
         packetbytes = bytearray(12)
-        packetbytes[0] = self.COMMAND_START_CODE_1
-        packetbytes[1] = self.COMMAND_START_CODE_2
-        packetbytes[2] = self.COMMAND_DEVICE_ID_1
-        packetbytes[3] = self.COMMAND_DEVICE_ID_2
-        packetbytes[4] = self.Parameter[0]
-        packetbytes[5] = self.Parameter[1]
-        packetbytes[6] = self.Parameter[2]
-        packetbytes[7] = self.Parameter[3]
-        packetbytes[8] = self.command[0]
-        packetbytes[9] = self.command[1]
-        chksum = self.CalculateCheckSum(packetbytes[0:9])
-        packetbytes[10] = self.GetLowByte(chksum)
-        packetbytes[11] = self.GetHighByte(chksum)
-
+        self.PackInto(packetbytes, self.commandName, self.IntFromParameter())
         return packetbytes
 
     def ParameterFromInt(self, i):
@@ -186,92 +270,297 @@ class Command_Packet(Packet):
         self.Parameter[2] = (i & 0x00ff0000) >> 16
         self.Parameter[3] = (i & 0xff000000) >> 24
 
+    def IntFromParameter(self):
+        '''
+        Converts the paramter array back to an int
+        '''
+        return (self.Parameter[0] | (self.Parameter[1] << 8) |
+                (self.Parameter[2] << 16) | (self.Parameter[3] << 24))
+
+
+Command_Packet._encoding = dict(
+    (name, (code, Packet.COMMAND_START_CODE_1 + Packet.COMMAND_START_CODE_2 +
+            Packet.COMMAND_DEVICE_ID_1 + Packet.COMMAND_DEVICE_ID_2 +
+            Packet().GetLowByte(code) + Packet().GetHighByte(code)))
+    for name, code in Command_Packet.commands.items())
+
+
+class ErrorCode(IntEnum):
+    '''
+        Error codes sent in the parameter of a NACK response
+    '''
+    NO_ERROR = 0x0000    # Default value. no error
+    NACK_TIMEOUT = 0x1001    # Obsolete, capture timeout
+    NACK_INVALID_BAUDRATE = 0x1002    # Obsolete, Invalid serial baud rate
+    NACK_INVALID_POS = 0x1003    # The specified ID is not between 0~199
+    NACK_IS_NOT_USED = 0x1004    # The specified ID is not used
+    NACK_IS_ALREADY_USED = 0x1005    # The specified ID is already used
+    NACK_COMM_ERR = 0x1006    # Communication Error
+    NACK_VERIFY_FAILED = 0x1007    # 1:1 Verification Failure
+    NACK_IDENTIFY_FAILED = 0x1008    # 1:N Identification Failure
+    NACK_DB_IS_FULL = 0x1009    # The database is full
+    NACK_DB_IS_EMPTY = 0x100A    # The database is empty
+    # Obsolete, Invalid order of the enrollment (The order was not as:
+    # EnrollStart -> Enroll1 -> Enroll2 -> Enroll3)
+    NACK_TURN_ERR = 0x100B
+    NACK_BAD_FINGER = 0x100C    # Too bad fingerprint
+    NACK_ENROLL_FAILED = 0x100D    # Enrollment Failure
+    NACK_IS_NOT_SUPPORTED = 0x100E    # The specified command is not supported
+    # Device Error, especially if Crypto-Chip is trouble
+    NACK_DEV_ERR = 0x100F
+    NACK_CAPTURE_CANCELED = 0x1010    # Obsolete, The capturing is canceled
+    NACK_INVALID_PARAM = 0x1011    # Invalid parameter
+    NACK_FINGER_IS_NOT_PRESSED = 0x1012    # Finger is not pressed
+    INVALID = 0xFFFF     # Used when parsing fails
+
 
 class Response_Packet(Packet):
     '''
         Response Packet Class
+        Immutable: parsed once from the 12 bytes read off the wire
     '''
-    errors = {
-        'NO_ERROR': 0x0000,    # Default value. no error
-        'NACK_TIMEOUT': 0x1001,    # Obsolete, capture timeout
-        # Obsolete, Invalid serial baud rate
-        'NACK_INVALID_BAUDRATE': 0x1002,
-        'NACK_INVALID_POS': 0x1003,    # The specified ID is not between 0~199
-        'NACK_IS_NOT_USED': 0x1004,    # The specified ID is not used
-        'NACK_IS_ALREADY_USED': 0x1005,    # The specified ID is already used
-        'NACK_COMM_ERR': 0x1006,    # Communication Error
-        'NACK_VERIFY_FAILED': 0x1007,    # 1:1 Verification Failure
-        'NACK_IDENTIFY_FAILED': 0x1008,    # 1:N Identification Failure
-        'NACK_DB_IS_FULL': 0x1009,    # The database is full
-        'NACK_DB_IS_EMPTY': 0x100A,    # The database is empty
-        # Obsolete, Invalid order of the enrollment (The order was not as:
-        # EnrollStart -> Enroll1 -> Enroll2 -> Enroll3)
-        'NACK_TURN_ERR': 0x100B,
-        'NACK_BAD_FINGER': 0x100C,    # Too bad fingerprint
-        'NACK_ENROLL_FAILED': 0x100D,    # Enrollment Failure
-        # The specified command is not supported
-        'NACK_IS_NOT_SUPPORTED': 0x100E,
-        # Device Error, especially if Crypto-Chip is trouble
-        'NACK_DEV_ERR': 0x100F,
-        # Obsolete, The capturing is canceled
-        'NACK_CAPTURE_CANCELED': 0x1010,
-        'NACK_INVALID_PARAM': 0x1011,    # Invalid parameter
-        'NACK_FINGER_IS_NOT_PRESSED': 0x1012,    # Finger is not pressed
-        'INVALID': 0XFFFF     # Used when parsing fails
-        }
+    __slots__ = ('RawBytes', 'ACK', 'Parameter', 'Error', 'ChecksumOK',
+                 'serial_dbg')
+
+    # Name -> code, kept for callers that look codes up by name
+    errors = dict((e.name, e.value) for e in ErrorCode)
+    # Code -> ErrorCode
+    _error_codes = dict((e.value, e) for e in ErrorCode)
+
+    # Start codes, device ID, parameter, response code and checksum
+    PACKET = struct.Struct('<BBHIHH')
+    ACK_CODE = 0x30
 
     def __init__(self, _buffer=None, serial_dbg=False):
         '''
         Creates and parses a response packet from the finger print scanner
+        A missing, short or corrupt buffer gives a NACK with Error INVALID
         '''
-        self.serial_dbg = serial_dbg
-
+        setattr_ = object.__setattr__
+        setattr_(self, 'serial_dbg', serial_dbg)
+        setattr_(self, 'RawBytes', bytes(_buffer or b''))
+        ack = False
+        param = 0
+        error = ErrorCode.INVALID
+        checksum_ok = False
         if not (_buffer is None):
-            self.RawBytes = _buffer
-            self._lastBuffer = bytes(_buffer)
             if self.serial_dbg:
-                debug_msg('Read: {}'.format(self.serializeToSend(_buffer)))
-            if _buffer.__len__() >= 12:
-                self.ACK = True if _buffer[8] == 0x30 else False
-                self.ParameterBytes[0] = _buffer[4]
-                self.ParameterBytes[1] = _buffer[5]
-                self.ParameterBytes[2] = _buffer[6]
-                self.ParameterBytes[3] = _buffer[7]
-                self.ResponseBytes[0] = _buffer[8]
-                self.ResponseBytes[1] = _buffer[9]
-                self.Error = self.ParseFromBytes(
-                    self.GetHighByte(
-                        _buffer[5]), self.GetLowByte(
-                        _buffer[4]))
-
-    _lastBuffer = bytes()
-    RawBytes = bytearray(12)
-    ParameterBytes = bytearray(4)
-    ResponseBytes = bytearray(2)
-    ACK = False
-    Error = None
-    serial_dbg = True
+                wire_log.debug('Read: %s', _Hex(_buffer))
+            if len(_buffer) >= 12:
+                start1, start2, _, param, response, chksum = \
+                    self.PACKET.unpack_from(_buffer)
+                checksum_ok = (
+                    start1 == self.COMMAND_START_CODE_1 and
+                    start2 == self.COMMAND_START_CODE_2 and
+                    chksum == sum(bytearray(_buffer[:10])) & 0xFFFF)
+                if checksum_ok:
+                    ack = response == self.ACK_CODE
+                    error = (ErrorCode.NO_ERROR if ack else
+                             self._error_codes.get(param, ErrorCode.INVALID))
+        setattr_(self, 'ACK', ack)
+        setattr_(self, 'Parameter', param)
+        setattr_(self, 'Error', error)
+        setattr_(self, 'ChecksumOK', checksum_ok)
+
+    def __setattr__(self, name, value):
+        raise AttributeError('Response_Packet is immutable')
+
+    def __repr__(self):
+        return 'Response_Packet(ACK={}, Parameter={}, Error={})'.format(
+            self.ACK, self.Parameter, self.Error.name)
+
+    @property
+    def ParameterBytes(self):
+        '''
+        The 4 parameter bytes, least significant first
+        '''
+        return bytearray(struct.pack('<I', self.Parameter))
 
     def ParseFromBytes(self, high, low):
         '''
         Parses bytes into one of the possible errors from the finger print
         scanner
         '''
-        e = 'INVALID'
-        if high == 0x01:
-            if low in self.errors.values():
-                errorIndex = self.errors.values().index(low)
-                e = self.errors.keys()[errorIndex]
-        return e
+        return self._error_codes.get((high << 8) | low, ErrorCode.INVALID)
 
     def IntFromParameter(self):
+        return self.Parameter
+
+
+class Data_Packet(Packet):
+    '''
+        Data Packet Class
+        Carries the payload of the image and template transfers: two start
+        codes, the device ID, the data and a 2 byte checksum of everything
+        before it
+    '''
+    DATA_START_CODE_1 = 0x5A
+    # Static byte to mark the beginning of a data packet    -    never
+    # changes
+    DATA_START_CODE_2 = 0xA5
+    # Static byte to mark the beginning of a data packet    -    never
+    # changes
+    HEADER_SIZE = 4
+    CHECKSUM_SIZE = 2
+
+    def __init__(self, _buffer=None, serial_dbg=False, data=None):
+        '''
+        Creates and parses a data packet from the finger print scanner
+        The payload is exposed as a memoryview into _buffer (no copy)
+        Pass data instead of _buffer to build a packet to upload
+        '''
+        self.serial_dbg = serial_dbg
+
+        if not (data is None):
+            _buffer = bytearray(self.HEADER_SIZE)
+            _buffer[0] = self.DATA_START_CODE_1
+            _buffer[1] = self.DATA_START_CODE_2
+            _buffer[2] = self.COMMAND_DEVICE_ID_1
+            _buffer[3] = self.COMMAND_DEVICE_ID_2
+            _buffer.extend(data)
+            chksum = self.CalculateCheckSum(_buffer)
+            _buffer.append(self.GetLowByte(chksum))
+            _buffer.append(self.GetHighByte(chksum))
+
+        if not (_buffer is None):
+            self.RawBytes = _buffer
+            if self.serial_dbg:
+                wire_log.debug('Data packet: %d bytes', len(_buffer))
+            if len(_buffer) >= self.HEADER_SIZE + self.CHECKSUM_SIZE:
+                self.HeaderOK = self.IsHeader(_buffer)
+                self.Data = memoryview(_buffer)[
+                    self.HEADER_SIZE:-self.CHECKSUM_SIZE]
+                chksum = _buffer[-2] + (_buffer[-1] << 8)
+                self.ChecksumOK = chksum == self.GetWord(
+                    self.CalculateCheckSum(memoryview(_buffer)[:-2]))
+
+    RawBytes = bytearray()
+    Data = memoryview(bytearray())
+    HeaderOK = False
+    ChecksumOK = False
+    serial_dbg = False
+
+    def IsHeader(self, header):
+        '''
+        Checks the start codes and device ID of a data packet header
+        '''
+        return (header[0] == self.DATA_START_CODE_1 and
+                header[1] == self.DATA_START_CODE_2 and
+                header[2] == self.COMMAND_DEVICE_ID_1 and
+                header[3] == self.COMMAND_DEVICE_ID_2)
+
+    def GetPacketBytes(self):
+        '''
+        Returns the bytes of the packet as sent on the wire
+        '''
+        return self.RawBytes
+
+    def IsValid(self):
+        '''
+        True if both the header and the checksum of the packet are correct
+        '''
+        return self.HeaderOK and self.ChecksumOK
+
+    def GetWord(self, w):
+        '''
+        Truncates a checksum to the 16 bits sent on the wire
+        '''
+        return w & 0xFFFF
+
+
+class Template_Database:
+    '''
+        Backup file of the template database of a fps
+        Little endian layout: a 64 byte header (magic, version, slot count,
+        template size and an occupancy bitmap with bit n set when ID n is
+        enrolled) followed by one fixed size record per slot. The file is
+        memory mapped, so records are read and written in place.
+    '''
+    MAGIC = b'GT511DB\x00'
+    VERSION = 1
+    SLOTS = 200
+    HEADER = struct.Struct('<8sHHH')   # magic, version, slots, template size
+    HEADER_SIZE = 64
+    BITMAP_SIZE = (SLOTS + 7) // 8
+
+    def __init__(self, path, mode='r', template_size=498):
+        '''
+        Opens a backup file
+        Parameter: mode - 'r' to read an existing file, 'w' to create (or
+                   truncate) one with every slot empty
+        Raises: ValueError if an existing file is not a template database
+        '''
+        self.path = path
+        self._view = None
+        self._writable = mode == 'w'
+        if self._writable:
+            self._file = open(path, 'w+b')
+            self.TemplateSize = template_size
+            self._file.truncate(self.HEADER_SIZE +
+                                self.SLOTS * template_size)
+            self._map = mmap.mmap(self._file.fileno(), 0)
+            self.HEADER.pack_into(self._map, 0, self.MAGIC, self.VERSION,
+                                  self.SLOTS, template_size)
+        else:
+            self._file = open(path, 'rb')
+            self._map = mmap.mmap(self._file.fileno(), 0,
+                                  access=mmap.ACCESS_READ)
+            magic, version, slots, self.TemplateSize = \
+                self.HEADER.unpack_from(self._map, 0)
+            if (magic != self.MAGIC or version != self.VERSION or
+                    slots != self.SLOTS or len(self._map) <
+                    self.HEADER_SIZE + slots * self.TemplateSize):
+                self.Close()
+                raise ValueError('{} is not a template database'.format(path))
+        self._view = memoryview(self._map)
+        self._bitmap = self._view[self.HEADER.size:
+                                  self.HEADER.size + self.BITMAP_SIZE]
+
+    def Record(self, ID):
+        '''
+        Returns the record of an ID as a memoryview into the file
+        '''
+        start = self.HEADER_SIZE + ID * self.TemplateSize
+        return self._view[start:start + self.TemplateSize]
+
+    def IsUsed(self, ID):
+        '''
+        True if the backup holds a template for the ID
+        '''
+        return bool(self._bitmap[ID >> 3] & (1 << (ID & 7)))
+
+    def SetUsed(self, ID, used=True):
+        '''
+        Marks the record of an ID as holding (or not holding) a template
+        '''
+        if used:
+            self._bitmap[ID >> 3] |= 1 << (ID & 7)
+        else:
+            self._bitmap[ID >> 3] &= ~(1 << (ID & 7)) & 0xFF
+
+    def Occupancy(self):
+        '''
+        Returns the occupancy bitmap as an int (bit n set if ID n is used)
+        '''
         retval = 0
-        retval = (retval << 8) + self.ParameterBytes[3]
-        retval = (retval << 8) + self.ParameterBytes[2]
-        retval = (retval << 8) + self.ParameterBytes[1]
-        retval = (retval << 8) + self.ParameterBytes[0]
+        for i, b in enumerate(bytearray(self._bitmap)):
+            retval |= b << (8 * i)
         return retval
 
+    def Close(self):
+        '''
+        Flushes and closes the file (records handed out become invalid)
+        '''
+        if self._view is not None:
+            self._bitmap.release()
+            self._view.release()
+            self._view = None
+        if not self._map.closed:
+            if self._writable:
+                self._map.flush()
+            self._map.close()
+        self._file.close()
+
 
 class SerialCommander:
 
@@ -283,7 +572,7 @@ class SerialCommander:
         return bytes(bytearray([v for v in kwargs.values()]))
 
     def serializeToSend(self, bytearr):
-        return ' '.join(binascii.hexlify(ch) for ch in bytes(bytearr))
+        return ' '.join('%02x' % ch for ch in bytearray(bytearr))
 
     def unserializeFromRead(self, char_readed, bytearr):
         bytearr.append(char_readed)
@@ -293,73 +582,795 @@ class SerialCommander:
 def connect(device_name, baud, timeout):
     _ser = None
     try:
-        _ser = serial.Serial(device_name, baudrate=baud, timeout=timeout)
+        _ser = serial.serial_for_url(device_name, baudrate=baud,
+                                     timeout=timeout)
         if not _ser.isOpen():
             _ser.open()
     except Exception as e:
-        debug_msg('Cannot connect to device {}'.format(str(e)))
-        pass
+        log.warning('Cannot connect to %s: %s', device_name, e)
     return _ser
 
 
+# Baud rates supported by the GT-511C3, slowest first
+BAUD_RATES = (9600, 19200, 38400, 57600, 115200)
+
+# Where FPS_GT511C3(auto_baud=True) remembers the baud rate of each port
+BAUD_CACHE = os.path.join(os.path.expanduser('~'), '.gt511c3_baud.json')
+
+
+def load_baud_cache(path=BAUD_CACHE):
+    '''
+    Returns the cached baud rates as a dict of port -> baud (empty if the
+    cache file is missing or unreadable)
+    '''
+    try:
+        with open(path) as f:
+            cache = json.load(f)
+    except (IOError, OSError, ValueError):
+        return {}
+    return cache if isinstance(cache, dict) else {}
+
+
+def save_baud_cache(device_name, baud, path=BAUD_CACHE):
+    '''
+    Remembers the baud rate of a port in the cache file
+    The file is replaced atomically, so concurrent readers never see it half
+    written
+    '''
+    cache = load_baud_cache(path)
+    if cache.get(device_name) == baud:
+        return
+    cache[device_name] = baud
+    tmp = '{}.{}.tmp'.format(path, os.getpid())
+    try:
+        with open(tmp, 'w') as f:
+            json.dump(cache, f, indent=1, sort_keys=True)
+        os.replace(tmp, path)
+    except (IOError, OSError) as e:
+        log.warning('Cannot write baud cache %s: %s', path, e)
+
+
+def probe(device_name, bauds=BAUD_RATES, timeout=.2, baud_cache=None):
+    '''
+    Looks for a GT-511C3 on a port by sending Open (without device info) at
+    each baud rate until one gets a well formed ACK
+    Parameter: baud_cache - cache file to try the cached rate of the port
+               from first and to remember the rate found in, None for none
+    Returns: the baud rate the device answered at, None if nothing answered
+    '''
+    if baud_cache:
+        cached = load_baud_cache(baud_cache).get(device_name)
+        if cached in bauds:
+            bauds = [cached] + [b for b in bauds if b != cached]
+    baud = _probe(device_name, bauds, timeout)
+    if baud is not None and baud_cache:
+        save_baud_cache(device_name, baud, baud_cache)
+    return baud
+
+
+def _probe(device_name, bauds, timeout):
+    packetbytes = Command_Packet.Pack('Open')
+    try:
+        _ser = serial.serial_for_url(device_name, baudrate=bauds[0],
+                                     timeout=timeout)
+    except Exception:
+        return None
+    try:
+        for baud in bauds:
+            _ser.baudrate = baud
+            _ser.reset_input_buffer()
+            _ser.write(packetbytes)
+            r = bytearray(_ser.read(12))
+            if (len(r) == 12 and r[0] == Packet.COMMAND_START_CODE_1 and
+                    r[1] == Packet.COMMAND_START_CODE_2 and
+                    Response_Packet(r).ACK):
+                return baud
+    except Exception:
+        pass
+    finally:
+        _ser.close()
+    return None
+
+
+# One entry of FPS_GT511C3.run_batch: command name, its Response_Packet and
+# its Data_Packet (None for commands without data or when NACKed)
+Batch_Result = collections.namedtuple('Batch_Result',
+                                      ('command', 'response', 'data'))
+
+
+# Outcome of FPS_GT511C3.enroll and identify: the ID, the stage that failed
+# (None on success) with its return code (None for a timeout), and a list
+# of (stage, seconds) for every stage run
+Pipeline_Result = collections.namedtuple('Pipeline_Result',
+                                         ('ID', 'stage', 'code', 'timings'))
+
+
+class Batch(object):
+    '''
+        Commands queued by FPS_GT511C3.batch(), sent when the with block ends
+        (or on run()); the results are in self.results, one Batch_Result per
+        command, in order
+
+        with scanner.batch() as b:
+            b.set_led(True)
+            b.capture_finger(False)
+            b.identify1_N()
+            b.set_led(False)
+        ID = b.results[2].response.Parameter
+
+        The commands go out one at a time; scanner.batch(window=2) or more
+        pipelines them (see FPS_GT511C3.run_batch)
+    '''
+    # Commands that send a data packet to the fps, or change the link
+    NOT_BATCHABLE = ('SetTemplate', 'VerifyTemplate1_1', 'IdentifyTemplate1_N',
+                     'ChangeBaudrate', 'Close')
+
+    def __init__(self, scanner, window=1):
+        self._scanner = scanner
+        self._window = window
+        self.commands = []
+        self.results = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type is None:
+            self.run()
+
+    def add(self, commandName, parameter=0):
+        '''
+        Queues a command
+        Returns: index of its result in self.results
+        Raises: ValueError for commands that can't be pipelined
+        '''
+        if commandName in self.NOT_BATCHABLE:
+            raise ValueError('{} cannot be batched'.format(commandName))
+        self.commands.append((commandName, parameter))
+        return len(self.commands) - 1
+
+    def run(self):
+        '''
+        Sends the queued commands (see FPS_GT511C3.run_batch)
+        Returns: list of Batch_Result
+        '''
+        self.results = self._scanner.run_batch(self.commands, self._window)
+        return self.results
+
+    def set_led(self, on=True):
+        return self.add('CmosLed', 1 if on else 0)
+
+    def is_press_finger(self):
+        return self.add('IsPressFinger')
+
+    def capture_finger(self, highquality=True):
+        return self.add('CaptureFinger', 1 if highquality else 0)
+
+    def identify1_N(self):
+        return self.add('Identify1_N')
+
+    def verify1_1(self, ID):
+        return self.add('Verify1_1', ID)
+
+    def get_enroll_count(self):
+        return self.add('GetEnrollCount')
+
+    def check_enrolled(self, ID):
+        return self.add('CheckEnrolled', ID)
+
+    def delete_id(self, ID):
+        return self.add('DeleteID', ID)
+
+    def get_template(self, ID):
+        return self.add('GetTemplate', ID)
+
+    def make_template(self):
+        return self.add('MakeTemplate')
+
+
+def _poll_intervals(fast, slow, backoff):
+    '''
+    Sleeps between finger polls: fast right after activity, growing by
+    backoff on every idle poll up to slow
+    '''
+    interval = fast
+    while True:
+        yield interval
+        interval = min(slow, interval * backoff)
+
+
+# Finger press (pressed=True) or release reported by FingerWatcher
+Finger_Event = collections.namedtuple('Finger_Event', ('pressed', 'time'))
+
+
+class FingerWatcher(object):
+    '''
+        Polls is_press_finger on a background thread and reports every press
+        and release as a Finger_Event, to a callback (called on the watcher
+        thread), through self.events (a queue) and as an async iterator
+
+        with FingerWatcher(scanner) as watcher:
+            event = watcher.events.get()
+
+        async for event in FingerWatcher(scanner).start():
+            ...
+
+        Polling is every fast seconds after a change, backing off to every
+        slow seconds while nothing happens; each poll holds the device lock
+        for one IsPressFinger exchange only, so other commands still run
+    '''
+    FAST = .02
+    SLOW = .08
+    BACKOFF = 1.5
+
+    def __init__(self, scanner, callback=None, led=True, fast=FAST,
+                 slow=SLOW, backoff=BACKOFF, maxsize=64):
+        '''
+        Parameter: callback - called with each Finger_Event
+        Parameter: led - turn the LED on while watching (needed for
+                   IsPressFinger) and off again on stop
+        Parameter: fast, slow, backoff - polling intervals (see above)
+        Parameter: maxsize - events kept in self.events, oldest are dropped
+        '''
+        self._scanner = scanner
+        self._callback = callback
+        self._led = led
+        self._fast = fast
+        self._slow = slow
+        self._backoff = backoff
+        self._stop = threading.Event()
+        self._thread = None
+        self.events = queue.Queue(maxsize)
+        self.pressed = None     # Last known state, None before the first poll
+        self.error = None       # Exception that stopped the watcher
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.stop()
+
+    def start(self):
+        '''
+        Starts the watcher thread; events left from an earlier run
+        (including its end of iteration) are dropped
+        Returns: self
+        '''
+        if self._thread is None or not self._thread.is_alive():
+            self._stop.clear()
+            while True:
+                try:
+                    self.events.get_nowait()
+                except queue.Empty:
+                    break
+            self.pressed = None
+            self._thread = threading.Thread(
+                target=self._run,
+                name='fps-finger-{}'.format(self._scanner._device_name))
+            self._thread.daemon = True
+            self._thread.start()
+        return self
+
+    def stop(self, wait=True):
+        '''
+        Stops the watcher thread (and turns the LED off if it turned it on)
+        '''
+        self._stop.set()
+        if (wait and self._thread is not None and
+                self._thread is not threading.current_thread()):
+            self._thread.join()
+
+    def _run(self):
+        scanner = self._scanner
+        try:
+            if self._led:
+                scanner.set_led(True)
+            try:
+                self._poll()
+            finally:
+                # Also when the callback or a poll raised
+                if self._led:
+                    scanner.set_led(False)
+        except Exception as e:
+            self.error = e
+        finally:
+            self._emit(None)
+
+    def _poll(self):
+        '''
+        Polls the scanner until stopped, emitting every change
+        '''
+        intervals = _poll_intervals(self._fast, self._slow, self._backoff)
+        while not self._stop.is_set():
+            pressed = self._scanner.is_press_finger()
+            if self.pressed is None:
+                # The first poll only tells the state to start from
+                self.pressed = pressed
+            elif pressed != self.pressed:
+                self.pressed = pressed
+                self._emit(Finger_Event(pressed, time.time()))
+                intervals = _poll_intervals(self._fast, self._slow,
+                                            self._backoff)
+            self._stop.wait(next(intervals))
+
+    def _emit(self, event):
+        '''
+        Hands an event (None when the watcher stops) to every consumer
+        '''
+        if event is not None and self._callback is not None:
+            self._callback(event)
+        while True:
+            try:
+                self.events.put_nowait(event)
+                break
+            except queue.Full:
+                try:
+                    self.events.get_nowait()
+                except queue.Empty:
+                    pass
+
+    def __iter__(self):
+        '''
+        Yields events from self.events until the watcher stops (starting
+        it if it never ran)
+        '''
+        if self._thread is None:
+            self.start()
+        while True:
+            event = self.events.get()
+            if event is None:
+                return
+            yield event
+
+    def __aiter__(self):
+        return self
+
+    def __anext__(self):
+        '''
+        Awaits the next event of self.events on the default executor
+        (starting the watcher if it never ran)
+        '''
+        import asyncio
+        if self._thread is None:
+            self.start()
+        loop = asyncio.get_event_loop()
+        result = loop.create_future()
+
+        def done(task):
+            if result.done():
+                return
+            if task.exception() is not None:
+                result.set_exception(task.exception())
+            elif task.result() is None:
+                result.set_exception(StopAsyncIteration())
+            else:
+                result.set_result(task.result())
+        if not self._thread.is_alive() and self.events.empty():
+            result.set_exception(StopAsyncIteration())
+        else:
+            loop.run_in_executor(None, self.events.get).add_done_callback(done)
+        return result
+
+
+# One finished command, as passed to the hooks of Metrics: device name,
+# command name, seconds from sending it to the last byte of its response,
+# bytes written and read for it, and None if it was ACKed, else the error
+# name (an ErrorCode name, or TIMEOUT if the response never came whole)
+Command_Timing = collections.namedtuple(
+    'Command_Timing',
+    ('device', 'command', 'seconds', 'bytes_out', 'bytes_in', 'error'))
+
+
+def _prometheus_labels(labels):
+    return ','.join('{}="{}"'.format(
+        name, str(value).replace('\\', '\\\\').replace('"', '\\"')
+        .replace('\n', '\\n')) for name, value in labels)
+
+
+class Metrics(object):
+    '''
+        In-memory registry of command counts, latency histograms, bytes
+        moved, NACKs by error, retries and timeouts, by device and command
+        Set it as the metrics of one or more FPS_GT511C3 to collect; with
+        metrics None (the default) the driver only pays one attribute check
+        per packet. Hooks are called with a Command_Timing for every finished
+        command, on the thread that ran it.
+
+        SAMPLE CODE:
+
+            metrics = fps.Metrics()
+            scanner.metrics = metrics
+            metrics.add_hook(lambda t: t.error and print(t))
+            ...
+            print(metrics.prometheus())
+    '''
+    # Upper bounds (seconds) of the latency histogram buckets
+    BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1., 2.5, 5.,
+               10.)
+    PREFIX = 'gt511c3'
+
+    def __init__(self, hook=None):
+        self._lock = threading.Lock()
+        self._hooks = [hook] if hook is not None else []
+        self.reset()
+
+    def reset(self):
+        '''
+        Clears all counters (hooks are kept)
+        '''
+        with self._lock:
+            # (device, command) -> count
+            self.commands = collections.Counter()
+            # (device, command) -> [count per bucket and +Inf..., sum]
+            self.latency = {}
+            # device -> bytes
+            self.bytes_out = collections.Counter()
+            self.bytes_in = collections.Counter()
+            # (device, command, error name) -> count
+            self.nacks = collections.Counter()
+            # (device, command) -> count
+            self.retries = collections.Counter()
+            self.timeouts = collections.Counter()
+
+    def add_hook(self, hook):
+        self._hooks.append(hook)
+
+    def remove_hook(self, hook):
+        self._hooks.remove(hook)
+
+    def sent(self, device, count):
+        with self._lock:
+            self.bytes_out[device] += count
+
+    def received(self, device, count):
+        with self._lock:
+            self.bytes_in[device] += count
+
+    def retry(self, device, command):
+        '''
+        Counts a command sent again because its previous attempt failed
+        (polls like the IsPressFinger of wait_finger are plain commands)
+        '''
+        with self._lock:
+            self.retries[device, command] += 1
+
+    def timeout(self, device, command):
+        with self._lock:
+            self.timeouts[device, command] += 1
+
+    def finished(self, timing):
+        '''
+        Records a finished command (Command_Timing) and passes it on to the
+        hooks
+        '''
+        key = (timing.device, timing.command)
+        with self._lock:
+            self.commands[key] += 1
+            histogram = self.latency.get(key)
+            if histogram is None:
+                histogram = self.latency[key] = [0] * (len(self.BUCKETS) + 1)
+                histogram.append(0.)
+            histogram[bisect.bisect_left(self.BUCKETS, timing.seconds)] += 1
+            histogram[-1] += timing.seconds
+            if timing.error not in (None, 'TIMEOUT'):
+                self.nacks[timing.device, timing.command, timing.error] += 1
+        for hook in self._hooks:
+            hook(timing)
+
+    def snapshot(self):
+        '''
+        Returns: the counters as plain dicts (e.g. for JSON), keyed by
+                 device, then command (then error for nacks); a histogram is
+                 the counts per bucket of BUCKETS and +Inf, and the sum
+        '''
+        def nest(items):
+            out = {}
+            for key, value in items:
+                level = out
+                for part in key[:-1]:
+                    level = level.setdefault(part, {})
+                level[key[-1]] = value
+            return out
+        with self._lock:
+            return {
+                'buckets': list(self.BUCKETS),
+                'commands': nest(self.commands.items()),
+                'latency': nest((key, {'counts': h[:-1], 'sum': h[-1]})
+                                for key, h in self.latency.items()),
+                'bytes_out': dict(self.bytes_out),
+                'bytes_in': dict(self.bytes_in),
+                'nacks': nest(self.nacks.items()),
+                'retries': nest(self.retries.items()),
+                'timeouts': nest(self.timeouts.items()),
+            }
+
+    def prometheus(self):
+        '''
+        Returns: the counters in the Prometheus text exposition format
+        '''
+        lines = []
+
+        def family(name, kind, text, samples):
+            name = '{}_{}'.format(self.PREFIX, name)
+            lines.append('# HELP {} {}'.format(name, text))
+            lines.append('# TYPE {} {}'.format(name, kind))
+            for suffix, labels, value in samples:
+                lines.append('{}{}{{{}}} {}'.format(
+                    name, suffix, _prometheus_labels(labels), value))
+
+        def per_command(counter):
+            return [('', (('device', d), ('command', c)), n)
+                    for (d, c), n in sorted(counter.items())]
+
+        def per_device(counter):
+            return [('', (('device', d),), n)
+                    for d, n in sorted(counter.items())]
+
+        with self._lock:
+            family('commands_total', 'counter', 'Commands finished',
+                   per_command(self.commands))
+            samples = []
+            for (d, c), h in sorted(self.latency.items()):
+                total = 0
+                for bound, n in zip(self.BUCKETS + ('+Inf',), h[:-1]):
+                    total += n
+                    samples.append(('_bucket', (('device', d), ('command', c),
+                                                ('le', bound)), total))
+                samples.append(('_sum', (('device', d), ('command', c)),
+                                h[-1]))
+                samples.append(('_count', (('device', d), ('command', c)),
+                                total))
+            family('command_seconds', 'histogram',
+                   'Time from sending a command to the end of its response',
+                   samples)
+            family('bytes_sent_total', 'counter', 'Bytes written to the fps',
+                   per_device(self.bytes_out))
+            family('bytes_received_total', 'counter',
+                   'Bytes read from the fps', per_device(self.bytes_in))
+            family('nacks_total', 'counter', 'NACKed commands by error',
+                   [('', (('device', d), ('command', c), ('error', e)), n)
+                    for (d, c, e), n in sorted(self.nacks.items())])
+            family('retries_total', 'counter', 'Commands sent again',
+                   per_command(self.retries))
+            family('timeouts_total', 'counter',
+                   'Responses cut short by the serial timeout',
+                   per_command(self.timeouts))
+        return '\n'.join(lines) + '\n'
+
+
+class WireTrace(object):
+    '''
+        Record of the bytes written to and read from a fps, cheap enough to
+        leave on in production: the last size chunks stay in memory (a ring
+        buffer, see dump) and, with path, every chunk is also appended to a
+        binary capture file for post-mortem analysis (see read)
+        File layout: MAGIC, then per chunk a RECORD (monotonic timestamp,
+        direction, length) followed by the bytes. The file is buffered;
+        flush or close it to get everything on disk.
+
+        SAMPLE CODE:
+
+            scanner.wire = fps.WireTrace(path='scanner.trace')
+            ...
+            print(scanner.wire.dump())
+            for timestamp, direction, data in fps.WireTrace.read(
+                    'scanner.trace'):
+                ...
+    '''
+    MAGIC = b'GT511WT\x01'
+    RECORD = struct.Struct('<dBI')
+    WRITE = 0       # host to fps
+    READ = 1        # fps to host
+
+    def __init__(self, size=256, path=None):
+        '''
+        Parameter: size - chunks kept in memory
+        Parameter: path - capture file to create, None for memory only
+        '''
+        self.chunks = collections.deque(maxlen=size)
+        self._file = None
+        if path is not None:
+            self._file = open(path, 'wb')
+            self._file.write(self.MAGIC)
+
+    def record(self, direction, data):
+        '''
+        Adds a chunk (WRITE or READ) with the current time
+        '''
+        data = data.tobytes() if isinstance(data, memoryview) else bytes(data)
+        timestamp = time.monotonic()
+        self.chunks.append((timestamp, direction, data))
+        if self._file is not None:
+            self._file.write(self.RECORD.pack(timestamp, direction,
+                                              len(data)))
+            self._file.write(data)
+
+    def dump(self):
+        '''
+        Returns: the chunks in memory as text, one line each
+        '''
+        return '\n'.join('{:.6f} {} {}'.format(
+            timestamp, '>' if direction == self.WRITE else '<', _Hex(data))
+            for timestamp, direction, data in self.chunks)
+
+    def flush(self):
+        if self._file is not None:
+            self._file.flush()
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    @classmethod
+    def read(cls, path):
+        '''
+        Reads a capture file
+        Yields: (timestamp, direction, bytes) of every chunk
+        Raises: ValueError if the file is not a capture
+        '''
+        with open(path, 'rb') as f:
+            if f.read(len(cls.MAGIC)) != cls.MAGIC:
+                raise ValueError('{} is not a wire capture'.format(path))
+            while True:
+                header = f.read(cls.RECORD.size)
+                if len(header) < cls.RECORD.size:
+                    return
+                timestamp, direction, length = cls.RECORD.unpack(header)
+                data = f.read(length)
+                if len(data) < length:
+                    return
+                yield timestamp, direction, data
+
+
 class FPS_GT511C3(SerialCommander):
     _serial = None
     _lastResponse = None
+    _lastData = None
+    _occupancy = None    # Cached enrollment bitmap, None until first scan
+    _enrollID = None
+    _worker = None
+    _baud_cache = None
     _device_name = None
     _baud = None
     _timeout = None
 
-    # Enables verbose debug output using hardware Serial
-    serial_dbg = True
+    # Logs every packet to wire_log (at DEBUG; configure logging to see it)
+    serial_dbg = False
+
+    # Where get_image/get_raw_image (and their _into versions) add every
+    # image they download: any object with append(frame, device=...) and
+    # frame_size, such as a raw_archive.CaptureArchive; images of another
+    # size than frame_size are not added
+    archive = None
+
+    # WireTrace the connection records every write and read to, None to
+    # record nothing
+    wire = None
+
+    # Metrics registry the connection reports to (see Metrics), None to
+    # collect nothing
+    metrics = None
+
+    # Seconds the line must stay quiet after a timed out or garbled
+    # response before the next command is sent (see _resync)
+    RESYNC_QUIET = 1.
+
+    # Commands that send a template after their ACK
+    UPLOAD_COMMANDS = ('SetTemplate', 'VerifyTemplate1_1',
+                       'IdentifyTemplate1_N')
+
+    # Payload sizes of the data packets sent by the download commands
+    IMAGE_SIZE = 52116        # GetImage, 258x202
+    RAW_IMAGE_SIZE = 19200        # GetRawImage, 160x120
+    TEMPLATE_SIZE = 498        # GetTemplate
+    DEVICE_INFO_SIZE = 24        # Open with a non-zero parameter
 
-    def __init__(self, device_name='/dev/ttyAMA0', baud=9600, timeout=10000):
+    def __init__(self, device_name='/dev/ttyAMA0', baud=9600, timeout=2,
+                 auto_baud=False, baud_cache=BAUD_CACHE, wire=None):
         '''
         Creates a new object to interface with the fingerprint scanner
+        Parameter: auto_baud - ignore baud, find the current baud rate of the
+                   device (trying the cached one first) and switch it to the
+                   fastest rate the port supports; True or the highest baud
+                   rate to switch to (e.g. 57600 for a slow level shifter)
+        Parameter: baud_cache - cache file used by auto_baud, None to disable
+        Parameter: wire - WireTrace to record to from the first command on
+                   (the baud rate probing of auto_baud is not recorded)
         '''
         self._device_name = device_name
+        if wire is not None:
+            self.wire = wire
         self._baud = baud
         self._timeout = timeout
+        self._baud_cache = baud_cache if auto_baud else None
+        # Every command runs with this held (see _synchronized)
+        self._lock = threading.RLock()
+        self._worker_lock = threading.Lock()
+        # Reused for every command packet sent on this connection
+        self._txbuf = bytearray(12)
+        self._queue = queue.Queue()
+        # Commands sent and not yet answered, while metrics are collected:
+        # [name, parameter, start time, bytes in, bytes out, ACKed with more
+        # to come, timed out]
+        self._inflight = collections.deque(maxlen=16)
+        # One dict of ID -> enrolled per running refresh_occupancy, for the
+        # changes made while it scans
+        self._scans = []
+        detected = None
+        if auto_baud:
+            detected = self._detect_baud()
+            if detected is None:
+                log.warning('No answer from %s at any baud rate',
+                            device_name)
+            baud = detected or baud
+            self._baud = baud
         self._serial = connect(device_name, baud, timeout)
         if self._serial:
             time.sleep(.1)
-            debug_msg('Connecting to {} ({})'.format(device_name, baud))
+            log.info('Connecting to %s (%d baud)', device_name, baud)
             self.open()
-        elif self.serial_dbg:
-            debug_msg('Cannot connect to device {}'.format(self._device_name),
-                      'FPS_GT511C3')
+            if detected:
+                self._upgrade_baud(BAUD_RATES[-1] if auto_baud is True
+                                   else auto_baud)
 
+    def _detect_baud(self):
+        '''
+        Finds the current baud rate of the device, trying the cached rate of
+        the port before the others
+        Returns: the baud rate, None if the device didn't answer
+        '''
+        return probe(self._device_name, BAUD_RATES,
+                     baud_cache=self._baud_cache)
+
+    def _upgrade_baud(self, max_baud):
+        '''
+        Switches the device to the fastest baud rate (up to max_baud) that
+        the serial port accepts; the rate is cached once the device answers
+        at it (probe cached the one it found)
+        '''
+        for baud in reversed(BAUD_RATES):
+            if baud <= self._baud:
+                break
+            if baud > max_baud:
+                continue
+            try:
+                self._serial.baudrate = baud
+            except (ValueError, IOError, serial.SerialException):
+                continue
+            finally:
+                self._serial.baudrate = self._baud
+            # Stop once the device took the rate, even if it went silent
+            if self.change_baud_rate(baud) or self._baud == baud:
+                break
+
+    @_synchronized
     def open(self):
         '''
             Initialises the device and gets ready for commands
         '''
         # self.ChangeBaudRate(BAUD)
         time.sleep(.1)
-        cp = Command_Packet('Open', serial_dbg=self.serial_dbg)
-        cp.ParameterFromInt(1)
-        packetbytes = cp.GetPacketBytes()
-        self.send_command(packetbytes, 12)
-        rp = self.get_response()
-        del packetbytes
+        self._command('Open', 1)
+        # Parameter 1 asks for the device info (firmware version, iso area
+        # max size and serial number), sent back as a data packet
+        rp = self.get_response(self.DEVICE_INFO_SIZE)
         return rp.ACK
 
+    @_synchronized
     def close(self):
         '''
              Does not actually do anything (according to the datasheet)
              I implemented open, so had to do closed too... lol
         '''
-        cp = Command_Packet('Close', serial_dbg=self.serial_dbg)
-        cp.Parameter[0] = 0x00
-        cp.Parameter[1] = 0x00
-        cp.Parameter[2] = 0x00
-        cp.Parameter[3] = 0x00
-        packetbytes = cp.GetPacketBytes()
-        self.send_command(packetbytes, 12)
+        self._command('Close')
         rp = self.get_response()
+        self.stop_worker(wait=False)
         if self._serial:
             self._serial.close()
-        del packetbytes
         return rp.ACK
 
+    @_synchronized
     def set_led(self, on=True):
         '''
              Turns on or off the LED backlight
@@ -367,83 +1378,67 @@ class FPS_GT511C3(SerialCommander):
              Parameter: true turns on the backlight, false turns it off
              Returns: True if successful, false if not
         '''
-        cp = Command_Packet('CmosLed', serial_dbg=self.serial_dbg)
-        cp.Parameter[0] = 0x01 if on else 0x00
-        cp.Parameter[1] = 0x00
-        cp.Parameter[2] = 0x00
-        cp.Parameter[3] = 0x00
-        packetbytes = cp.GetPacketBytes()
-        self.send_command(packetbytes, 12)
+        self._command('CmosLed', 1 if on else 0)
         rp = self.get_response()
         retval = rp.ACK
         del rp
-        del packetbytes
         return retval
 
+    @_synchronized
     def change_baud_rate(self, baud):
         '''
-             Changes the baud rate of the connection
+             Changes the baud rate of the connection and checks it with Open
+             at the new rate; the rate is cached (auto_baud) only then
              Parameter: 9600 - 115200
-             Returns: True if success, false if invalid baud
-             NOTE: Untested (don't have a logic level changer and a voltage
-             divider is too slow)
+             Returns: True if success, false if invalid baud or the device
+                      doesn't answer at the new rate
         '''
         retval = False
-        if baud != self._serial.getBaudrate():
-            cp = Command_Packet('ChangeBaudrate', serial_dbg=self.serial_dbg)
-            cp.ParameterFromInt(baud)
-            packetbytes = cp.GetPacketBytes()
-            self.send_command(packetbytes, 12)
-            time.sleep(.5)
+        if baud != self._serial.baudrate:
+            self._command('ChangeBaudrate', baud)
             rp = self.get_response()
-            time.sleep(.5)
             retval = rp.ACK
             if retval:
-                if self.serial_dbg:
-                    debug_msg('Changing port baudrate to {}'.format(baud))
-                self._serial.close()
-                self._serial = connect(self._device_name,
-                                       self._baud,
-                                       self._timeout)
-            del rp  # TODO why del these?
-            del packetbytes  # TODO why del these?
+                log.info('Changing %s to %d baud', self._device_name, baud)
+                # The device answers at the old rate and switches right
+                # after, so the port follows without reopening
+                self._serial.baudrate = baud
+                self._baud = baud
+                retval = self.open()
+                if not retval:
+                    log.warning('No answer at %d baud, power cycle %s', baud,
+                                self._device_name)
+                elif self._baud_cache:
+                    save_baud_cache(self._device_name, baud, self._baud_cache)
         return retval
 
+    @_synchronized
     def get_enroll_count(self):
         '''
              Gets the number of enrolled fingerprints
              Return: The total number of enrolled fingerprints
         '''
-        cp = Command_Packet('GetEnrollCount', serial_dbg=self.serial_dbg)
-        cp.Parameter[0] = 0x00
-        cp.Parameter[1] = 0x00
-        cp.Parameter[2] = 0x00
-        cp.Parameter[3] = 0x00
-        packetbytes = cp.GetPacketBytes()
-        self.send_command(packetbytes, 12)
+        self._command('GetEnrollCount')
         rp = self.get_response()
         retval = rp.IntFromParameter()
         del rp
-        del packetbytes
         return retval
 
+    @_synchronized
     def check_enrolled(self, ID):
         '''
              checks to see if the ID number is in use or not
              Parameter: 0-199
              Return: True if the ID number is enrolled, false if not
         '''
-        cp = Command_Packet('CheckEnrolled', serial_dbg=self.serial_dbg)
-        cp.ParameterFromInt(ID)
-        packetbytes = cp.GetPacketBytes()
-        del cp
-        self.send_command(packetbytes, 12)
-        del packetbytes
+        self._command('CheckEnrolled', ID)
         rp = self.get_response()
         retval = rp.ACK
+        self._mark_enrolled(ID, retval)
         del rp
         return retval
 
+    @_synchronized
     def enroll_start(self, ID):
         '''
              Starts the Enrollment Process
@@ -453,25 +1448,25 @@ class FPS_GT511C3(SerialCommander):
                 1 - Database is full
                 2 - Invalid Position
                 3 - Position(ID) is already used
+                4 - Communications error (no valid response)
         '''
-        cp = Command_Packet('EnrollStart', serial_dbg=self.serial_dbg)
-        cp.ParameterFromInt(ID)
-        packetbytes = cp.GetPacketBytes()
-        del cp
-        self.send_command(packetbytes, 12)
-        del packetbytes
+        self._command('EnrollStart', ID)
         rp = self.get_response()
+        self._enrollID = ID if rp.ACK else None
         retval = 0
         if not rp.ACK:
-            if rp.Error == rp.errors['NACK_DB_IS_FULL']:
+            if rp.Error == ErrorCode.NACK_DB_IS_FULL:
                 retval = 1
-            elif rp.Error == rp.errors['NACK_INVALID_POS']:
+            elif rp.Error == ErrorCode.NACK_INVALID_POS:
                 retval = 2
-            elif rp.Error == rp.errors['NACK_IS_ALREADY_USED']:
+            elif rp.Error == ErrorCode.NACK_IS_ALREADY_USED:
                 retval = 3
+            else:
+                retval = 4
         del rp
         return retval
 
+    @_synchronized
     def enroll1(self):
         '''
              Gets the first scan of an enrollment
@@ -481,21 +1476,10 @@ class FPS_GT511C3(SerialCommander):
                 2 - Bad finger
                 3 - ID in use
         '''
-        cp = Command_Packet('Enroll1', serial_dbg=self.serial_dbg)
-        packetbytes = cp.GetPacketBytes()
-        del cp
-        self.send_command(packetbytes, 12)
-        del packetbytes
-        rp = self.get_response()
-        retval = rp.IntFromParameter()
-        retval = 3 if retval < 200 else 0
-        if not rp.ACK:
-            if rp.Error == rp.errors['NACK_ENROLL_FAILED']:
-                retval = 1
-            elif rp.Error == rp.errors['NACK_BAD_FINGER']:
-                retval = 2
-        return 0 if rp.ACK else retval
+        self._command('Enroll1')
+        return self._enroll_code(self.get_response())
 
+    @_synchronized
     def enroll2(self):
         '''
              Gets the Second scan of an enrollment
@@ -505,21 +1489,10 @@ class FPS_GT511C3(SerialCommander):
                 2 - Bad finger
                 3 - ID in use
         '''
-        cp = Command_Packet('Enroll2', serial_dbg=self.serial_dbg)
-        packetbytes = cp.GetPacketBytes()
-        del cp
-        self.send_command(packetbytes, 12)
-        del packetbytes
-        rp = self.get_response()
-        retval = rp.IntFromParameter()
-        retval = 3 if retval < 200 else 0
-        if not rp.ACK:
-            if rp.Error == rp.errors['NACK_ENROLL_FAILED']:
-                retval = 1
-            elif rp.Error == rp.errors['NACK_BAD_FINGER']:
-                retval = 2
-        return 0 if rp.ACK else retval
+        self._command('Enroll2')
+        return self._enroll_code(self.get_response())
 
+    @_synchronized
     def enroll3(self):
         '''
              Gets the Third scan of an enrollment
@@ -530,71 +1503,203 @@ class FPS_GT511C3(SerialCommander):
                 2 - Bad finger
                 3 - ID in use
         '''
-        cp = Command_Packet('Enroll3', serial_dbg=self.serial_dbg)
-        packetbytes = cp.GetPacketBytes()
-        del cp
-        self.send_command(packetbytes, 12)
-        del packetbytes
+        self._command('Enroll3')
         rp = self.get_response()
-        retval = rp.IntFromParameter()
-        retval = 3 if retval < 200 else 0
-        if not rp.ACK:
-            if rp.Error == rp.errors['NACK_ENROLL_FAILED']:
-                retval = 1
-            elif rp.Error == rp.errors['NACK_BAD_FINGER']:
-                retval = 2
-        return 0 if rp.ACK else retval
+        if rp.ACK and self._enrollID is not None:
+            self._mark_enrolled(self._enrollID)
+        return self._enroll_code(rp)
 
+    def _enroll_code(self, rp):
+        '''
+             Return code of enroll1/2/3 for their response
+        '''
+        if rp.ACK:
+            return 0
+        if rp.Error == ErrorCode.NACK_BAD_FINGER:
+            return 2
+        if rp.ChecksumOK and rp.Parameter < 200:
+            # NACK with the ID that already holds this finger
+            return 3
+        return 1
+
+    @_synchronized
     def is_press_finger(self):
         '''
              Checks to see if a finger is pressed on the FPS
              Return: true if finger pressed, false if not
         '''
-        cp = Command_Packet('IsPressFinger', serial_dbg=self.serial_dbg)
-        packetbytes = cp.GetPacketBytes()
-        self.send_command(packetbytes, 12)
+        self._command('IsPressFinger')
         rp = self.get_response()
-        pval = rp.ParameterBytes[0]
-        pval += rp.ParameterBytes[1]
-        pval += rp.ParameterBytes[2]
-        pval += rp.ParameterBytes[3]
-        retval = True if pval == 0 else False
+        retval = rp.ACK and rp.Parameter == 0
         del rp
-        del packetbytes
-        del cp
         return retval
 
+    def wait_finger(self, pressed=True, timeout=None,
+                    fast=FingerWatcher.FAST, slow=FingerWatcher.SLOW,
+                    backoff=FingerWatcher.BACKOFF):
+        '''
+             Waits for a finger to be pressed on (or lifted off) the FPS,
+             polling fast at first and backing off to slow
+             LED must be on to detect fingers
+             Parameter: pressed - wait for a press (True) or a release
+             Parameter: timeout - seconds to wait, None for ever
+             Return: true if it happened, false on timeout
+        '''
+        deadline = None if timeout is None else time.time() + timeout
+        for interval in _poll_intervals(fast, slow, backoff):
+            if self.is_press_finger() == pressed:
+                return True
+            if deadline is not None:
+                left = deadline - time.time()
+                if left <= 0:
+                    return False
+                interval = min(interval, left)
+            time.sleep(interval)
+
+    def watch_finger(self, callback=None, led=True):
+        '''
+             Returns a FingerWatcher (not yet started) for this device
+        '''
+        return FingerWatcher(self, callback, led)
+
+    def enroll(self, ID=None, timeout=10, prompt=None):
+        '''
+             Enrolls a finger from three high quality captures, waiting for
+             the finger to be pressed and lifted in between
+             The LED is on only while fingers are expected
+             The device lock is taken per exchange, not while waiting for the
+             finger, so other threads can use the device meanwhile (as long
+             as they don't capture or enroll)
+             Parameter: ID - 0-199, None for the lowest free ID
+             Parameter: timeout - seconds to wait for each press or release
+             Parameter: prompt - called with a message for the user before
+                        every press and release
+             Return: Pipeline_Result; a failed start has the enroll_start
+                     code (1 also when no ID is free), a failed capture
+                     code 1, a failed enroll stage the enroll1/2/3 code
+        '''
+        timings = []
+        clock = [time.time()]
+
+        def lap(stage):
+            now = time.time()
+            timings.append((stage, now - clock[0]))
+            clock[0] = now
+
+        def fail(stage, code):
+            lap(stage)
+            return Pipeline_Result(ID, stage, code, timings)
+
+        # Held until EnrollStart, so nobody takes the free ID meanwhile
+        with self._lock:
+            if ID is None:
+                ID = self.next_free_id()
+                if ID >= Template_Database.SLOTS:
+                    return fail('start', 1)
+            code = self.enroll_start(ID)
+            if code:
+                return fail('start', code)
+        lap('start')
+        led = self.set_led(True)
+        try:
+            for n in (1, 2, 3):
+                if n > 1:
+                    if prompt:
+                        prompt('Remove finger')
+                    if not self.wait_finger(False, timeout):
+                        return fail('release%d' % (n - 1), None)
+                    lap('release%d' % (n - 1))
+                if prompt:
+                    prompt('Press finger to enroll {}'.format(ID) if n == 1
+                           else 'Press the same finger again')
+                if not self.wait_finger(True, timeout):
+                    return fail('press%d' % n, None)
+                lap('press%d' % n)
+                if not self.capture_finger(True):
+                    return fail('capture%d' % n, 1)
+                lap('capture%d' % n)
+                if n < 3:
+                    code = (self.enroll1, self.enroll2)[n - 1]()
+                else:
+                    # Last capture done: the LED goes off right before
+                    # Enroll3, both sent back to back under one lock (one
+                    # at a time, see run_batch)
+                    results = self.run_batch([('CmosLed', 0),
+                                              ('Enroll3', 0)])
+                    led = False
+                    code = self._enroll_code(results[1].response)
+                if code:
+                    return fail('enroll%d' % n, code)
+                lap('enroll%d' % n)
+        finally:
+            if led:
+                self.set_led(False)
+        return Pipeline_Result(ID, None, 0, timings)
+
+    def identify(self, timeout=10, prompt=None):
+        '''
+             Waits for a finger and identifies it against all enrolled
+             fingerprints; the capture, LED off and Identify1_N commands are
+             sent back to back under one lock, one at a time (run_batch)
+             The device lock is not held while waiting for the finger
+             Parameter: timeout - seconds to wait for the finger
+             Parameter: prompt - called with a message for the user
+             Return: Pipeline_Result with ID 0-199, or 200 if not found
+        '''
+        timings = []
+        start = time.time()
+        led = self.set_led(True)
+        try:
+            if prompt:
+                prompt('Press finger')
+            if not self.wait_finger(True, timeout):
+                timings.append(('press', time.time() - start))
+                return Pipeline_Result(200, 'press', None, timings)
+            now = time.time()
+            timings.append(('press', now - start))
+            results = self.run_batch([('CaptureFinger', 0),
+                                      ('CmosLed', 0),
+                                      ('Identify1_N', 0)])
+            led = False
+        finally:
+            if led:
+                self.set_led(False)
+        timings.append(('identify', time.time() - now))
+        if not results[0].response.ACK:
+            return Pipeline_Result(200, 'capture', 1, timings)
+        rp = results[2].response
+        ID = min(rp.IntFromParameter(), 200) if rp.ACK else 200
+        return Pipeline_Result(ID, None, 0, timings)
+
+    @_synchronized
     def delete_id(self, ID):
         '''
              Deletes the specified ID (enrollment) from the database
              Returns: true if successful, false if position invalid
         '''
-        cp = Command_Packet('DeleteID', serial_dbg=self.serial_dbg)
-        cp.ParameterFromInt(ID)
-        packetbytes = cp.GetPacketBytes()
-        self.send_command(packetbytes, 12)
+        self._command('DeleteID', ID)
         rp = self.get_response()
         retval = rp.ACK
+        if retval:
+            self._mark_enrolled(ID, False)
         del rp
-        del packetbytes
-        del cp
         return retval
 
+    @_synchronized
     def delete_all(self):
         '''
              Deletes all IDs (enrollments) from the database
              Returns: true if successful, false if db is empty
         '''
-        cp = Command_Packet('DeleteAll', serial_dbg=self.serial_dbg)
-        packetbytes = cp.GetPacketBytes()
-        self.send_command(packetbytes, 12)
+        self._command('DeleteAll')
         rp = self.get_response()
         retval = rp.ACK
+        if retval:
+            self._mark_deleted_all()
         del rp
-        del packetbytes
-        del cp
         return retval
 
+    @_synchronized
     def verify1_1(self, ID):
         '''
              Checks the currently pressed finger against a specific ID
@@ -604,25 +1709,24 @@ class FPS_GT511C3(SerialCommander):
                 1 - Invalid Position
                 2 - ID is not in use
                 3 - Verified FALSE (not the correct finger)
+                4 - Communications error (no valid response)
         '''
-        cp = Command_Packet('Verify1_1', serial_dbg=self.serial_dbg)
-        cp.ParameterFromInt(ID)
-        packetbytes = cp.GetPacketBytes()
-        self.send_command(packetbytes, 12)
+        self._command('Verify1_1', ID)
         rp = self.get_response()
         retval = 0
         if not rp.ACK:
-            if rp.Error == rp.errors['NACK_INVALID_POS']:
+            if rp.Error == ErrorCode.NACK_INVALID_POS:
                 retval = 1
-            elif rp.Error == rp.errors['NACK_IS_NOT_USED']:
+            elif rp.Error == ErrorCode.NACK_IS_NOT_USED:
                 retval = 2
-            elif rp.Error == rp.errors['NACK_VERIFY_FAILED']:
+            elif rp.Error == ErrorCode.NACK_VERIFY_FAILED:
                 retval = 3
+            else:
+                retval = 4
         del rp
-        del packetbytes
-        del cp
         return retval
 
+    @_synchronized
     def identify1_N(self):
         '''
              Checks the currently pressed finger against all enrolled
@@ -632,18 +1736,15 @@ class FPS_GT511C3(SerialCommander):
                        the ID number)
                 200: Failed to find the fingerprint in the database
         '''
-        cp = Command_Packet('Identify1_N', serial_dbg=self.serial_dbg)
-        packetbytes = cp.GetPacketBytes()
-        self.send_command(packetbytes, 12)
+        self._command('Identify1_N')
         rp = self.get_response()
-        retval = rp.IntFromParameter()
+        retval = rp.IntFromParameter() if rp.ACK else 200
         if retval > 200:
             retval = 200
         del rp
-        del packetbytes
-        del cp
         return retval
 
+    @_synchronized
     def capture_finger(self, highquality=True):
         '''
              Captures the currently pressed finger into onboard ram
@@ -655,96 +1756,495 @@ class FPS_GT511C3(SerialCommander):
 
              Returns: True if ok, false if no finger pressed
         '''
-        cp = Command_Packet('CaptureFinger', serial_dbg=self.serial_dbg)
-        cp.ParameterFromInt(1 if highquality else 0)
-        packetbytes = cp.GetPacketBytes()
-        self.send_command(packetbytes, 12)
+        self._command('CaptureFinger', 1 if highquality else 0)
         rp = self.get_response()
         retval = rp.ACK
         del rp
-        del packetbytes
-        del cp
         return retval
 
+    @_synchronized
     def get_image(self):
         '''
-             Gets an image that is 258x202 (52116 bytes) and returns it in
-             407 Data_Packets Use StartDataDownload, and then
-             GetNextDataPacket until done
+             Gets an image that is 258x202 (52116 bytes) in one Data_Packet
+             The payload is left in self._lastData (see iter_image for a
+             streaming download)
 
-             Returns: True (device confirming download starting)
+             Returns: True if the image was downloaded and the data packet is
+                      valid, False if not
         '''
-        cp = Command_Packet('GetImage', serial_dbg=self.serial_dbg)
-        packetbytes = cp.GetPacketBytes()
-        self.send_command(packetbytes, 12)
-        rp = self.get_response()
-        retval = rp.ACK
+        self._command('GetImage')
+        rp = self.get_response(self.IMAGE_SIZE)
+        retval = rp.ACK and self._lastData.IsValid()
+        if retval:
+            self._archive_frame(self._lastData.Data)
         return retval
 
+    @_synchronized
     def get_raw_image(self):
         '''
-             Gets an image that is qvga 160x120 (19200 bytes) and returns
-             it in 150 Data_Packets Use StartDataDownload, and then
-             GetNextDataPacket until done
+             Gets an image that is qvga 160x120 (19200 bytes) in one
+             Data_Packet
+             The payload is left in self._lastData (see iter_raw_image for a
+             streaming download)
 
-             Returns: True (device confirming download starting)
-             Not implemented due to memory restrictions on the arduino
-             may revisit this if I find a need for it
+             Returns: True if the image was downloaded and the data packet is
+                      valid, False if not
         '''
-        cp = Command_Packet('GetRawImage', serial_dbg=self.serial_dbg)
-        packetbytes = cp.GetPacketBytes()
-        self.send_command(packetbytes, 12)
-        rp = self.get_response()
-        retval = rp.ACK
+        self._command('GetRawImage')
+        rp = self.get_response(self.RAW_IMAGE_SIZE)
+        retval = rp.ACK and self._lastData.IsValid()
+        if retval:
+            self._archive_frame(self._lastData.Data)
         return retval
 
+    @_synchronized
     def get_template(self, ID):
         '''
-             Gets a template from the fps (498 bytes) in 4 Data_Packets
-             Use StartDataDownload, and then GetNextDataPacket until done
+             Gets a template from the fps (498 bytes) in one Data_Packet
+             The template is left in self._lastData (see iter_template for a
+             streaming download)
              Parameter: 0-199 ID number
              Returns:
-                0 - ACK Download starting
+                0 - ACK Template downloaded
                 1 - Invalid position
                 2 - ID not used (no template to download
+                3 - Download failed (bad data packet)
+        '''
+        self._command('GetTemplate', ID)
+        rp = self.get_response(self.TEMPLATE_SIZE)
+        retval = 0
+        if not rp.ACK:
+            if rp.Error == ErrorCode.NACK_INVALID_POS:
+                retval = 1
+            elif rp.Error == ErrorCode.NACK_IS_NOT_USED:
+                retval = 2
+        elif not self._lastData.IsValid():
+            retval = 3
+        return retval
+
+    @_synchronized
+    def get_image_into(self, buf):
         '''
-        cp = Command_Packet('GetTemplate', serial_dbg=self.serial_dbg)
-        cp.ParameterFromInt(ID)
-        packetbytes = cp.GetPacketBytes()
-        self.send_command(packetbytes, 12)
+             Downloads the 258x202 image (52116 bytes) in place into buf
+             Parameter: writable buffer of at least 52116 bytes, e.g. a
+                        bytearray, memoryview or numpy.uint8 array of shape
+                        (202, 258)
+             Returns: True if the image was downloaded and the data packet is
+                      valid, False if not
+             Raises: ValueError if buf is read-only or too small
+        '''
+        view = _data_view(buf, self.IMAGE_SIZE)
+        self._command('GetImage')
+        if not self.get_response().ACK:
+            return False
+        retval = self.read_data_into(view, self.IMAGE_SIZE)
+        if retval:
+            self._archive_frame(view)
+        return retval
+
+    @_synchronized
+    def get_raw_image_into(self, buf):
+        '''
+             Downloads the qvga 160x120 raw image (19200 bytes) in place into
+             buf
+             Parameter: writable buffer of at least 19200 bytes, e.g. a
+                        bytearray, memoryview or numpy.uint8 array of shape
+                        (120, 160)
+             Returns: True if the image was downloaded and the data packet is
+                      valid, False if not
+             Raises: ValueError if buf is read-only or too small
+        '''
+        view = _data_view(buf, self.RAW_IMAGE_SIZE)
+        self._command('GetRawImage')
+        if not self.get_response().ACK:
+            return False
+        retval = self.read_data_into(view, self.RAW_IMAGE_SIZE)
+        if retval:
+            self._archive_frame(view)
+        return retval
+
+    def _archive_frame(self, frame):
+        '''
+             Adds a downloaded image to self.archive, if set and of its size
+        '''
+        if self.archive is not None and len(frame) == self.archive.frame_size:
+            self.archive.append(frame, device=self._device_name)
+
+    @_synchronized
+    def get_template_into(self, ID, buf):
+        '''
+             Downloads the template (498 bytes) of the specified ID in place
+             into buf
+             Parameter: 0-199 ID number
+             Parameter: writable buffer of at least 498 bytes
+             Returns:
+                0 - ACK Template downloaded
+                1 - Invalid position
+                2 - ID not used (no template to download
+                3 - Download failed (bad data packet)
+             Raises: ValueError if buf is read-only or too small
+        '''
+        view = _data_view(buf, self.TEMPLATE_SIZE)
+        self._command('GetTemplate', ID)
         rp = self.get_response()
         retval = 0
         if not rp.ACK:
-            if rp.Error == rp.errors['NACK_INVALID_POS']:
+            if rp.Error == ErrorCode.NACK_INVALID_POS:
                 retval = 1
-            elif rp.Error == rp.errors['NACK_IS_NOT_USED']:
+            elif rp.Error == ErrorCode.NACK_IS_NOT_USED:
                 retval = 2
+        elif not self.read_data_into(view, self.TEMPLATE_SIZE):
+            retval = 3
         return retval
 
-    '''
-         Uploads a template to the fps
-         Parameter: the template (498 bytes)
-         Parameter: the ID number to upload
-         Parameter: Check for duplicate fingerprints already on fps
-         Returns:
-            0-199 - ID duplicated
-            200 - Uploaded ok (no duplicate if enabled)
-            201 - Invalid position
-            202 - Communications error
-            203 - Device error
-        int SetTemplate(byte* tmplt, int id, bool duplicateCheck);
-    def SetTemplate(self,tmplt,ID,duplicateCheck):
-        cp = Command_Packet('SetTemplate',serial_dbg=self.serial_dbg)
-        cp.ParameterFromInt(ID)
+    def iter_image(self, chunk_size=4096):
+        '''
+             Streams the 258x202 image (52116 bytes) from the fps
+             The device stays locked until the generator is exhausted or
+             closed
+             Yields: bytearray chunks of at most chunk_size bytes as they
+                     arrive, nothing if the device refused the command
+             Raises: IOError if the data packet is truncated or corrupt
+        '''
+        with self._lock:
+            self._command('GetImage')
+            if self.get_response().ACK:
+                for chunk in self.iter_data(self.IMAGE_SIZE, chunk_size):
+                    yield chunk
+
+    def iter_raw_image(self, chunk_size=4096):
+        '''
+             Streams the qvga 160x120 raw image (19200 bytes) from the fps
+             The device stays locked until the generator is exhausted or
+             closed
+             Yields: bytearray chunks of at most chunk_size bytes as they
+                     arrive, nothing if the device refused the command
+             Raises: IOError if the data packet is truncated or corrupt
+        '''
+        with self._lock:
+            self._command('GetRawImage')
+            if self.get_response().ACK:
+                for chunk in self.iter_data(self.RAW_IMAGE_SIZE, chunk_size):
+                    yield chunk
+
+    def iter_template(self, ID, chunk_size=4096):
+        '''
+             Streams the template (498 bytes) of the specified ID from the fps
+             The device stays locked until the generator is exhausted or
+             closed
+             Parameter: 0-199 ID number
+             Yields: bytearray chunks of at most chunk_size bytes as they
+                     arrive, nothing if the ID is invalid or not used (the
+                     reason is in self._lastResponse)
+             Raises: IOError if the data packet is truncated or corrupt
+        '''
+        with self._lock:
+            self._command('GetTemplate', ID)
+            if self.get_response().ACK:
+                for chunk in self.iter_data(self.TEMPLATE_SIZE, chunk_size):
+                    yield chunk
+
+    @_synchronized
+    def make_template(self):
+        '''
+             Makes a template for transmission from the finger captured with
+             capture_finger (the template is not stored on the fps)
+             The template (498 bytes) is left in self._lastData
+             Returns: True if the template was made and downloaded, False if
+                      not (bad finger or bad data packet)
+        '''
+        self._command('MakeTemplate')
+        rp = self.get_response(self.TEMPLATE_SIZE)
+        retval = rp.ACK and self._lastData.IsValid()
+        return retval
+
+    @_synchronized
+    def set_template(self, tmplt, ID, duplicate_check=True):
+        '''
+             Uploads a template to the fps
+             Parameter: the template (498 bytes)
+             Parameter: the ID number to upload
+             Parameter: Check for duplicate fingerprints already on fps
+             Returns:
+                0-199 - ID duplicated
+                200 - Uploaded ok (no duplicate if enabled)
+                201 - Invalid position
+                202 - Communications error
+                203 - Device error
+        '''
+        rp = self._upload_template(
+            'SetTemplate', ID | (0 if duplicate_check else 0x00010000), tmplt)
+        retval = 200
+        if not rp.ACK:
+            if rp.ChecksumOK and rp.Parameter < 200:
+                retval = rp.Parameter
+            elif rp.Error == ErrorCode.NACK_INVALID_POS:
+                retval = 201
+            elif rp.Error == ErrorCode.NACK_DEV_ERR:
+                retval = 203
+            else:
+                retval = 202
+        else:
+            self._mark_enrolled(ID)
+        return retval
+
+    @_synchronized
+    def verify_template1_1(self, tmplt, ID):
+        '''
+             Checks a template against the enrollment of a specific ID
+             (no finger capture needed)
+             Parameter: the template (498 bytes)
+             Parameter: 0-199 (id number to be checked)
+             Returns:
+                0 - Verified OK (the correct finger)
+                1 - Invalid Position
+                2 - ID is not in use
+                3 - Verified FALSE (not the correct finger)
+                4 - Communications error
+        '''
+        rp = self._upload_template('VerifyTemplate1_1', ID, tmplt)
+        retval = 0
+        if not rp.ACK:
+            if rp.Error == ErrorCode.NACK_INVALID_POS:
+                retval = 1
+            elif rp.Error == ErrorCode.NACK_IS_NOT_USED:
+                retval = 2
+            elif rp.Error == ErrorCode.NACK_VERIFY_FAILED:
+                retval = 3
+            else:
+                retval = 4
+        return retval
 
+    @_synchronized
+    def identify_template1_N(self, tmplt):
+        '''
+             Checks a template against all enrolled fingerprints
+             (no finger capture needed)
+             Parameter: the template (498 bytes)
+             Returns:
+                0-199: Verified against the specified ID (found, and here is
+                       the ID number)
+                200: Failed to find the fingerprint in the database
+        '''
+        rp = self._upload_template('IdentifyTemplate1_N', 0, tmplt)
+        retval = rp.IntFromParameter() if rp.ACK else 200
+        if retval > 200:
+            retval = 200
+        return retval
 
+    def _upload_template(self, name, parameter, tmplt):
+        '''
+             Sends a template command and, once the fps ACKs it, the template
+             as a Data_Packet
+             Returns: the final Response_Packet (the NACK of the command if
+                      the fps refused it)
+        '''
+        if len(tmplt) != self.TEMPLATE_SIZE:
+            raise ValueError('Template must be {} bytes'.format(
+                self.TEMPLATE_SIZE))
+        self._command(name, parameter)
+        rp = self.get_response()
+        if rp.ACK:
+            dp = Data_Packet(data=tmplt, serial_dbg=self.serial_dbg)
+            packetbytes = dp.GetPacketBytes()
+            self.send_command(packetbytes, len(packetbytes))
+            rp = self.get_response()
+        return rp
+
+    @_synchronized
+    def occupancy(self, refresh=False):
+        '''
+             Returns the enrollment bitmap of the fps as an int (bit n set if
+             ID n is enrolled)
+             The bitmap is scanned from the fps once and then kept current by
+             check_enrolled, enroll_start/enroll3, set_template, delete_id
+             and delete_all
+             Parameter: refresh - rescan the fps even if the bitmap is cached
+        '''
+        if refresh or self._occupancy is None:
+            self.refresh_occupancy()
+        return self._occupancy
+
+    def refresh_occupancy(self, background=False):
+        '''
+             Rescans the enrollment bitmap from the fps
+             Stops as soon as GetEnrollCount enrolled IDs have been found
+             The device is locked per command, so other threads can use it
+             while a scan is running
+             Parameter: background - scan in a daemon thread and return it
+                        (the cached bitmap stays in use until it finishes)
+             Returns: the bitmap, or the thread when scanning in background
+             Raises: IOError if GetEnrollCount or a CheckEnrolled fails
+                     other than with NACK_IS_NOT_USED (the cached bitmap is
+                     left as it was)
+        '''
+        if background:
+            t = threading.Thread(target=self.refresh_occupancy,
+                                 name='occupancy-{}'.format(self._device_name))
+            t.daemon = True
+            t.start()
+            return t
+        changes = {}
+        with self._lock:
+            self._scans.append(changes)
+        try:
+            with self._lock:
+                remaining = self.get_enroll_count()
+                if not self._lastResponse.ACK:
+                    raise IOError('GetEnrollCount failed on {}'.format(
+                        self._device_name))
+            bitmap = 0
+            for ID in range(Template_Database.SLOTS):
+                if not remaining:
+                    break
+                with self._lock:
+                    self._command('CheckEnrolled', ID)
+                    rp = self.get_response()
+                    # IDs enrolled since GetEnrollCount are not counted
+                    counted = ID not in changes
+                enrolled = rp.ACK
+                if not enrolled and rp.Error != ErrorCode.NACK_IS_NOT_USED:
+                    raise IOError('CheckEnrolled {} failed on {}: {}'.format(
+                        ID, self._device_name, rp.Error.name))
+                if enrolled:
+                    bitmap |= 1 << ID
+                    if counted:
+                        remaining -= 1
+            with self._lock:
+                # Commands run during the scan know better than the scan
+                for ID, enrolled in changes.items():
+                    if enrolled:
+                        bitmap |= 1 << ID
+                    else:
+                        bitmap &= ~(1 << ID)
+                self._occupancy = bitmap
+        finally:
+            with self._lock:
+                self._scans.remove(changes)
+        return bitmap
+
+    def next_free_id(self):
+        '''
+             Returns the lowest ID that is not enrolled, from the cached
+             bitmap (the fps is only scanned if nothing is cached yet)
+             Returns: 0-199, or 200 if the database is full
+        '''
+        free = ~self.occupancy() & ((1 << Template_Database.SLOTS) - 1)
+        if not free:
+            return Template_Database.SLOTS
+        return (free & -free).bit_length() - 1
+
+    def _mark_enrolled(self, ID, enrolled=True):
+        '''
+             Updates the cached enrollment bitmap after a command changed
+             (or revealed) the state of an ID
+        '''
+        if not 0 <= ID < Template_Database.SLOTS:
+            return
+        for changes in self._scans:
+            changes[ID] = enrolled
+        if self._occupancy is None:
+            return
+        if enrolled:
+            self._occupancy |= 1 << ID
+        else:
+            self._occupancy &= ~(1 << ID)
+
+    def _mark_deleted_all(self):
+        '''
+             Empties the cached enrollment bitmap after DeleteAll
+        '''
+        for changes in self._scans:
+            changes.update(dict.fromkeys(range(Template_Database.SLOTS),
+                                         False))
+        self._occupancy = 0
+
+    @_synchronized
+    def backup_database(self, path):
+        '''
+             Saves every enrolled template to a Template_Database file
+             GetTemplate doubles as the enrollment check (no CheckEnrolled
+             round trips), templates are downloaded straight into the memory
+             mapped records, and the scan stops once GetEnrollCount templates
+             have been found
+             Parameter: path of the backup file (replaced only once the
+                        backup is complete)
+             Returns: the number of templates saved
+             Raises: IOError if GetEnrollCount fails or a GetTemplate fails
+                     other than with NACK_IS_NOT_USED (an incomplete backup
+                     would delete templates when restored with prune)
+        '''
+        remaining = self.get_enroll_count()
+        if not self._lastResponse.ACK:
+            raise IOError('GetEnrollCount failed on {}'.format(
+                self._device_name))
+        saved = 0
+        tmp = '{}.{}.tmp'.format(path, os.getpid())
+        db = Template_Database(tmp, 'w', self.TEMPLATE_SIZE)
+        try:
+            for ID in range(db.SLOTS):
+                if saved >= remaining:
+                    break
+                record = db.Record(ID)
+                retval = self.get_template_into(ID, record)
+                record.release()
+                rp = self._lastResponse
+                if not rp.ACK and rp.Error == ErrorCode.NACK_IS_NOT_USED:
+                    continue
+                if not rp.ACK or retval != 0:
+                    raise IOError('GetTemplate {} failed on {}: {}'.format(
+                        ID, self._device_name,
+                        rp.Error.name if not rp.ACK else 'bad data packet'))
+                db.SetUsed(ID)
+                saved += 1
+        except BaseException:
+            db.Close()
+            os.remove(tmp)
+            raise
+        db.Close()
+        os.replace(tmp, path)
+        return saved
+
+    @_synchronized
+    def restore_database(self, path, prune=False, compare=False):
+        '''
+             Uploads the templates of a Template_Database file to the fps
+             Parameter: path of the backup file
+             Parameter: prune - also delete IDs that are empty in the backup
+             Parameter: compare - download every enrolled slot first and skip
+                        those that already hold the identical template (about
+                        doubles the time when most slots differ)
+             Returns: list of the IDs that could not be restored (empty if
+                      everything went fine)
+        '''
+        failed = []
+        current = bytearray(self.TEMPLATE_SIZE)
+        db = Template_Database(path)
+        try:
+            for ID in range(db.SLOTS):
+                if not db.IsUsed(ID):
+                    if prune:
+                        self.delete_id(ID)
+                    continue
+                # Released even if a command raises, or Close can't unmap
+                with db.Record(ID) as record:
+                    if compare:
+                        enrolled = self.get_template_into(ID, current) == 0
+                        if enrolled and current == record:
+                            continue
+                    else:
+                        enrolled = self.occupancy() >> ID & 1
+                    if enrolled:
+                        self.delete_id(ID)
+                    if self.set_template(record, ID,
+                                         duplicate_check=False) != 200:
+                        failed.append(ID)
+        finally:
+            db.Close()
+        return failed
+
+    '''
          Commands that are not implemented (and why)
-         VerifyTemplate1_1 - Couldn't find a good reason to implement this
-                             on an arduino
-         IdentifyTemplate1_N - Couldn't find a good reason to implement this
-                               on an arduino
-         MakeTemplate - Couldn't find a good reason to implement this on an
-                        arduino
          UsbInternalCheck - not implemented - Not valid config for arduino
          GetDatabaseStart - historical command, no longer supported
          GetDatabaseEnd - historical command, no longer supported
@@ -755,52 +2255,399 @@ class FPS_GT511C3(SerialCommander):
                          reason... not implemented
     '''
 
-    def send_command(self, cmd, length):
+    def batch(self, window=1):
         '''
-             resets the Data_Packet class, and gets ready to download
-             Not implemented due to memory restrictions on the arduino
-             may revisit this if I find a need for it
-            void StartDataDownload();
+             Returns a Batch for queueing several commands that are then
+             sent with run_batch, sequentially unless a window above 1 opts
+             in to pipelining (see run_batch)
+        '''
+        return Batch(self, window)
+
+    @_synchronized
+    def run_batch(self, commands, window=1):
+        '''
+             Sends a list of commands under one lock, by default one at a
+             time (each waits for the response of the previous one)
+             Pipelining is opt-in: with a window above 1, up to window
+             commands are written ahead of their responses, so the fps never
+             waits on the host between commands; responses are matched to
+             commands in order by framing. This assumes the fps buffers a
+             command that arrives while it is still busy with the previous
+             one, which the data sheet doesn't promise and hasn't been
+             verified on hardware
+             Every command is sent even if an earlier one is NACKed
+             Parameter: commands - list of (command name, parameter)
+             Parameter: window - commands in flight (1 = no pipelining, the
+                        default)
+             Returns: list of Batch_Result
+        '''
+        results = []
+        sent = 0
+        window = max(1, window)
+        while sent < min(window, len(commands)):
+            self._command(*commands[sent], flush=not sent)
+            sent += 1
+        for commandName, parameter in commands:
+            data_length = self._data_length(commandName, parameter)
+            rp = self.get_response(data_length)
+            if sent < len(commands):
+                # Flush only when no response is outstanding
+                self._command(*commands[sent], flush=sent == len(results) + 1)
+                sent += 1
+            self._note_response(commandName, parameter, rp)
+            data = self._lastData if rp.ACK and data_length else None
+            results.append(Batch_Result(commandName, rp, data))
+        return results
+
+    def _data_length(self, commandName, parameter):
+        '''
+             Size of the data packet the fps sends after ACKing a command
+        '''
+        if commandName in ('GetTemplate', 'MakeTemplate'):
+            return self.TEMPLATE_SIZE
+        if commandName == 'GetImage':
+            return self.IMAGE_SIZE
+        if commandName == 'GetRawImage':
+            return self.RAW_IMAGE_SIZE
+        if commandName == 'Open' and parameter:
+            return self.DEVICE_INFO_SIZE
+        return 0
+
+    def _note_response(self, commandName, parameter, rp):
+        '''
+             Keeps the cached enrollment state current for commands run
+             outside their methods (run_batch)
+        '''
+        if commandName == 'CheckEnrolled':
+            self._mark_enrolled(parameter, rp.ACK)
+        elif commandName == 'DeleteID' and rp.ACK:
+            self._mark_enrolled(parameter, False)
+        elif commandName == 'DeleteAll' and rp.ACK:
+            self._mark_deleted_all()
+        elif commandName == 'EnrollStart':
+            self._enrollID = parameter if rp.ACK else None
+        elif (commandName == 'Enroll3' and rp.ACK and
+                self._enrollID is not None):
+            self._mark_enrolled(self._enrollID)
+
+    def transaction(self):
+        '''
+             Returns the device lock, for running several send_command and
+             get_response calls as one uninterrupted exchange:
+                 with scanner.transaction():
+                     scanner.send_command(...)
+                     rp = scanner.get_response()
+        '''
+        return self._lock
+
+    def submit(self, method, *args, **kwargs):
+        '''
+             Queues a call for the I/O thread of the device (started on first
+             use), so callers never wait on the serial port themselves
+             Parameter: method - name of a FPS_GT511C3 method or a callable
+             Parameter: args, kwargs - passed on to the method
+             Returns: concurrent.futures.Future with the return value
+        '''
+        if not callable(method):
+            method = getattr(self, method)
+        future = Future()
+        with self._worker_lock:
+            if self._worker is None or not self._worker.is_alive():
+                self._worker = threading.Thread(
+                    target=self._work,
+                    name='fps-io-{}'.format(self._device_name))
+                self._worker.daemon = True
+                self._worker.start()
+            self._queue.put((future, method, args, kwargs))
+        return future
+
+    def stop_worker(self, wait=True):
+        '''
+             Stops the I/O thread after the calls already queued have run
+             Parameter: wait - block until the thread has finished
+        '''
+        worker = self._worker
+        if worker is not None and worker.is_alive():
+            self._queue.put(None)
+            if wait and worker is not threading.current_thread():
+                worker.join()
 
-             Returns the next data packet
-             Not implemented due to memory restrictions on the arduino
-             may revisit this if I find a need for it
-            Data_Packet GetNextDataPacket();
+    def _work(self):
+        '''
+             Body of the I/O thread: runs queued calls one at a time
+        '''
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            future, method, args, kwargs = item
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                result = method(*args, **kwargs)
+            except BaseException as e:
+                future.set_exception(e)
+            else:
+                future.set_result(result)
+
+    def _command(self, commandName, parameter=0, flush=True):
+        '''
+             Encodes a command into the transmit buffer of the connection and
+             sends it (callers hold the device lock)
+             Parameter: flush - drop unread input first, so a reply that came
+                        in after its command gave up is not taken for the
+                        response to this one (False while earlier commands
+                        still wait for their responses, see run_batch)
+        '''
+        if self.serial_dbg:
+            wire_log.debug('Command: %s %d', commandName, parameter)
+        if flush and self._serial:
+            self._serial.reset_input_buffer()
+        Command_Packet.PackInto(self._txbuf, commandName, parameter)
+        if self.metrics is not None:
+            self._inflight.append([commandName, parameter, time.time(), 0, 0,
+                                   False, False])
+        self.send_command(self._txbuf, 12)
+
+    def send_command(self, cmd, length):
+        '''
+             Writes a command packet to the serial port
+             Data packets sent back by the download commands are read with
+             get_response (whole packet) or iter_data (streamed)
         '''
         if self._serial:
-            self._serial.write(bytes(cmd))
+            self._serial.write(cmd)
+            if self.metrics is not None:
+                self._count_bytes(length, True)
+            if self.wire is not None:
+                self.wire.record(WireTrace.WRITE, cmd[:length])
             if self.serial_dbg:
-                print self.serializeToSend(cmd)
-                print bytes(cmd)
-                print repr(bytes(cmd))[1:-1]
+                wire_log.debug('Write: %s', _Hex(bytes(cmd[:length])))
         else:
-            if self.serial_dbg:
-                debug_msg('Cannot write to {}'.format(self._device_name),
-                          'SendCommand')
+            log.warning('Cannot write to %s', self._device_name)
 
-    def get_response(self):
+    def get_response(self, data_length=0):
         '''
         Gets the response to the command from the software serial channel
         (and waits for it)
+        Reads exactly one 12 byte response packet and, when data_length is
+        given and the device ACKs, the data packet that follows it (4 header
+        bytes, data_length data bytes and 2 checksum bytes)
+        Parameter: data_length - size of the data packet payload sent by the
+                   command (0 for commands that only respond)
         '''
-        time.sleep(.1)
         if self._serial is None:
             rp = Response_Packet()
-            debug_msg('Cannot read from {}'.format(self._device_name),
-                      'GetResponse')
+            log.warning('Cannot read from %s', self._device_name)
         else:
-            r = bytearray(self._serial.read(self._serial.inWaiting()))
-            rp = Response_Packet(r, self.serial_dbg)
-
-        if rp.ACK:
-            time.sleep(.1)
-            r2 = bytearray(self._serial.read(self._serial.inWaiting()))
-            rp2 = Response_Packet(r2, self.serial_dbg)
-            while str(rp2._lastBuffer).__len__() > 0:
-                rp.RawBytes.extend(rp2.RawBytes)
-                rp._lastBuffer += rp2._lastBuffer
-                time.sleep(.1)
-                r2 = bytearray(self._serial.read(self._serial.inWaiting()))
-                rp2 = Response_Packet(r2, self.serial_dbg)
+            rp = Response_Packet(self._read_exact(12), self.serial_dbg)
+            if not rp.ChecksumOK:
+                self._resync()
+            elif rp.ACK and data_length:
+                packet = self._read_exact(data_length + 6)
+                self._lastData = Data_Packet(packet, self.serial_dbg)
+                if len(packet) < data_length + 6:
+                    self._resync()
+            if self.metrics is not None and self._inflight:
+                self._response_metrics(rp, data_length)
         self._lastResponse = rp
         return rp
+
+    def iter_data(self, length, chunk_size=4096):
+        '''
+        Streams the data packet that follows an ACKed download command
+        Validates the header before the first chunk and the checksum before
+        the last one goes out (the caller may stop right after it). If the
+        caller stops early, the rest of the packet is read and dropped so
+        the next response stays in sync.
+        Parameter: length - size of the data packet payload
+        Parameter: chunk_size - maximum size of the yielded chunks
+        Yields: bytearray chunks of the payload as they arrive
+        Raises: IOError if the packet is truncated or corrupt
+        '''
+        dp = Data_Packet()
+        header = self._read_exact(dp.HEADER_SIZE)
+        if len(header) < dp.HEADER_SIZE or not dp.IsHeader(header):
+            self._data_metrics(False)
+            self._resync()
+            raise IOError('Bad data packet header from {}'.format(
+                self._device_name))
+        chksum = dp.CalculateCheckSum(header)
+        remaining = length
+        complete = True
+        try:
+            while remaining:
+                wanted = min(chunk_size, remaining)
+                chunk = self._read_exact(wanted)
+                remaining -= len(chunk)
+                if len(chunk) < wanted:
+                    complete = False
+                    raise IOError('Data packet from {} truncated'.format(
+                        self._device_name))
+                chksum += dp.CalculateCheckSum(chunk)
+                if not remaining:
+                    self._check_trailer(dp, chksum)
+                yield chunk
+        finally:
+            if remaining:
+                if complete:
+                    self._read_exact(remaining + dp.CHECKSUM_SIZE)
+                else:
+                    self._resync()
+                self._data_metrics(complete)
+        if not length:
+            self._check_trailer(dp, chksum)
+
+    def _check_trailer(self, dp, chksum):
+        '''
+        Reads the checksum that ends a data packet and compares it with
+        chksum, the sum of the header and payload bytes
+        Raises: IOError if it is missing or wrong
+        '''
+        trailer = self._read_exact(dp.CHECKSUM_SIZE)
+        if len(trailer) < dp.CHECKSUM_SIZE:
+            self._resync()
+        valid = (len(trailer) == dp.CHECKSUM_SIZE and
+                 trailer[0] + (trailer[1] << 8) == dp.GetWord(chksum))
+        self._data_metrics(valid)
+        if not valid:
+            raise IOError('Bad data packet checksum from {}'.format(
+                self._device_name))
+
+    def read_data_into(self, buf, length):
+        '''
+        Reads the data packet that follows an ACKed download command straight
+        into buf, without intermediate copies of the payload
+        Parameter: buf - writable buffer of at least length bytes
+        Parameter: length - size of the data packet payload
+        Returns: True if the packet was complete and valid, False if not
+        '''
+        view = _data_view(buf, length)
+        dp = Data_Packet()
+        header = self._read_exact(dp.HEADER_SIZE)
+        got = self._readinto_exact(view)
+        trailer = self._read_exact(dp.CHECKSUM_SIZE)
+        if (len(trailer) < dp.CHECKSUM_SIZE or
+                not dp.IsHeader(header)):
+            self._resync()
+        valid = (got == length and len(trailer) == dp.CHECKSUM_SIZE and
+                 dp.IsHeader(header) and
+                 trailer[0] + (trailer[1] << 8) == dp.GetWord(
+                     dp.CalculateCheckSum(header) + sum(view)))
+        self._data_metrics(valid)
+        return valid
+
+    def _count_bytes(self, count, sent):
+        '''
+             Adds bytes written (sent) or read to the metrics, charging
+             writes to the newest command in flight and reads to the oldest
+        '''
+        if sent:
+            self.metrics.sent(self._device_name, count)
+            if self._inflight:
+                self._inflight[-1][4] += count
+        else:
+            self.metrics.received(self._device_name, count)
+            if self._inflight:
+                self._inflight[0][3] += count
+
+    def _count_timeout(self):
+        command = self._inflight[0] if self._inflight else None
+        self.metrics.timeout(self._device_name, command and command[0])
+        if command:
+            command[6] = True
+
+    def _response_metrics(self, rp, data_length):
+        '''
+             Finishes the metrics of the oldest command in flight with its
+             response, unless the ACK is followed by an upload or by a data
+             packet read separately (iter_data, read_data_into)
+        '''
+        command = self._inflight[0]
+        name, parameter = command[:2]
+        if rp.ACK and not command[5] and (
+                name in self.UPLOAD_COMMANDS or
+                (not data_length and self._data_length(name, parameter))):
+            command[5] = True
+            return
+        self._finish_metrics(None if rp.ACK else rp.Error.name)
+
+    def _data_metrics(self, valid):
+        '''
+             Finishes the metrics of a command whose data packet was read
+             by iter_data or read_data_into
+        '''
+        if (self.metrics is not None and self._inflight and
+                self._inflight[0][5]):
+            self._finish_metrics(None if valid else ErrorCode.INVALID.name)
+
+    def _finish_metrics(self, error):
+        name, _, start, bytes_in, bytes_out, _, timed_out = \
+            self._inflight.popleft()
+        self.metrics.finished(Command_Timing(
+            self._device_name, name, time.time() - start, bytes_out,
+            bytes_in, 'TIMEOUT' if timed_out else error))
+
+    def _read_exact(self, length):
+        '''
+        Reads exactly length bytes from the serial port
+        Keeps reading as long as bytes keep arriving and gives up (returning
+        what was read so far) only when a whole serial timeout passes without
+        any new data
+        '''
+        buf = bytearray(length)
+        got = self._readinto_exact(memoryview(buf))
+        if got < length:
+            del buf[got:]
+        return buf
+
+    def _resync(self):
+        '''
+        Drops what the fps still sends after a response that timed out or
+        came garbled (a late reply, the rest of a packet), until the line
+        has been quiet for RESYNC_QUIET seconds (or the serial timeout if
+        longer), so that the next command reads its own response
+        '''
+        timeout = self._serial.timeout
+        self._serial.reset_input_buffer()
+        self._serial.timeout = max(self.RESYNC_QUIET, timeout or 0)
+        dropped = 0
+        try:
+            while True:
+                data = self._serial.read(4096)
+                if self.wire is not None:
+                    self.wire.record(WireTrace.READ, data)
+                if not data:
+                    break
+                dropped += len(data)
+        finally:
+            self._serial.timeout = timeout
+        if self.metrics is not None and dropped:
+            self.metrics.received(self._device_name, dropped)
+        log.warning('Resynchronized with %s, dropped %d late bytes',
+                    self._device_name, dropped)
+
+    def _readinto_exact(self, view):
+        '''
+        Fills the memoryview view from the serial port, same timeout rules as
+        _read_exact
+        Returns: number of bytes read
+        '''
+        length = len(view)
+        got = self._serial.readinto(view)
+        # Nothing at all within the timeout: the response is not coming
+        while got and got < length:
+            n = self._serial.readinto(view[got:])
+            if not n:
+                log.warning('Timeout after %d of %d bytes from %s', got,
+                            length, self._device_name)
+                break
+            got += n
+        if self.wire is not None:
+            # Reads that timed out empty are recorded too
+            self.wire.record(WireTrace.READ, view[:got])
+        if self.metrics is not None:
+            self._count_bytes(got, False)
+            if got < length:
+                self._count_timeout()
+        return got
@@ -0,0 +1,500 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+'''
+asyncio client for the GT-511C3
+
+Speaks the same protocol as fps.FPS_GT511C3 (and reuses its Command_Packet,
+Response_Packet and Data_Packet encoding) over asyncio streams, so one event
+loop can drive many scanners without a thread per outstanding command.
+
+Serial ports are opened with pyserial-asyncio (pip install pyserial-asyncio);
+any other asyncio StreamReader/StreamWriter pair (e.g. a TCP serial bridge)
+can be handed to the constructor directly.
+
+SAMPLE CODE:
+
+    async def main():
+        scanner = await AsyncFPS_GT511C3.connect('/dev/ttyUSB0', 115200)
+        await scanner.set_led(True)
+        if await scanner.is_press_finger():
+            await scanner.capture_finger(False)
+            print(await scanner.identify1_N())
+        await scanner.set_led(False)
+        await scanner.close()
+'''
+
+import asyncio
+import logging
+
+import fps
+
+try:
+    import serial_asyncio
+except ImportError:
+    serial_asyncio = None
+
+log = logging.getLogger('fps')
+
+
+def _nack_code(rp, errors, default=0):
+    '''
+    Maps the NACK reason of a response to the return codes used by the
+    FPS_GT511C3 methods: 0 on ACK, n for the n-th name in errors and default
+    for any other reason
+    '''
+    if rp.ACK:
+        return 0
+    for i, name in enumerate(errors):
+        if rp.Error == fps.ErrorCode[name]:
+            return i + 1
+    return default
+
+
+class AsyncFPS_GT511C3(object):
+    '''
+        asyncio version of fps.FPS_GT511C3
+        Every command is a coroutine with the same parameters and return
+        values as its blocking counterpart
+    '''
+    IMAGE_SIZE = fps.FPS_GT511C3.IMAGE_SIZE
+    RAW_IMAGE_SIZE = fps.FPS_GT511C3.RAW_IMAGE_SIZE
+    TEMPLATE_SIZE = fps.FPS_GT511C3.TEMPLATE_SIZE
+    DEVICE_INFO_SIZE = fps.FPS_GT511C3.DEVICE_INFO_SIZE
+
+    serial_dbg = False
+    # Seconds the line must stay quiet before a failed response is
+    # considered over (see _resync)
+    RESYNC_QUIET = fps.FPS_GT511C3.RESYNC_QUIET
+
+    def __init__(self, reader, writer, device_name=None, timeout=2):
+        '''
+        Wraps an already connected asyncio stream pair
+        Parameter: timeout - seconds without any incoming byte before a read
+                   gives up
+        '''
+        self._reader = reader
+        self._writer = writer
+        self._device_name = device_name
+        self._timeout = timeout
+        # Serializes command/response exchanges between coroutines
+        self._lock = asyncio.Lock()
+        self._lastResponse = None
+        self._lastData = None
+
+    @classmethod
+    async def connect(cls, device_name='/dev/ttyAMA0', baud=9600, timeout=2):
+        '''
+        Opens the serial port with pyserial-asyncio and initialises the
+        device
+        '''
+        if serial_asyncio is None:
+            raise ImportError(
+                'AsyncFPS_GT511C3.connect needs pyserial-asyncio')
+        reader, writer = await serial_asyncio.open_serial_connection(
+            url=device_name, baudrate=baud)
+        scanner = cls(reader, writer, device_name, timeout)
+        await scanner.open()
+        return scanner
+
+    async def open(self):
+        '''
+            Initialises the device and gets ready for commands
+        '''
+        rp = await self._command('Open', 1,
+                                 data_length=self.DEVICE_INFO_SIZE)
+        return rp.ACK
+
+    async def close(self):
+        '''
+             Sends Close and closes the stream
+        '''
+        rp = await self._command('Close')
+        self._writer.close()
+        return rp.ACK
+
+    async def set_led(self, on=True):
+        '''
+             Turns on or off the LED backlight
+             Returns: True if successful, false if not
+        '''
+        rp = await self._command('CmosLed', 1 if on else 0)
+        return rp.ACK
+
+    async def change_baud_rate(self, baud):
+        '''
+             Changes the baud rate of the device and then of the port
+             Returns: True if success, false if invalid baud
+        '''
+        port = getattr(self._writer.transport, 'serial', None)
+        if port is not None and port.baudrate == baud:
+            return False
+        rp = await self._command('ChangeBaudrate', baud)
+        if rp.ACK and port is not None:
+            await self._writer.drain()
+            port.baudrate = baud
+        return rp.ACK
+
+    async def get_enroll_count(self):
+        '''
+             Return: The total number of enrolled fingerprints
+        '''
+        rp = await self._command('GetEnrollCount')
+        return rp.IntFromParameter()
+
+    async def check_enrolled(self, ID):
+        '''
+             Return: True if the ID number is enrolled, false if not
+        '''
+        rp = await self._command('CheckEnrolled', ID)
+        return rp.ACK
+
+    async def enroll_start(self, ID):
+        '''
+             Starts the Enrollment Process
+             Return: see FPS_GT511C3.enroll_start
+        '''
+        rp = await self._command('EnrollStart', ID)
+        return _nack_code(rp, ('NACK_DB_IS_FULL', 'NACK_INVALID_POS',
+                               'NACK_IS_ALREADY_USED'), 4)
+
+    async def enroll1(self):
+        '''
+             Gets the first scan of an enrollment
+             Return: see FPS_GT511C3.enroll1
+        '''
+        return await self._enroll('Enroll1')
+
+    async def enroll2(self):
+        '''
+             Gets the second scan of an enrollment
+             Return: see FPS_GT511C3.enroll2
+        '''
+        return await self._enroll('Enroll2')
+
+    async def enroll3(self):
+        '''
+             Gets the third scan of an enrollment, finishes enrollment
+             Return: see FPS_GT511C3.enroll3
+        '''
+        return await self._enroll('Enroll3')
+
+    async def _enroll(self, name):
+        rp = await self._command(name)
+        duplicate = 3 if rp.ChecksumOK and rp.Parameter < 200 else 1
+        return _nack_code(rp, ('NACK_ENROLL_FAILED', 'NACK_BAD_FINGER'),
+                          duplicate)
+
+    async def is_press_finger(self):
+        '''
+             Return: true if finger pressed, false if not
+        '''
+        rp = await self._command('IsPressFinger')
+        return rp.ACK and rp.IntFromParameter() == 0
+
+    async def delete_id(self, ID):
+        '''
+             Returns: true if successful, false if position invalid
+        '''
+        rp = await self._command('DeleteID', ID)
+        return rp.ACK
+
+    async def delete_all(self):
+        '''
+             Returns: true if successful, false if db is empty
+        '''
+        rp = await self._command('DeleteAll')
+        return rp.ACK
+
+    async def verify1_1(self, ID):
+        '''
+             Checks the currently pressed finger against a specific ID
+             Returns: see FPS_GT511C3.verify1_1
+        '''
+        rp = await self._command('Verify1_1', ID)
+        return _nack_code(rp, ('NACK_INVALID_POS', 'NACK_IS_NOT_USED',
+                               'NACK_VERIFY_FAILED'), 4)
+
+    async def identify1_N(self):
+        '''
+             Returns: 0-199 matching ID, 200 if not found
+        '''
+        rp = await self._command('Identify1_N')
+        return min(rp.IntFromParameter(), 200) if rp.ACK else 200
+
+    async def capture_finger(self, highquality=True):
+        '''
+             Captures the currently pressed finger into onboard ram
+             Returns: True if ok, false if no finger pressed
+        '''
+        rp = await self._command('CaptureFinger', 1 if highquality else 0)
+        return rp.ACK
+
+    async def get_image(self):
+        '''
+             Downloads the 258x202 image into self._lastData
+             Returns: True if the data packet arrived and is valid
+        '''
+        rp = await self._command('GetImage', data_length=self.IMAGE_SIZE)
+        return rp.ACK and self._lastData.IsValid()
+
+    async def get_raw_image(self):
+        '''
+             Downloads the 160x120 raw image into self._lastData
+             Returns: True if the data packet arrived and is valid
+        '''
+        rp = await self._command('GetRawImage',
+                                 data_length=self.RAW_IMAGE_SIZE)
+        return rp.ACK and self._lastData.IsValid()
+
+    async def get_template(self, ID):
+        '''
+             Downloads the template of an ID into self._lastData
+             Returns: see FPS_GT511C3.get_template
+        '''
+        rp = await self._command('GetTemplate', ID,
+                                 data_length=self.TEMPLATE_SIZE)
+        if rp.ACK and not self._lastData.IsValid():
+            return 3
+        return _nack_code(rp, ('NACK_INVALID_POS', 'NACK_IS_NOT_USED'))
+
+    async def make_template(self):
+        '''
+             Makes a template of the last capture into self._lastData
+             Returns: True if the template was made and downloaded
+        '''
+        rp = await self._command('MakeTemplate',
+                                 data_length=self.TEMPLATE_SIZE)
+        return rp.ACK and self._lastData.IsValid()
+
+    async def set_template(self, tmplt, ID, duplicate_check=True):
+        '''
+             Uploads a template to the fps
+             Returns: see FPS_GT511C3.set_template
+        '''
+        rp = await self._upload('SetTemplate', tmplt,
+                                ID | (0 if duplicate_check else 0x00010000))
+        if rp.ACK:
+            return 200
+        if rp.ChecksumOK and rp.Parameter < 200:
+            return rp.Parameter
+        return 200 + _nack_code(rp, ('NACK_INVALID_POS', 'NACK_COMM_ERR',
+                                     'NACK_DEV_ERR'), 2)
+
+    async def verify_template1_1(self, tmplt, ID):
+        '''
+             Checks a template against the enrollment of a specific ID
+             Returns: see FPS_GT511C3.verify_template1_1
+        '''
+        rp = await self._upload('VerifyTemplate1_1', tmplt, ID)
+        return _nack_code(rp, ('NACK_INVALID_POS', 'NACK_IS_NOT_USED',
+                               'NACK_VERIFY_FAILED'), 4)
+
+    async def identify_template1_N(self, tmplt):
+        '''
+             Checks a template against all enrolled fingerprints
+             Returns: 0-199 matching ID, 200 if not found
+        '''
+        rp = await self._upload('IdentifyTemplate1_N', tmplt)
+        return min(rp.IntFromParameter(), 200) if rp.ACK else 200
+
+    async def iter_image(self, chunk_size=4096):
+        '''
+             Streams the 258x202 image as chunks of at most chunk_size bytes
+             (async for chunk in scanner.iter_image(): ...)
+        '''
+        async for chunk in self._download('GetImage', 0, self.IMAGE_SIZE,
+                                          chunk_size):
+            yield chunk
+
+    async def iter_raw_image(self, chunk_size=4096):
+        '''
+             Streams the 160x120 raw image as chunks of at most chunk_size
+             bytes
+        '''
+        async for chunk in self._download('GetRawImage', 0,
+                                          self.RAW_IMAGE_SIZE, chunk_size):
+            yield chunk
+
+    async def iter_template(self, ID, chunk_size=4096):
+        '''
+             Streams the template of an ID, nothing if the ID is not used
+        '''
+        async for chunk in self._download('GetTemplate', ID,
+                                          self.TEMPLATE_SIZE, chunk_size):
+            yield chunk
+
+    async def _command(self, name, parameter=0, data_length=0):
+        '''
+             Sends one command and reads its response (and data packet)
+             Returns: the Response_Packet
+        '''
+        async with self._lock:
+            await self._flush()
+            self._send_command(name, parameter)
+            return await self._get_response(data_length)
+
+    async def _upload(self, name, tmplt, parameter=0):
+        '''
+             Sends a template command and, once ACKed, the template
+             Returns: the final Response_Packet
+        '''
+        if len(tmplt) != self.TEMPLATE_SIZE:
+            raise ValueError('Template must be {} bytes'.format(
+                self.TEMPLATE_SIZE))
+        async with self._lock:
+            await self._flush()
+            self._send_command(name, parameter)
+            rp = await self._get_response()
+            if rp.ACK:
+                dp = fps.Data_Packet(data=tmplt, serial_dbg=self.serial_dbg)
+                self._writer.write(bytes(dp.GetPacketBytes()))
+                rp = await self._get_response()
+            return rp
+
+    async def _download(self, name, parameter, length, chunk_size):
+        '''
+             Sends a download command and streams its data packet
+             A task reads the packet into a queue under the device lock and
+             the chunks are yielded from there, so the lock is never held
+             while the caller has a chunk (a slow or abandoned consumer
+             doesn't block other commands, the packet is still read whole)
+             Raises: IOError if the packet is truncated or corrupt
+        '''
+        chunks = asyncio.Queue()
+        task = asyncio.ensure_future(self._read_download(
+            name, parameter, length, chunk_size, chunks))
+        # Retrieved here too, in case the consumer stops early
+        task.add_done_callback(lambda t: t.cancelled() or t.exception())
+        while True:
+            chunk = await chunks.get()
+            if chunk is None:
+                break
+            yield chunk
+        await task
+
+    async def _read_download(self, name, parameter, length, chunk_size,
+                             chunks):
+        '''
+             Runs a download command, putting the chunks of its data packet
+             on the queue chunks and None at the end
+        '''
+        dp = fps.Data_Packet()
+        try:
+            async with self._lock:
+                await self._flush()
+                self._send_command(name, parameter)
+                if not (await self._get_response()).ACK:
+                    return
+                header = await self._read_exact(dp.HEADER_SIZE)
+                if len(header) < dp.HEADER_SIZE or not dp.IsHeader(header):
+                    await self._resync()
+                    raise IOError('Bad data packet header from {}'.format(
+                        self._device_name))
+                chksum = dp.CalculateCheckSum(header)
+                remaining = length
+                try:
+                    while remaining:
+                        wanted = min(chunk_size, remaining)
+                        chunk = await self._read_exact(wanted)
+                        remaining -= len(chunk)
+                        if len(chunk) < wanted:
+                            raise IOError('Data packet from {} truncated'
+                                          .format(self._device_name))
+                        chksum += dp.CalculateCheckSum(chunk)
+                        chunks.put_nowait(chunk)
+                finally:
+                    if remaining:
+                        await self._resync()
+                trailer = await self._read_exact(dp.CHECKSUM_SIZE)
+                if len(trailer) < dp.CHECKSUM_SIZE:
+                    await self._resync()
+                if (len(trailer) < dp.CHECKSUM_SIZE or
+                        trailer[0] + (trailer[1] << 8) != dp.GetWord(chksum)):
+                    raise IOError('Bad data packet checksum from {}'.format(
+                        self._device_name))
+        finally:
+            chunks.put_nowait(None)
+
+    def _send_command(self, name, parameter):
+        # A fresh bytes object: the transport may keep it queued
+        self._writer.write(fps.Command_Packet.Pack(name, parameter))
+
+    async def _get_response(self, data_length=0):
+        '''
+             Reads one 12 byte response and, if data_length is given and the
+             device ACKed, the data packet after it
+        '''
+        rp = fps.Response_Packet(await self._read_exact(12), self.serial_dbg)
+        if not rp.ChecksumOK:
+            await self._resync()
+        elif rp.ACK and data_length:
+            data = await self._read_exact(data_length + 6)
+            if len(data) < data_length + 6:
+                await self._resync()
+            self._lastData = fps.Data_Packet(data, self.serial_dbg)
+        self._lastResponse = rp
+        return rp
+
+    async def _flush(self):
+        '''
+             Drops whatever is already buffered from the device (a reply
+             that came after its command gave up), without waiting for more,
+             so that the next command reads its own response
+        '''
+        dropped = 0
+        while True:
+            read = asyncio.ensure_future(self._reader.read(4096))
+            # One loop iteration: enough to return what is buffered
+            await asyncio.sleep(0)
+            if not read.done():
+                read.cancel()
+                try:
+                    await read
+                except asyncio.CancelledError:
+                    pass
+                break
+            data = read.result()
+            if not data:
+                break
+            dropped += len(data)
+        if dropped:
+            log.warning('Dropped %d stale bytes from %s', dropped,
+                        self._device_name)
+
+    async def _resync(self):
+        '''
+             Drops what the device still sends after a response that timed
+             out or came garbled, until the line has been quiet for
+             RESYNC_QUIET seconds (or the timeout if longer), as
+             FPS_GT511C3._resync does
+        '''
+        quiet = max(self.RESYNC_QUIET, self._timeout or 0)
+        dropped = 0
+        while True:
+            try:
+                data = await asyncio.wait_for(self._reader.read(4096), quiet)
+            except asyncio.TimeoutError:
+                break
+            if not data:
+                break
+            dropped += len(data)
+        log.warning('Resynchronized with %s, dropped %d late bytes',
+                    self._device_name, dropped)
+
+    async def _read_exact(self, length):
+        '''
+             Reads exactly length bytes, giving up only when no byte arrives
+             for a whole timeout (returns what was read so far)
+        '''
+        buf = bytearray()
+        while len(buf) < length:
+            try:
+                chunk = await asyncio.wait_for(
+                    self._reader.read(length - len(buf)), self._timeout)
+            except asyncio.TimeoutError:
+                break
+            if not chunk:
+                break
+            buf.extend(chunk)
+        return buf
@@ -0,0 +1,334 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+'''
+Latency and throughput benchmark of the FPS_GT511C3 commands
+
+Runs every command (and template and image transfer) many times at one or
+more baud rates and reports, per command, the p50/p95/p99 latency, the
+bytes sent and received, bytes/sec, and how the time splits between serial
+I/O (the wire plus the device's processing), time.sleep in the driver and
+the rest (host side). Results go to a JSON file that a later run can be
+compared with (--compare) to catch regressions, e.g. in get_response.
+
+Without a port the benchmark runs against fps_emulator on a pseudo
+terminal, with the latencies of a real scanner (TYPICAL_LATENCY), so the
+numbers cover the driver and pyserial but not the hardware. On a real
+scanner keep a finger on the sensor and something enrolled at ID 0.
+
+SAMPLE CODE:
+
+    python fps_bench.py -o bench.json                   # emulated
+    python fps_bench.py /dev/ttyAMA0 --baud 9600 115200 -o bench.json
+    python fps_bench.py --compare bench.json            # exit 1 on regressions
+'''
+
+import argparse
+import json
+import platform
+import sys
+import time
+
+import serial
+
+import fps
+
+# (name, method, arguments, image download: runs --image-runs times)
+BENCHMARKS = [
+    ('set_led', 'set_led', (True,), False),
+    ('is_press_finger', 'is_press_finger', (), False),
+    ('get_enroll_count', 'get_enroll_count', (), False),
+    ('check_enrolled', 'check_enrolled', (0,), False),
+    ('capture_finger', 'capture_finger', (), False),
+    ('verify1_1', 'verify1_1', (0,), False),
+    ('identify1_N', 'identify1_N', (), False),
+    ('get_template', 'get_template', (0,), False),
+    ('get_raw_image', 'get_raw_image', (), True),
+    ('get_image', 'get_image', (), True),
+]
+
+PERCENTILES = (50, 95, 99)
+
+
+class _Meter(object):
+    '''
+        Counts the bytes moved and the time spent in the serial port and in
+        time.sleep of the driver while attached
+    '''
+
+    def __init__(self):
+        self.io = 0.
+        self.sleep = 0.
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self._serial = None
+        self._time = None
+        self._inside = False
+
+    def reset(self):
+        self.io = self.sleep = 0.
+        self.bytes_in = self.bytes_out = 0
+
+    def attach(self, ser):
+        '''
+        Wraps read, readinto and write of the port, and the driver's sleep
+        '''
+        self._serial = ser
+        for name in ('read', 'readinto', 'write'):
+            setattr(ser, name, self._timed(getattr(ser, name),
+                                           name == 'write'))
+        self._time = fps.time
+        fps.time = _SleepMeter(self)
+
+    def detach(self):
+        for name in ('read', 'readinto', 'write'):
+            delattr(self._serial, name)
+        fps.time = self._time
+
+    def _timed(self, method, out):
+        def timed(*args):
+            # pyserial's readinto calls read: count the outer call only
+            if self._inside:
+                return method(*args)
+            self._inside = True
+            start = time.time()
+            try:
+                result = method(*args)
+            finally:
+                self.io += time.time() - start
+                self._inside = False
+            n = result if isinstance(result, int) else len(result or b'')
+            if out:
+                self.bytes_out += n
+            else:
+                self.bytes_in += n
+            return result
+        return timed
+
+
+class _SleepMeter(object):
+    '''
+        Stands in for the time module in fps, timing sleep
+    '''
+
+    def __init__(self, meter):
+        self._meter = meter
+
+    def __getattr__(self, name):
+        return getattr(time, name)
+
+    def sleep(self, seconds):
+        start = time.time()
+        try:
+            time.sleep(seconds)
+        finally:
+            self._meter.sleep += time.time() - start
+
+
+def percentile(ordered, p):
+    '''
+    Returns: the p-th percentile of sorted values (linear interpolation)
+    '''
+    if not ordered:
+        return None
+    k = (len(ordered) - 1) * p / 100.
+    lower = int(k)
+    upper = min(lower + 1, len(ordered) - 1)
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (k - lower)
+
+
+def bench_command(scanner, meter, method, args, runs, warmup=1):
+    '''
+    Times runs calls of a scanner method
+    Returns: dict of the statistics of the runs
+    '''
+    call = getattr(scanner, method)
+    for i in range(warmup):
+        call(*args)
+    meter.reset()
+    latencies = []
+    for i in range(runs):
+        start = time.time()
+        call(*args)
+        latencies.append(time.time() - start)
+    total = sum(latencies)
+    latencies.sort()
+    moved = meter.bytes_in + meter.bytes_out
+    result = {
+        'runs': runs,
+        'mean': total / runs,
+        'min': latencies[0],
+        'max': latencies[-1],
+        'bytes_in': meter.bytes_in // runs,
+        'bytes_out': meter.bytes_out // runs,
+        'bytes_per_sec': moved / total if total else None,
+        # 10 bits per byte (8N1) at the current rate
+        'wire_time': moved * 10. / scanner._baud / runs,
+        'io_share': meter.io / total if total else None,
+        'sleep_share': meter.sleep / total if total else None,
+    }
+    result['host_share'] = (1 - result['io_share'] - result['sleep_share']
+                            if total else None)
+    for p in PERCENTILES:
+        result['p{}'.format(p)] = percentile(latencies, p)
+    return result
+
+
+def run(scanner, bauds, runs=50, image_runs=3, benchmarks=None,
+        progress=None):
+    '''
+    Runs the benchmarks at each baud rate, switching the device between them
+    Parameter: benchmarks - names from BENCHMARKS to run, default all
+    Parameter: progress - called with (baud, name) before each benchmark
+    Returns: dict of baud rate (as a string) -> name -> statistics
+    '''
+    results = {}
+    meter = _Meter()
+    scanner.set_led(True)
+    for baud in bauds:
+        if baud != scanner._baud and not scanner.change_baud_rate(baud):
+            raise IOError('Cannot switch {} to {} baud'.format(
+                scanner._device_name, baud))
+        meter.attach(scanner._serial)
+        try:
+            at_baud = results[str(baud)] = {}
+            for name, method, args, image in BENCHMARKS:
+                if benchmarks and name not in benchmarks:
+                    continue
+                if progress is not None:
+                    progress(baud, name)
+                at_baud[name] = bench_command(
+                    scanner, meter, method, args,
+                    image_runs if image else runs, 0 if image else 1)
+        finally:
+            meter.detach()
+    scanner.set_led(False)
+    return results
+
+
+def compare(results, baseline, threshold=1.2):
+    '''
+    Compares the p50 latencies with those of an earlier run
+    Returns: list of (baud, name, baseline p50, p50, ratio) that got slower
+             than threshold times the baseline
+    '''
+    slower = []
+    for baud, at_baud in results.items():
+        for name, stats in at_baud.items():
+            old = baseline.get(baud, {}).get(name)
+            if not old or not old.get('p50'):
+                continue
+            ratio = stats['p50'] / old['p50']
+            if ratio > threshold:
+                slower.append((baud, name, old['p50'], stats['p50'], ratio))
+    return slower
+
+
+def _emulated(baud):
+    '''
+    Returns: (port name, server) of an emulated scanner with finger 1
+             enrolled at ID 0 and on the sensor; the server is None when it
+             runs in process (no pty)
+    '''
+    import fps_emulator
+    emulator = fps_emulator.Emulator(baud, fps_emulator.TYPICAL_LATENCY)
+    emulator.enroll(0, 1)
+    emulator.press(1)
+    try:
+        server = fps_emulator.PtyServer(emulator)
+    except ImportError:
+        return emulator.url, None
+    return server.port, server
+
+
+def _report(results, out):
+    for baud, at_baud in sorted(results.items(), key=lambda r: int(r[0])):
+        out.write('{} baud\n'.format(baud))
+        out.write('  {:<18}{:>9}{:>9}{:>9}{:>11}{:>6}{:>7}{:>7}\n'.format(
+            'command', 'p50 ms', 'p95 ms', 'p99 ms', 'bytes/s', 'io%',
+            'sleep%', 'host%'))
+        for name, s in at_baud.items():
+            out.write('  {:<18}{:>9.1f}{:>9.1f}{:>9.1f}{:>11.0f}{:>6.0f}'
+                      '{:>7.0f}{:>7.0f}\n'.format(
+                          name, s['p50'] * 1e3, s['p95'] * 1e3,
+                          s['p99'] * 1e3, s['bytes_per_sec'] or 0,
+                          (s['io_share'] or 0) * 100,
+                          (s['sleep_share'] or 0) * 100,
+                          (s['host_share'] or 0) * 100))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Benchmark FPS_GT511C3 command latency and throughput')
+    parser.add_argument('port', nargs='?',
+                        help='serial port or URL (default: emulated on a '
+                             'pty)')
+    parser.add_argument('--baud', type=int, nargs='+', default=[9600],
+                        choices=fps.BAUD_RATES,
+                        help='baud rates to run at, the first one is the '
+                             'current rate of the device')
+    parser.add_argument('-n', '--runs', type=int, default=50)
+    parser.add_argument('--image-runs', type=int, default=3,
+                        help='runs of the image downloads')
+    parser.add_argument('-b', '--bench', nargs='+',
+                        choices=[b[0] for b in BENCHMARKS],
+                        help='benchmarks to run (default all)')
+    parser.add_argument('-o', '--output', help='JSON file for the results')
+    parser.add_argument('--compare', metavar='JSON',
+                        help='earlier results to compare the p50s with')
+    parser.add_argument('--threshold', type=float, default=1.2,
+                        help='p50 ratio that counts as a regression')
+    args = parser.parse_args(argv)
+
+    server = None
+    port = args.port
+    if port is None:
+        port, server = _emulated(args.baud[0])
+    scanner = fps.FPS_GT511C3(device_name=port, baud=args.baud[0])
+    if not scanner._serial:
+        sys.stderr.write('Cannot open {}\n'.format(port))
+        return 2
+
+    def progress(baud, name):
+        sys.stderr.write('{} baud: {}\n'.format(baud, name))
+
+    try:
+        results = run(scanner, args.baud, args.runs, args.image_runs,
+                      args.bench, progress)
+    finally:
+        if args.baud[0] != scanner._baud:
+            scanner.change_baud_rate(args.baud[0])
+        scanner._serial.close()
+        if server is not None:
+            server.close()
+
+    document = {
+        'meta': {
+            'port': args.port or 'emulated',
+            'time': time.time(),
+            'python': platform.python_version(),
+            'pyserial': serial.VERSION,
+            'platform': platform.platform(),
+            'runs': args.runs,
+            'image_runs': args.image_runs,
+        },
+        'results': results,
+    }
+    _report(results, sys.stdout)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(document, f, indent=1, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)['results']
+        slower = compare(results, baseline, args.threshold)
+        for baud, name, old, new, ratio in slower:
+            print('SLOWER {} at {} baud: p50 {:.1f} ms -> {:.1f} ms '
+                  '(x{:.2f})'.format(name, baud, old * 1e3, new * 1e3, ratio))
+        if slower:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,762 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+'''
+Software GT-511C3 for running the driver without the hardware
+
+Emulator speaks the command, response and data packets of the scanner and
+keeps a 200 slot template database, the LED, the finger on the sensor and
+the enrollment state. Fingers are numbers: a finger pressed with press(n)
+always gives the same synthetic images and template, so enrolling and
+identifying behave like on a real scanner.
+
+Bytes take as long as they would on the wire at the baud rate of the
+emulated device. Each command can get a processing latency (TYPICAL_LATENCY
+is roughly what the real scanner takes), and responses can be dropped,
+corrupted or truncated at random or on demand (inject).
+
+The driver attaches to it in two ways:
+  - in process, through the gt511:// pyserial URL handler registered by
+    this module: FPS_GT511C3(device_name=emulator.url)
+  - through a pseudo terminal (POSIX only): PtyServer(emulator).port is a
+    tty device name, usable from any process
+
+SAMPLE CODE:
+
+    emulator = fps_emulator.Emulator(latency=fps_emulator.TYPICAL_LATENCY)
+    scanner = fps.FPS_GT511C3(device_name=emulator.url)
+    emulator.press(3)
+    print(scanner.enroll())
+
+    python fps_emulator.py --baud 115200    # serves a pty until killed
+'''
+
+import collections
+import math
+import os
+import random
+import struct
+import sys
+import threading
+import time
+import types
+
+import serial
+from serial.serialutil import SerialBase, SerialException, PortNotOpenError
+
+import fps
+
+SLOTS = fps.Template_Database.SLOTS
+TEMPLATE_SIZE = fps.FPS_GT511C3.TEMPLATE_SIZE
+RAW_SIZE = (160, 120)
+IMAGE_SIZE = (258, 202)
+
+COMMAND = struct.Struct('<BBHIHH')  # start codes, device ID, param, code, sum
+DATA_HEADER = b'\x5a\xa5\x01\x00'
+ACK = fps.Command_Packet.commands['Ack']
+NACK = fps.Command_Packet.commands['Nack']
+COMMAND_NAMES = dict((code, name) for name, code in
+                     fps.Command_Packet.commands.items())
+
+# Seconds the GT-511C3 takes to process each command, roughly
+TYPICAL_LATENCY = {
+    'Open': .05, 'CmosLed': .01, 'IsPressFinger': .03, 'CaptureFinger': .3,
+    'Enroll1': .4, 'Enroll2': .4, 'Enroll3': .6, 'Verify1_1': .3,
+    'Identify1_N': .5, 'VerifyTemplate1_1': .1, 'IdentifyTemplate1_N': .3,
+    'MakeTemplate': .3, 'GetImage': .1, 'GetRawImage': .2, 'SetTemplate': .1,
+    'DeleteID': .05, 'DeleteAll': .1, 'GetTemplate': .02,
+}
+
+FAULTS = ('drop', 'corrupt', 'truncate', 'nack')
+
+# Emulators reachable as gt511://<name>
+EMULATORS = {}
+
+
+def template_of(finger):
+    '''
+    Returns the template (498 bytes) the emulator makes of a finger
+    '''
+    rnd = random.Random(finger)
+    return (struct.pack('<I', finger) +
+            bytes(bytearray(rnd.getrandbits(8)
+                            for i in range(TEMPLATE_SIZE - 4))))
+
+
+def finger_of(tmplt):
+    '''
+    Returns the finger a template was made of (see template_of)
+    '''
+    return struct.unpack_from('<I', bytes(tmplt[:4]))[0]
+
+
+_images = {}
+
+
+def synthetic_image(finger, size):
+    '''
+    Returns a width x height 8 bit grey image (bytes) of a finger: a whorl
+    of ridges around a per finger centre, on a light background; None gives
+    an empty sensor
+    '''
+    key = (finger, size)
+    image = _images.get(key)
+    if image is not None:
+        return image
+    width, height = size
+    if finger is None:
+        image = bytes(bytearray([230]) * (width * height))
+    else:
+        rnd = random.Random(finger)
+        cx = width * rnd.uniform(.4, .6)
+        cy = height * rnd.uniform(.4, .6)
+        period = rnd.uniform(5., 8.) * width / 160.
+        twist = rnd.uniform(-1.5, 1.5)
+        rx, ry = width * .38, height * .45
+        pixels = bytearray(width * height)
+        i = 0
+        for y in range(height):
+            for x in range(width):
+                dx, dy = x - cx, y - cy
+                if (dx / rx) ** 2 + (dy / ry) ** 2 > 1:
+                    pixels[i] = 230
+                else:
+                    phase = (math.hypot(dx, dy) + twist * math.atan2(dy, dx) *
+                             period) * 2 * math.pi / period
+                    pixels[i] = int(110 + 90 * math.sin(phase))
+                i += 1
+        image = bytes(pixels)
+    _images[key] = image
+    return image
+
+
+def response_packet(ack, parameter=0):
+    '''
+    Returns the 12 bytes of a response packet
+    '''
+    packet = bytearray(COMMAND.pack(0x55, 0xAA, 1, parameter & 0xFFFFFFFF,
+                                    ACK if ack else NACK, 0))
+    struct.pack_into('<H', packet, 10, sum(packet[:10]) & 0xFFFF)
+    return bytes(packet)
+
+
+def data_packet(payload):
+    '''
+    Returns the bytes of a data packet carrying payload
+    '''
+    packet = bytearray(DATA_HEADER) + bytearray(payload)
+    return bytes(packet + struct.pack('<H', sum(packet) & 0xFFFF))
+
+
+class Emulator(object):
+    '''
+        Protocol model of one GT-511C3
+    '''
+    FIRMWARE = 0x20110523
+    ISO_AREA_MAX_SIZE = 0x1000
+
+    def __init__(self, baud=9600, latency=0, faults=None, timing=True,
+                 seed=None, name=None):
+        '''
+        Parameter: baud - baud rate the device starts at
+        Parameter: latency - seconds to process every command, or a dict of
+                   command name -> seconds (e.g. TYPICAL_LATENCY)
+        Parameter: faults - dict of fault (see FAULTS but 'nack') -> chance
+                   of it hitting each response
+        Parameter: timing - take the wire time of every byte at the baud rate
+        Parameter: seed - of the random faults
+        Parameter: name - the emulator is reachable as gt511://name
+        '''
+        self.baud = baud
+        self.latency = latency
+        self.faults = dict(faults or {})
+        self.timing = timing
+        self.templates = {}          # ID -> template
+        self.led = False
+        self.finger = None           # finger on the sensor
+        self.serial_number = os.urandom(16)
+        self.commands = collections.Counter()
+        self._random = random.Random(seed)
+        self._injected = collections.deque()
+        self._captured = None
+        self._enroll = None          # [ID, next stage, finger]
+        self._expect = None          # (command, parameter) awaiting data
+        self._new_baud = None        # see take_baud_change
+        self._inbuf = bytearray()
+        self._lock = threading.Lock()
+        self.name = name if name is not None else str(id(self))
+        EMULATORS[self.name] = self
+
+    @property
+    def url(self):
+        return 'gt511://' + self.name
+
+    def byte_time(self):
+        '''
+        Returns: seconds per byte at the current baud rate (8N1), 0 without
+                 timing
+        '''
+        return 10.0 / self.baud if self.timing else 0.
+
+    def press(self, finger=1):
+        '''
+        Puts a finger on the sensor
+        '''
+        self.finger = finger
+
+    def release(self):
+        '''
+        Lifts the finger off the sensor
+        '''
+        self.finger = None
+
+    def enroll(self, ID, finger):
+        '''
+        Stores the template of a finger straight into the database
+        '''
+        self.templates[ID] = template_of(finger)
+
+    def inject(self, fault, count=1, after=0):
+        '''
+        Makes count responses fail with a fault (see FAULTS), starting after
+        the next after responses
+        '''
+        if fault not in FAULTS:
+            raise ValueError('Unknown fault {}'.format(fault))
+        self._injected.extend([None] * after + [fault] * count)
+
+    def close(self):
+        EMULATORS.pop(self.name, None)
+
+    def feed(self, data):
+        '''
+        Receives bytes from the host
+        Returns: list of (latency, bytes) for the responses they complete
+        '''
+        out = []
+        with self._lock:
+            self._inbuf += data
+            while True:
+                if self._expect is not None:
+                    size = len(DATA_HEADER) + TEMPLATE_SIZE + 2
+                    if len(self._inbuf) < size:
+                        break
+                    packet = bytes(self._inbuf[:size])
+                    del self._inbuf[:size]
+                    name, parameter = self._expect
+                    self._expect = None
+                    reply = self._upload(name, parameter, packet)
+                else:
+                    start = self._inbuf.find(b'\x55\xaa')
+                    if start < 0:
+                        del self._inbuf[:max(0, len(self._inbuf) - 1)]
+                        break
+                    del self._inbuf[:start]
+                    if len(self._inbuf) < COMMAND.size:
+                        break
+                    packet = bytes(self._inbuf[:COMMAND.size])
+                    del self._inbuf[:COMMAND.size]
+                    name, reply = self._command(packet)
+                out.append((self._latency(name), self._fault(reply)))
+        return out
+
+    def _latency(self, name):
+        if isinstance(self.latency, dict):
+            return self.latency.get(name, 0)
+        return self.latency
+
+    def _fault(self, reply):
+        '''
+        Applies the next injected fault, or a random one, to a reply
+        '''
+        fault = None
+        if self._injected:
+            fault = self._injected.popleft()
+        else:
+            for kind, chance in self.faults.items():
+                if self._random.random() < chance:
+                    fault = kind
+                    break
+        if fault is None or not reply:
+            return reply
+        if fault == 'drop':
+            return b''
+        if fault == 'truncate':
+            return reply[:len(reply) // 2]
+        if fault == 'nack':
+            return response_packet(False, fps.ErrorCode.NACK_DEV_ERR)
+        reply = bytearray(reply)
+        reply[self._random.randrange(len(reply))] ^= 0xFF
+        return bytes(reply)
+
+    def _command(self, packet):
+        '''
+        Runs one command packet
+        Returns: (command name, reply bytes)
+        '''
+        _, _, _, parameter, code, checksum = COMMAND.unpack(packet)
+        name = COMMAND_NAMES.get(code, 'NotSet')
+        if sum(bytearray(packet[:10])) & 0xFFFF != checksum:
+            return name, response_packet(False, fps.ErrorCode.NACK_COMM_ERR)
+        self.commands[name] += 1
+        handler = getattr(self, '_do_' + name, None)
+        if handler is None:
+            return name, response_packet(
+                False, fps.ErrorCode.NACK_IS_NOT_SUPPORTED)
+        return name, handler(parameter)
+
+    # Commands, each returns the bytes it sends back
+
+    def _do_Open(self, parameter):
+        reply = response_packet(True)
+        if parameter:
+            reply += data_packet(struct.pack('<II16s', self.FIRMWARE,
+                                             self.ISO_AREA_MAX_SIZE,
+                                             self.serial_number))
+        return reply
+
+    def _do_Close(self, parameter):
+        return response_packet(True)
+
+    def _do_ChangeBaudrate(self, parameter):
+        if parameter not in fps.BAUD_RATES:
+            return response_packet(False, fps.ErrorCode.NACK_INVALID_PARAM)
+        # The ACK still goes out at the old rate (see EmulatedSerial)
+        self._new_baud = parameter
+        return response_packet(True)
+
+    def _do_CmosLed(self, parameter):
+        self.led = bool(parameter)
+        return response_packet(True)
+
+    def _do_GetEnrollCount(self, parameter):
+        return response_packet(True, len(self.templates))
+
+    def _check_id(self, ID, used=True):
+        '''
+        Returns: NACK reply if ID is out of range or (not) used, else None
+        '''
+        if not 0 <= ID < SLOTS:
+            return response_packet(False, fps.ErrorCode.NACK_INVALID_POS)
+        if used and ID not in self.templates:
+            return response_packet(False, fps.ErrorCode.NACK_IS_NOT_USED)
+        if not used and ID in self.templates:
+            return response_packet(False, fps.ErrorCode.NACK_IS_ALREADY_USED)
+        return None
+
+    def _do_CheckEnrolled(self, parameter):
+        return self._check_id(parameter) or response_packet(True)
+
+    def _do_EnrollStart(self, parameter):
+        if len(self.templates) >= SLOTS:
+            return response_packet(False, fps.ErrorCode.NACK_DB_IS_FULL)
+        nack = self._check_id(parameter, used=False)
+        if nack:
+            return nack
+        self._enroll = [parameter, 1, None]
+        return response_packet(True)
+
+    def _enroll_stage(self, stage):
+        if self._enroll is None or self._enroll[1] != stage:
+            return response_packet(False, fps.ErrorCode.NACK_TURN_ERR)
+        finger, self._captured = self._captured, None
+        if finger is None:
+            return response_packet(False, fps.ErrorCode.NACK_BAD_FINGER)
+        if self._enroll[2] not in (None, finger):
+            self._enroll = None
+            return response_packet(False, fps.ErrorCode.NACK_ENROLL_FAILED)
+        self._enroll[1:] = [stage + 1, finger]
+        if stage < 3:
+            return response_packet(True)
+        ID = self._enroll[0]
+        self._enroll = None
+        duplicate = self._find(finger)
+        if duplicate is not None:
+            return response_packet(False, duplicate)
+        self.templates[ID] = template_of(finger)
+        return response_packet(True)
+
+    def _do_Enroll1(self, parameter):
+        return self._enroll_stage(1)
+
+    def _do_Enroll2(self, parameter):
+        return self._enroll_stage(2)
+
+    def _do_Enroll3(self, parameter):
+        return self._enroll_stage(3)
+
+    def _do_IsPressFinger(self, parameter):
+        pressed = self.led and self.finger is not None
+        return response_packet(True, 0 if pressed else 1)
+
+    def _do_DeleteID(self, parameter):
+        nack = self._check_id(parameter)
+        if nack:
+            return nack
+        del self.templates[parameter]
+        return response_packet(True)
+
+    def _do_DeleteAll(self, parameter):
+        if not self.templates:
+            return response_packet(False, fps.ErrorCode.NACK_DB_IS_EMPTY)
+        self.templates.clear()
+        return response_packet(True)
+
+    def _find(self, finger):
+        '''
+        Returns: the lowest ID holding the finger, None if not enrolled
+        '''
+        for ID in sorted(self.templates):
+            if finger_of(self.templates[ID]) == finger:
+                return ID
+        return None
+
+    def _verify(self, ID, finger):
+        nack = self._check_id(ID)
+        if nack:
+            return nack
+        if finger is None or finger_of(self.templates[ID]) != finger:
+            return response_packet(False, fps.ErrorCode.NACK_VERIFY_FAILED)
+        return response_packet(True)
+
+    def _identify(self, finger):
+        if not self.templates:
+            return response_packet(False, fps.ErrorCode.NACK_DB_IS_EMPTY)
+        ID = self._find(finger) if finger is not None else None
+        if ID is None:
+            return response_packet(False, fps.ErrorCode.NACK_IDENTIFY_FAILED)
+        return response_packet(True, ID)
+
+    def _do_Verify1_1(self, parameter):
+        return self._verify(parameter, self._captured)
+
+    def _do_Identify1_N(self, parameter):
+        return self._identify(self._captured)
+
+    def _do_CaptureFinger(self, parameter):
+        if not self.led or self.finger is None:
+            self._captured = None
+            return response_packet(False,
+                                   fps.ErrorCode.NACK_FINGER_IS_NOT_PRESSED)
+        self._captured = self.finger
+        return response_packet(True)
+
+    def _do_MakeTemplate(self, parameter):
+        if self._captured is None:
+            return response_packet(False, fps.ErrorCode.NACK_BAD_FINGER)
+        return response_packet(True) + data_packet(
+            template_of(self._captured))
+
+    def _do_GetImage(self, parameter):
+        return response_packet(True) + data_packet(
+            synthetic_image(self._captured, IMAGE_SIZE))
+
+    def _do_GetRawImage(self, parameter):
+        finger = self.finger if self.led else None
+        return response_packet(True) + data_packet(
+            synthetic_image(finger, RAW_SIZE))
+
+    def _do_GetTemplate(self, parameter):
+        nack = self._check_id(parameter)
+        if nack:
+            return nack
+        return response_packet(True) + data_packet(self.templates[parameter])
+
+    def _expect_data(self, name, parameter, nack=None):
+        if nack:
+            return nack
+        self._expect = (name, parameter)
+        return response_packet(True)
+
+    def _do_SetTemplate(self, parameter):
+        nack = None
+        if not 0 <= parameter & 0xFFFF < SLOTS:
+            nack = response_packet(False, fps.ErrorCode.NACK_INVALID_POS)
+        return self._expect_data('SetTemplate', parameter, nack)
+
+    def _do_VerifyTemplate1_1(self, parameter):
+        return self._expect_data('VerifyTemplate1_1', parameter,
+                                 self._check_id(parameter))
+
+    def _do_IdentifyTemplate1_N(self, parameter):
+        nack = None
+        if not self.templates:
+            nack = response_packet(False, fps.ErrorCode.NACK_DB_IS_EMPTY)
+        return self._expect_data('IdentifyTemplate1_N', parameter, nack)
+
+    def _upload(self, name, parameter, packet):
+        '''
+        Finishes a template command once its data packet has arrived
+        '''
+        payload = packet[len(DATA_HEADER):-2]
+        checksum, = struct.unpack('<H', packet[-2:])
+        if (not packet.startswith(DATA_HEADER) or
+                sum(bytearray(packet[:-2])) & 0xFFFF != checksum):
+            return response_packet(False, fps.ErrorCode.NACK_COMM_ERR)
+        finger = finger_of(payload)
+        if name == 'VerifyTemplate1_1':
+            return self._verify(parameter, finger)
+        if name == 'IdentifyTemplate1_N':
+            return self._identify(finger)
+        ID = parameter & 0xFFFF
+        if not parameter & 0x00010000:
+            duplicate = self._find(finger)
+            if duplicate is not None and duplicate != ID:
+                return response_packet(False, duplicate)
+        self.templates[ID] = bytes(payload)
+        return response_packet(True)
+
+    def take_baud_change(self):
+        '''
+        Returns: the baud rate set by the last ChangeBaudrate (applied now),
+                 None if there was none
+        '''
+        baud = self._new_baud
+        if baud is not None:
+            self.baud = baud
+            self._new_baud = None
+        return baud
+
+
+class EmulatedSerial(SerialBase):
+    '''
+        pyserial port connected to an Emulator (gt511://<name> URLs)
+
+        Bytes written reach the emulator after their wire time and replies
+        come back byte by byte at the baud rate of the device, after the
+        latency of the command. Writes at another baud rate than the
+        device's are lost, like garbage on a real line.
+    '''
+
+    def __init__(self, *args, **kwargs):
+        self.emulator = None
+        self._segments = collections.deque()   # [start, bytes, offset, spb]
+        self._tx_free = 0.
+        self._rx_free = 0.
+        self._cond = threading.Condition()
+        super(EmulatedSerial, self).__init__(*args, **kwargs)
+
+    def open(self):
+        if self.is_open:
+            raise SerialException('Port is already open.')
+        if self._port is None:
+            raise SerialException('Port must be configured before use.')
+        name = self._port.split('://', 1)[-1].rstrip('/')
+        self.emulator = EMULATORS.get(name)
+        if self.emulator is None:
+            raise SerialException('No emulator at {}'.format(self._port))
+        self.is_open = True
+        self.reset_input_buffer()
+
+    def close(self):
+        self.is_open = False
+
+    def _reconfigure_port(self):
+        pass
+
+    @property
+    def in_waiting(self):
+        if not self.is_open:
+            raise PortNotOpenError()
+        with self._cond:
+            return self._ready(time.time())
+
+    def reset_input_buffer(self):
+        # Only what has arrived is dropped, replies on their way still come
+        with self._cond:
+            self._take(self._ready(time.time()))
+
+    def reset_output_buffer(self):
+        pass
+
+    def write(self, data):
+        if not self.is_open:
+            raise PortNotOpenError()
+        data = bytes(data)
+        emulator = self.emulator
+        now = time.time()
+        spb = 10.0 / self._baudrate if emulator.timing else 0.
+        arrival = max(now, self._tx_free) + len(data) * spb
+        self._tx_free = arrival
+        if self._baudrate != emulator.baud:
+            return len(data)
+        replies = emulator.feed(data)
+        with self._cond:
+            for latency, reply in replies:
+                start = max(arrival + latency, self._rx_free)
+                spb = emulator.byte_time()
+                self._segments.append([start, reply, 0, spb])
+                self._rx_free = start + len(reply) * spb
+                # A baud change takes effect after its ACK has been sent
+                emulator.take_baud_change()
+            self._cond.notify_all()
+        return len(data)
+
+    def _ready(self, now):
+        '''
+        Returns: the number of bytes that have arrived by now
+        '''
+        ready = 0
+        for start, reply, offset, spb in self._segments:
+            if spb:
+                arrived = min(len(reply), int((now - start) / spb))
+            else:
+                arrived = len(reply) if now >= start else 0
+            ready += max(0, arrived - offset)
+            if arrived < len(reply):
+                break
+        return ready
+
+    def _ready_at(self, count):
+        '''
+        Returns: when count more bytes will have arrived, None if they were
+                 never sent
+        '''
+        for start, reply, offset, spb in self._segments:
+            left = len(reply) - offset
+            if count <= left:
+                return start + (offset + count) * spb
+            count -= left
+        return None
+
+    def read(self, size=1):
+        if not self.is_open:
+            raise PortNotOpenError()
+        deadline = None if self._timeout is None else time.time() + \
+            self._timeout
+        with self._cond:
+            while True:
+                now = time.time()
+                ready = self._ready(now)
+                if ready >= size or (deadline is not None and
+                                     now >= deadline):
+                    break
+                when = self._ready_at(size)
+                if deadline is not None and (when is None or
+                                             when > deadline):
+                    when = deadline
+                self._cond.wait(None if when is None else
+                                max(0, when - now))
+            return self._take(min(size, ready))
+
+    def _take(self, size):
+        out = bytearray()
+        while size and self._segments:
+            segment = self._segments[0]
+            start, reply, offset, spb = segment
+            chunk = reply[offset:offset + size]
+            out += chunk
+            size -= len(chunk)
+            segment[2] += len(chunk)
+            if segment[2] >= len(reply):
+                self._segments.popleft()
+        return bytes(out)
+
+
+# serial.serial_for_url('gt511://...') finds EmulatedSerial as the
+# protocol_gt511 module of this "package"
+__path__ = []
+_handler = types.ModuleType(__name__ + '.protocol_gt511')
+_handler.Serial = EmulatedSerial
+sys.modules[_handler.__name__] = _handler
+if __name__ not in serial.protocol_handler_packages:
+    serial.protocol_handler_packages.append(__name__)
+
+
+class PtyServer(object):
+    '''
+        Serves an Emulator on a pseudo terminal (POSIX only), so any process
+        can open self.port like a real serial port
+        The host's baud rate can't be seen through a pty: the emulator
+        assumes it always matches
+    '''
+
+    def __init__(self, emulator):
+        import pty
+        import tty
+        self.emulator = emulator
+        self._master, self._slave = pty.openpty()
+        tty.setraw(self._slave)
+        tty.setraw(self._master)
+        os.set_blocking(self._master, False)
+        self.port = os.ttyname(self._slave)
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._serve,
+                                        name='fps-emulator-pty')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _serve(self):
+        import select
+        free = 0.
+        while not self._stop.is_set():
+            readable, _, _ = select.select([self._master], [], [], .1)
+            if not readable:
+                continue
+            try:
+                data = os.read(self._master, 4096)
+            except OSError:
+                break
+            arrival = time.time() + len(data) * self.emulator.byte_time()
+            for latency, reply in self.emulator.feed(data):
+                spb = self.emulator.byte_time()
+                start = max(arrival + latency, free)
+                free = start + len(reply) * spb
+                self._send(reply, start, spb)
+                self.emulator.take_baud_change()
+
+    def _send(self, reply, start, spb):
+        '''
+        Writes a reply to the pty in chunks of about 10 ms of wire time, each
+        when its last byte would have arrived; gives up when closed
+        '''
+        import select
+        chunk = max(1, int(.01 / spb)) if spb else len(reply)
+        sent = 0
+        while sent < len(reply) and not self._stop.is_set():
+            end = min(sent + chunk, len(reply))
+            delay = start + end * spb - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            _, writable, _ = select.select([], [self._master], [], .1)
+            if writable:
+                sent += os.write(self._master, reply[sent:end])
+
+    def close(self):
+        self._stop.set()
+        self._thread.join()
+        os.close(self._master)
+        os.close(self._slave)
+
+
+def main(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(
+        description='Serve an emulated GT-511C3 on a pseudo terminal')
+    parser.add_argument('--baud', type=int, default=9600)
+    parser.add_argument('--typical-latency', action='store_true',
+                        help='take as long as a real scanner per command')
+    parser.add_argument('--finger', type=int,
+                        help='keep this finger on the sensor')
+    parser.add_argument('--enrolled', type=int, default=0,
+                        help='fingers 1..N enrolled at IDs 0..N-1')
+    args = parser.parse_args(argv)
+    emulator = Emulator(args.baud, TYPICAL_LATENCY if args.typical_latency
+                        else 0)
+    for ID in range(args.enrolled):
+        emulator.enroll(ID, ID + 1)
+    if args.finger is not None:
+        emulator.press(args.finger)
+    server = PtyServer(emulator)
+    print(server.port)
+    sys.stdout.flush()
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
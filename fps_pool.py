@@ -0,0 +1,138 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+'''
+Several GT-511C3 scanners on one host
+
+ScannerPool probes every serial port in parallel, remembers which ones have
+a scanner and at what baud rate, and hands out connected FPS_GT511C3
+handles. Identification can be fanned out to all scanners at once; each
+scanner runs its part on its own I/O thread (FPS_GT511C3.submit).
+
+SAMPLE CODE:
+
+    pool = ScannerPool()
+    print(pool.discover())          # {'/dev/ttyUSB0': 115200, ...}
+    for port, ID in pool.identify().items():
+        print('{}: {}'.format(port, ID))
+    pool.close()
+'''
+
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import fps
+
+
+def _capture_and_identify(scanner):
+    '''
+    Captures the finger on a scanner (with the LED on only for the capture)
+    and identifies it against its database
+    Returns: 0-199 matching ID, 200 if not found or no finger pressed
+    '''
+    scanner.set_led(True)
+    try:
+        captured = scanner.capture_finger(False)
+    finally:
+        scanner.set_led(False)
+    if not captured:
+        return 200
+    return scanner.identify1_N()
+
+
+class ScannerPool(object):
+    '''
+        Discovers and manages the GT-511C3 scanners connected to the host
+    '''
+
+    def __init__(self, ports=None, bauds=fps.BAUD_RATES, timeout=2,
+                 probe_timeout=.2, baud_cache=fps.BAUD_CACHE):
+        '''
+        Parameter: ports - ports to probe, default all of fps.serial_ports()
+        Parameter: bauds - baud rates to try when probing
+        Parameter: timeout - serial timeout of the connected handles
+        Parameter: probe_timeout - how long to wait for each probe reply
+        Parameter: baud_cache - cache file of the baud rates found (tried
+                   first when probing), None to disable
+        '''
+        self._ports = ports
+        self._bauds = bauds
+        self._timeout = timeout
+        self._probe_timeout = probe_timeout
+        self._baud_cache = baud_cache
+        self._found = None       # port -> baud, None until discovered
+        self._scanners = {}      # port -> connected FPS_GT511C3
+        self._lock = threading.Lock()   # Guards self._scanners
+
+    def discover(self, refresh=False):
+        '''
+        Probes all ports concurrently with the Open command
+        Results are cached; pass refresh to probe again
+        Returns: dict of port -> baud rate for every port with a scanner
+        '''
+        if self._found is not None and not refresh:
+            return dict(self._found)
+        ports = self._ports if self._ports is not None else fps.devices()
+        found = {}
+        if ports:
+            with ThreadPoolExecutor(max_workers=len(ports)) as pool:
+                bauds = pool.map(
+                    lambda port: fps.probe(port, self._bauds,
+                                           self._probe_timeout,
+                                           self._baud_cache), ports)
+                for port, baud in zip(ports, bauds):
+                    if baud is not None:
+                        found[port] = baud
+        self._found = found
+        return dict(found)
+
+    def get(self, port):
+        '''
+        Returns a connected FPS_GT511C3 for a discovered port (one handle per
+        port, shared by all callers)
+        Raises: KeyError if no scanner was found on the port
+        '''
+        with self._lock:
+            scanner = self._scanners.get(port)
+            if scanner is None:
+                baud = self.discover()[port]
+                scanner = fps.FPS_GT511C3(device_name=port, baud=baud,
+                                          timeout=self._timeout)
+                scanner.serial_dbg = False
+                self._scanners[port] = scanner
+            return scanner
+
+    def scanners(self):
+        '''
+        Returns: dict of port -> connected FPS_GT511C3 for every scanner
+        '''
+        return dict((port, self.get(port)) for port in self.discover())
+
+    def identify(self):
+        '''
+        Captures and identifies the finger on every scanner concurrently
+        Returns: dict of port -> 0-199 matching ID, or 200 if not found (or
+                 no finger on that scanner)
+        '''
+        futures = dict((port, scanner.submit(_capture_and_identify, scanner))
+                       for port, scanner in self.scanners().items())
+        return dict((port, f.result()) for port, f in futures.items())
+
+    def identify_template(self, tmplt):
+        '''
+        Looks a template (498 bytes) up in the databases of all scanners
+        concurrently
+        Returns: dict of port -> 0-199 matching ID, or 200 if not found
+        '''
+        futures = dict((port, scanner.submit('identify_template1_N', tmplt))
+                       for port, scanner in self.scanners().items())
+        return dict((port, f.result()) for port, f in futures.items())
+
+    def close(self):
+        '''
+        Closes every handle handed out by the pool
+        '''
+        with self._lock:
+            scanners, self._scanners = self._scanners, {}
+        for scanner in scanners.values():
+            scanner.close()
@@ -0,0 +1,469 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+'''
+Host-side template store for more users than a scanner can hold
+
+The GT-511C3 keeps 200 templates and Identify1_N only searches those. A
+TemplateStore keeps any number of templates on the host, in a memory mapped
+file of fixed size records keyed by a user number. A TemplateIndex spreads
+the users over one or more scanners (user % number of scanners picks the
+scanner of a user) and keeps the most recently used templates of each
+scanner loaded in its 200 slots, uploading with SetTemplate on a miss and
+evicting the least recently used template when the slots are full.
+
+The matching itself is still done by the scanners (VerifyTemplate1_1 and
+IdentifyTemplate1_N); templates are only sent to the scanner that holds (or
+should hold) the candidate user.
+
+SAMPLE CODE:
+
+    store = TemplateStore('users.db')
+    scanner = fps.FPS_GT511C3('/dev/ttyUSB0', baud=115200)
+    index = TemplateIndex(store, [scanner])
+    index.adopt()                            # slots loaded before a restart
+    index.enroll_from(scanner, 1234, ID=0)   # keep template 0 as user 1234
+    ...
+    if scanner.capture_finger(False) and scanner.make_template():
+        user = index.identify(scanner._lastData.Data.tobytes(),
+                              exhaustive=True)
+'''
+
+import collections
+import mmap
+import os
+import struct
+
+import fps
+
+
+class TemplateStore(object):
+    '''
+        File of templates keyed by user number (0 - 0xFFFFFFFE)
+        Little endian layout: a 64 byte header (magic, version, template
+        size, record count) followed by records of the user number and the
+        template. Removed records are marked with user DELETED and reused.
+        The file is memory mapped and grows by doubling.
+    '''
+    MAGIC = b'GT511TS\x00'
+    VERSION = 1
+    HEADER = struct.Struct('<8sHHI')   # magic, version, template size, count
+    HEADER_SIZE = 64
+    KEY = struct.Struct('<I')
+    DELETED = 0xFFFFFFFF
+
+    def __init__(self, path, template_size=fps.FPS_GT511C3.TEMPLATE_SIZE,
+                 capacity=256):
+        '''
+        Opens a store, creating it if the file doesn't exist
+        Parameter: capacity - records to make room for in a new file
+        Raises: ValueError if the file is not a template store
+        '''
+        self.path = path
+        if not os.path.exists(path):
+            with open(path, 'wb') as f:
+                f.write(self.HEADER.pack(self.MAGIC, self.VERSION,
+                                         template_size, 0))
+                f.truncate(self.HEADER_SIZE +
+                           capacity * (self.KEY.size + template_size))
+        self._file = open(path, 'r+b')
+        self._map = mmap.mmap(self._file.fileno(), 0)
+        magic, version, self.TemplateSize, self._count = \
+            self.HEADER.unpack_from(self._map, 0)
+        if magic != self.MAGIC or version != self.VERSION:
+            self.close()
+            raise ValueError('{} is not a template store'.format(path))
+        self._record_size = self.KEY.size + self.TemplateSize
+        self._records = {}      # user -> record number
+        self._free = []         # numbers of DELETED records
+        for n in range(self._count):
+            key, = self.KEY.unpack_from(self._map, self._offset(n))
+            if key == self.DELETED:
+                self._free.append(n)
+            else:
+                self._records[key] = n
+
+    def __len__(self):
+        return len(self._records)
+
+    def __contains__(self, key):
+        return key in self._records
+
+    def keys(self):
+        '''
+        Returns: the user numbers in the store, in record order
+        '''
+        return sorted(self._records, key=self._records.get)
+
+    def get(self, key):
+        '''
+        Returns: the template of a user (bytes)
+        Raises: KeyError if the user is not in the store
+        '''
+        start = self._offset(self._records[key]) + self.KEY.size
+        return self._map[start:start + self.TemplateSize]
+
+    def put(self, key, tmplt):
+        '''
+        Stores (or replaces) the template of a user
+        Raises: ValueError if the template has the wrong size
+        '''
+        if len(tmplt) != self.TemplateSize:
+            raise ValueError('Template must be {} bytes'.format(
+                self.TemplateSize))
+        if not 0 <= key < self.DELETED:
+            raise ValueError('Bad user number {}'.format(key))
+        n = self._records.get(key)
+        if n is None:
+            n = self._free.pop() if self._free else self._append()
+            self._records[key] = n
+        start = self._offset(n)
+        self.KEY.pack_into(self._map, start, key)
+        start += self.KEY.size
+        self._map[start:start + self.TemplateSize] = bytes(tmplt)
+
+    def remove(self, key):
+        '''
+        Removes a user from the store
+        Raises: KeyError if the user is not in the store
+        '''
+        n = self._records.pop(key)
+        self.KEY.pack_into(self._map, self._offset(n), self.DELETED)
+        self._free.append(n)
+
+    def close(self):
+        '''
+        Flushes and closes the file
+        '''
+        if not self._map.closed:
+            self._map.flush()
+            self._map.close()
+        self._file.close()
+
+    def _offset(self, n):
+        return self.HEADER_SIZE + n * self._record_size
+
+    def _append(self):
+        '''
+        Adds a record at the end, growing the file when it is full
+        Returns: the new record number
+        '''
+        n = self._count
+        if self._offset(n + 1) > len(self._map):
+            self._map.resize(self.HEADER_SIZE + 2 * (n + 1) *
+                             self._record_size)
+        self._count += 1
+        self.HEADER.pack_into(self._map, 0, self.MAGIC, self.VERSION,
+                              self.TemplateSize, self._count)
+        return n
+
+
+class SlotCache(object):
+    '''
+        Which users are loaded in the slots of one scanner, least recently
+        used first
+    '''
+
+    def __init__(self, scanner, slots=None):
+        '''
+        Parameter: slots - IDs of the scanner the cache may use, None for
+                   all; IDs that are enrolled already are never overwritten
+                   (unless adopt finds a template of the store in them)
+        Raises: IOError if the enrollment bitmap can't be scanned
+        '''
+        self.scanner = scanner
+        if slots is None:
+            slots = range(fps.Template_Database.SLOTS)
+        self._slots = frozenset(slots)
+        occupancy = scanner.occupancy()
+        self._free = sorted((slot for slot in self._slots
+                             if not occupancy >> slot & 1), reverse=True)
+        self._lru = collections.OrderedDict()    # user -> slot
+        self._users = {}                          # slot -> user
+        self._known = {}    # slot -> user, enrolled outside the cache
+        # Slots the cache has held a user in, no need to ask the scanner
+        # whether they are free before uploading
+        self._owned = set()
+
+    def __contains__(self, key):
+        return key in self._lru
+
+    def __len__(self):
+        return len(self._lru)
+
+    @property
+    def capacity(self):
+        return len(self._lru) + len(self._free)
+
+    def user(self, slot):
+        '''
+        Returns: the user loaded in a slot (or found there by adopt), None if
+                 the slot is not known
+        '''
+        return self._users.get(slot, self._known.get(slot))
+
+    def adopt(self, store):
+        '''
+        Maps the enrolled IDs of the scanner that hold the template of a
+        user of store, downloading each one: those among the slots of the
+        cache (e.g. loaded before a restart) are taken over as loaded, the
+        others are only used to name the user when identify matches them
+        Returns: the number of IDs mapped
+        '''
+        users = dict((store.get(key), key) for key in store.keys())
+        occupancy = self.scanner.occupancy()
+        mapped = 0
+        for slot in range(fps.Template_Database.SLOTS):
+            if not occupancy >> slot & 1 or slot in self._users:
+                continue
+            if self.scanner.get_template(slot) != 0:
+                continue
+            key = users.get(bytes(self.scanner._lastData.Data))
+            if key is None:
+                continue
+            if slot in self._slots and key not in self._lru:
+                self._lru[key] = slot
+                self._users[slot] = key
+                self._owned.add(slot)
+            else:
+                self._known[slot] = key
+            mapped += 1
+        return mapped
+
+    def load(self, key, tmplt):
+        '''
+        Makes sure a user is loaded on the scanner, uploading its template
+        into a free slot (or the least recently used one) on a miss
+        Returns: the slot, None if the upload failed
+        Raises: IOError if the scanner can't tell whether a slot is free
+        '''
+        slot = self._lru.get(key)
+        if slot is not None:
+            self.touch(key)
+            return slot
+        slot = None
+        occupancy = self.scanner.occupancy()
+        while self._free and slot is None:
+            slot = self._free.pop()
+            if occupancy >> slot & 1 or not self._is_free(slot):
+                # Enrolled by someone else since, not ours to overwrite
+                slot = None
+        if slot is None:
+            if not self._lru:
+                return None
+            old, slot = self._lru.popitem(last=False)
+            del self._users[slot]
+            self.scanner.delete_id(slot)
+        if self.scanner.set_template(tmplt, slot,
+                                     duplicate_check=False) != 200:
+            self._free.append(slot)
+            return None
+        self._lru[key] = slot
+        self._users[slot] = key
+        self._owned.add(slot)
+        return slot
+
+    def _is_free(self, slot):
+        '''
+        Asks the scanner whether a slot the cache never held a user in is
+        still free, before the first upload into it
+        Raises: IOError if CheckEnrolled fails other than with
+                NACK_IS_NOT_USED (the slot goes back to the free list)
+        '''
+        if slot in self._owned:
+            return True
+        rp = self.scanner.run_batch([('CheckEnrolled', slot)])[0].response
+        if rp.ACK:
+            return False
+        if rp.Error != fps.ErrorCode.NACK_IS_NOT_USED:
+            self._free.append(slot)
+            raise IOError('CheckEnrolled {} failed on {}: {}'.format(
+                slot, self.scanner._device_name, rp.Error.name))
+        return True
+
+    def touch(self, key):
+        '''
+        Marks a loaded user as the most recently used
+        '''
+        self._lru.move_to_end(key)
+
+    def forget(self, key):
+        '''
+        Drops a user from the cache, deleting its template from the slot
+        '''
+        for slot in [s for s, k in self._known.items() if k == key]:
+            del self._known[slot]
+        slot = self._lru.pop(key, None)
+        if slot is not None:
+            del self._users[slot]
+            self.scanner.delete_id(slot)
+            self._free.append(slot)
+
+    def claim(self, key, slot, loaded=True):
+        '''
+        Maps an ID a user was just enrolled into on the scanner, instead of
+        leaving the template there unknown: as the slot the user is loaded
+        in if loaded and the ID is one of the cache's, else only to name the
+        user when identify matches it
+        A stale copy of the user elsewhere is deleted
+        '''
+        if self._lru.get(key) == slot:
+            self.touch(key)
+            return
+        self.forget(key)
+        if self.user(slot) is not None:
+            # Enrolled from the slot of a user, which stays that user's
+            return
+        if slot in self._free:
+            self._free.remove(slot)
+        if loaded and slot in self._slots:
+            self._lru[key] = slot
+            self._users[slot] = key
+            self._owned.add(slot)
+        else:
+            self._known[slot] = key
+
+
+class TemplateIndex(object):
+    '''
+        Routes verification and identification of the users of a
+        TemplateStore to the scanners that hold their templates
+    '''
+
+    def __init__(self, store, scanners, slots=None):
+        '''
+        Parameter: store - TemplateStore with the templates of every user
+        Parameter: scanners - list of connected FPS_GT511C3
+        Parameter: slots - IDs of each scanner the index may use, None for
+                   all (see SlotCache)
+        '''
+        self.store = store
+        self._caches = [SlotCache(scanner, slots) for scanner in scanners]
+
+    def adopt(self):
+        '''
+        Maps the templates of the store already enrolled on the scanners
+        (see SlotCache.adopt), so they are not uploaded again
+        Returns: the number of IDs mapped
+        '''
+        return sum(cache.adopt(self.store) for cache in self._caches)
+
+    def cache(self, key):
+        '''
+        Returns: the SlotCache of the scanner a user belongs to
+        '''
+        return self._caches[key % len(self._caches)]
+
+    def enroll_from(self, scanner, key, ID=None):
+        '''
+        Adds a user to the store from a scanner: the template of ID, or if
+        ID is None a template made from the finger just captured
+        An ID on a scanner of the index is kept as the user's (see
+        SlotCache.claim), loaded if it is on the user's own scanner
+        Returns: True if the template was downloaded and stored
+        '''
+        if ID is None:
+            ok = scanner.make_template()
+        else:
+            ok = scanner.get_template(ID) == 0
+        if ok:
+            self.store.put(key, scanner._lastData.Data)
+            home = self.cache(key)
+            for cache in self._caches:
+                if ID is not None and cache.scanner is scanner:
+                    cache.claim(key, ID, loaded=cache is home)
+                else:
+                    # Templates loaded from the old store entry are stale
+                    cache.forget(key)
+        return ok
+
+    def remove(self, key):
+        '''
+        Removes a user from the store and the slot caches
+        '''
+        self.store.remove(key)
+        self.cache(key).forget(key)
+
+    def verify(self, key, tmplt):
+        '''
+        Checks a template against a user, on the scanner that user belongs to
+        Returns: the FPS_GT511C3.verify_template1_1 codes (0 verified OK,
+                 3 not the user, 4 communications or upload error)
+        Raises: KeyError if the user is not in the store
+        '''
+        cache = self.cache(key)
+        slot = cache.load(key, self.store.get(key))
+        if slot is None:
+            return 4
+        return cache.scanner.verify_template1_1(tmplt, slot)
+
+    def identify(self, tmplt, candidates=None, exhaustive=False):
+        '''
+        Looks a template up among the users
+        Parameter: candidates - users to load before searching (e.g. picked
+                   by a badge), None to search what is already loaded
+        Parameter: exhaustive - if nothing matched, page every other user of
+                   the store through the scanners and search again
+        Returns: the matching user, None if not found
+        '''
+        searched = set()
+        if candidates is not None:
+            for key in candidates:
+                self.cache(key).load(key, self.store.get(key))
+        caches = [c for c in self._caches if len(c)]
+        key = self._identify_on(caches, tmplt)
+        if key is not None or not exhaustive:
+            return key
+        for cache in self._caches:
+            searched.update(cache._lru)
+        # Users of a scanner without slots for the cache can't be searched
+        pending = [k for k in self.store.keys()
+                   if k not in searched and self.cache(k).capacity]
+        while pending:
+            # Fill every scanner with the next users it hasn't searched
+            loaded = []
+            for cache in self._caches:
+                mine = [k for k in pending if self.cache(k) is cache]
+                mine = mine[:cache.capacity]
+                for k in mine:
+                    cache.load(k, self.store.get(k))
+                searched.update(mine)
+                if mine:
+                    loaded.append(cache)
+            pending = [k for k in pending if k not in searched]
+            key = self._identify_on(loaded, tmplt)
+            if key is not None:
+                return key
+        return None
+
+    def _identify_on(self, caches, tmplt):
+        '''
+        Runs IdentifyTemplate1_N on the scanners of some caches concurrently
+        Returns: the first matching user, None if not found
+        '''
+        futures = [(cache, cache.scanner.submit('identify_template1_N', tmplt))
+                   for cache in caches]
+        found = None
+        for cache, future in futures:
+            slot = future.result()
+            if found is not None or slot >= fps.Template_Database.SLOTS:
+                continue
+            found = cache.user(slot)
+            if found is None:
+                # The best match is an ID enrolled outside the store, which
+                # may hide a match among the users loaded on this scanner
+                found = self._verify_on(cache, tmplt)
+            if found in cache:
+                cache.touch(found)
+        return found
+
+    def _verify_on(self, cache, tmplt):
+        '''
+        Checks a template against every user loaded on the scanner of a
+        cache, one VerifyTemplate1_1 each
+        Returns: the matching user, None if not found
+        '''
+        for key, slot in list(cache._lru.items()):
+            if cache.scanner.verify_template1_1(tmplt, slot) == 0:
+                return key
+        return None
@@ -0,0 +1,367 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+'''
+Records the serial traffic of a scanner and replays it without the hardware
+
+Recording uses the capture files of fps.WireTrace: every write and read of
+FPS_GT511C3 with its monotonic timestamp. Replaying serves such a file as a
+serial port (replay://<path> URLs, registered by this module with pyserial):
+writes of the driver are checked against the recorded ones and reads get
+the recorded bytes, either as fast as possible or at the original pace
+(every read chunk comes as long after the write before it as it did when
+recorded). Since the driver sends Open when it connects, record from the
+start (FPS_GT511C3(..., wire=...)) and without auto_baud.
+
+replay_commands runs the commands of a trace through get_response again,
+which regression tests the framing (including the multi-packet image
+downloads) and benchmarks the parsing against real captures.
+
+SAMPLE CODE:
+
+    with fps_trace.record('field.trace') as wire:
+        scanner = fps.FPS_GT511C3('/dev/ttyUSB0', 115200, wire=wire)
+        scanner.set_led(True)
+        scanner.get_raw_image()
+
+    scanner = fps.FPS_GT511C3('replay://field.trace?pace=original', 115200)
+    scanner.set_led(True)
+    scanner.get_raw_image()                 # the recorded image
+
+    python fps_trace.py show field.trace
+    python fps_trace.py replay field.trace --pace original
+'''
+
+import argparse
+import collections
+import contextlib
+import struct
+import sys
+import time
+import types
+from urllib.parse import urlparse, parse_qs
+
+import serial
+from serial.serialutil import SerialBase, SerialException, PortNotOpenError
+
+import fps
+
+WRITE = fps.WireTrace.WRITE
+READ = fps.WireTrace.READ
+COMMAND = struct.Struct('<BBHIHH')
+COMMAND_NAMES = dict((code, name) for name, code in
+                     fps.Command_Packet.commands.items())
+
+
+class ReplayError(SerialException):
+    '''
+        The driver wrote something else than the trace recorded
+    '''
+
+
+@contextlib.contextmanager
+def record(path, size=256):
+    '''
+    Returns a WireTrace writing to path, closed when the with block exits;
+    pass it as the wire of FPS_GT511C3
+    '''
+    wire = fps.WireTrace(size, path)
+    try:
+        yield wire
+    finally:
+        wire.close()
+
+
+def load(path):
+    '''
+    Returns: the chunks of a trace as a list of (timestamp, direction,
+             bytes), consecutive chunks of one direction merged (keeping the
+             timestamp of the last)
+    '''
+    chunks = []
+    for timestamp, direction, data in fps.WireTrace.read(path):
+        if chunks and chunks[-1][1] == direction:
+            chunks[-1] = (timestamp, direction, chunks[-1][2] + data)
+        else:
+            chunks.append((timestamp, direction, data))
+    return chunks
+
+
+def describe(data, direction):
+    '''
+    Returns: a short description of the packets in a chunk
+    '''
+    if not data:
+        return 'nothing (timeout)'
+    parts = []
+    offset = 0
+    while offset < len(data):
+        rest = data[offset:]
+        if rest[:2] == b'\x55\xaa' and len(rest) >= COMMAND.size:
+            _, _, _, parameter, code, _ = COMMAND.unpack_from(rest)
+            if direction == WRITE:
+                name = COMMAND_NAMES.get(code, hex(code))
+                parts.append('{}({})'.format(name, parameter))
+            else:
+                rp = fps.Response_Packet(rest[:COMMAND.size])
+                parts.append('ACK({})'.format(parameter) if rp.ACK else
+                             'NACK({})'.format(rp.Error.name))
+            offset += COMMAND.size
+        elif rest[:2] == b'\x5a\xa5':
+            parts.append('data({} bytes)'.format(len(rest) - 6))
+            break
+        else:
+            parts.append('{} bytes'.format(len(rest)))
+            break
+    return ' '.join(parts)
+
+
+class ReplaySerial(SerialBase):
+    '''
+        pyserial port playing back a trace (replay://<path> URLs)
+
+        URL options: pace=original (default fast) to time the reads like the
+        recording, speed=<factor> to scale that, strict=0 to go on past
+        writes that differ from the recording
+    '''
+
+    def __init__(self, *args, **kwargs):
+        self.chunks = []
+        self.position = 0           # next chunk
+        self.offset = 0             # bytes of it already consumed
+        self.pace = False
+        self.speed = 1.
+        self.strict = True
+        self._anchor = None         # (trace time, wall time) of last write
+        super(ReplaySerial, self).__init__(*args, **kwargs)
+
+    def open(self):
+        if self.is_open:
+            raise SerialException('Port is already open.')
+        if self._port is None:
+            raise SerialException('Port must be configured before use.')
+        url = urlparse(self._port)
+        path = url.netloc + url.path
+        options = parse_qs(url.query)
+        self.pace = options.get('pace', ['fast'])[0] == 'original'
+        self.speed = float(options.get('speed', ['1'])[0])
+        self.strict = options.get('strict', ['1'])[0] not in ('0', 'false')
+        try:
+            self.chunks = load(path)
+        except (IOError, OSError, ValueError) as e:
+            raise SerialException('Cannot replay {}: {}'.format(path, e))
+        self.position = self.offset = 0
+        self.is_open = True
+
+    def close(self):
+        self.is_open = False
+
+    def _reconfigure_port(self):
+        pass
+
+    @property
+    def done(self):
+        '''
+        True once every recorded chunk has been replayed
+        '''
+        return self.position >= len(self.chunks)
+
+    @property
+    def in_waiting(self):
+        if not self.is_open:
+            raise PortNotOpenError()
+        waiting = 0
+        position, offset = self.position, self.offset
+        while position < len(self.chunks):
+            timestamp, direction, data = self.chunks[position]
+            if direction != READ or self._due(timestamp) > time.time():
+                break
+            waiting += len(data) - offset
+            position, offset = position + 1, 0
+        return waiting
+
+    def reset_input_buffer(self):
+        pass
+
+    def reset_output_buffer(self):
+        pass
+
+    def _due(self, timestamp):
+        '''
+        Returns: when a chunk recorded at timestamp is to be read
+        '''
+        if not self.pace or self._anchor is None:
+            return 0
+        trace, wall = self._anchor
+        return wall + (timestamp - trace) / self.speed
+
+    def write(self, data):
+        if not self.is_open:
+            raise PortNotOpenError()
+        data = bytes(data)
+        # Recorded replies the driver never read are dropped
+        while (self.position < len(self.chunks) and
+               self.chunks[self.position][1] == READ):
+            self.position, self.offset = self.position + 1, 0
+        expected = bytearray()
+        last = None
+        while len(expected) < len(data) and self.position < len(self.chunks):
+            timestamp, direction, chunk = self.chunks[self.position]
+            if direction != WRITE:
+                break
+            wanted = len(data) - len(expected)
+            expected += chunk[self.offset:self.offset + wanted]
+            self.offset += wanted
+            last = timestamp
+            if self.offset >= len(chunk):
+                self.position, self.offset = self.position + 1, 0
+        if bytes(expected) != data and self.strict:
+            raise ReplayError('Write {} differs from the trace ({}) at chunk '
+                              '{}'.format(describe(data, WRITE),
+                                          describe(bytes(expected), WRITE),
+                                          self.position))
+        if last is not None:
+            self._anchor = (last, time.time())
+        return len(data)
+
+    def read(self, size=1):
+        if not self.is_open:
+            raise PortNotOpenError()
+        out = bytearray()
+        while len(out) < size and self.position < len(self.chunks):
+            timestamp, direction, chunk = self.chunks[self.position]
+            if direction != READ:
+                break
+            delay = self._due(timestamp) - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            part = chunk[self.offset:self.offset + size - len(out)]
+            out += part
+            self.offset += len(part)
+            if self.offset >= len(chunk):
+                self.position, self.offset = self.position + 1, 0
+        return bytes(out)
+
+
+# serial.serial_for_url('replay://...') finds ReplaySerial as the
+# protocol_replay module of this "package"
+__path__ = []
+_handler = types.ModuleType(__name__ + '.protocol_replay')
+_handler.Serial = ReplaySerial
+sys.modules[_handler.__name__] = _handler
+if __name__ not in serial.protocol_handler_packages:
+    serial.protocol_handler_packages.append(__name__)
+
+
+def packets(data):
+    '''
+    Splits the bytes of a write chunk into the packets the driver sent:
+    12 byte commands and template data packets
+    Raises: ReplayError on anything else
+    '''
+    data_size = (fps.Data_Packet.HEADER_SIZE + fps.FPS_GT511C3.TEMPLATE_SIZE +
+                 fps.Data_Packet.CHECKSUM_SIZE)
+    offset = 0
+    while offset < len(data):
+        start = data[offset:offset + 2]
+        if start == b'\x55\xaa':
+            size = COMMAND.size
+        elif start == b'\x5a\xa5':
+            size = data_size
+        else:
+            raise ReplayError('Unknown packet in a write: {}'.format(
+                fps._Hex(data[offset:offset + 12])))
+        yield data[offset:offset + size]
+        offset += size
+
+
+def replay_commands(path, pace=False, speed=1., baud=9600):
+    '''
+    Sends the commands of a trace again through FPS_GT511C3 in the order
+    they were recorded (batches included), reading every response and data
+    packet with get_response
+    Returns: (list of fps.Batch_Result, seconds taken), the first result is
+             the Open sent when connecting
+    Raises: ReplayError if the driver's writes differ from the trace
+    '''
+    url = 'replay://{}{}'.format(path, '?pace=original&speed={}'.format(
+        speed) if pace else '')
+    start = time.time()
+    scanner = fps.FPS_GT511C3(url, baud)
+    port = scanner._serial
+    if port is None:
+        raise SerialException('Cannot replay {}'.format(path))
+    results = [fps.Batch_Result('Open', scanner._lastResponse,
+                                scanner._lastData)]
+    pending = collections.deque()   # (command, data length) to read
+    command = None
+    while not port.done:
+        index = port.position
+        timestamp, direction, data = port.chunks[index]
+        if direction == WRITE:
+            for packet in packets(data[port.offset:]):
+                if packet[:2] == b'\x5a\xa5':
+                    # Template upload after the ACK of its command
+                    scanner.send_command(packet, len(packet))
+                    pending.append((command, 0))
+                    continue
+                _, _, _, parameter, code, _ = COMMAND.unpack_from(packet)
+                command = COMMAND_NAMES.get(code)
+                scanner._command(command, parameter)
+                pending.append((command,
+                                scanner._data_length(command, parameter)))
+            continue
+        while pending and port.position == index:
+            command, data_length = pending.popleft()
+            rp = scanner.get_response(data_length)
+            results.append(fps.Batch_Result(
+                command, rp,
+                scanner._lastData if rp.ACK and data_length else None))
+        if port.position == index:
+            # Bytes the driver never asked for
+            port.position, port.offset = index + 1, 0
+    port.close()
+    return results, time.time() - start
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Show or replay GT-511C3 wire traces')
+    commands = parser.add_subparsers(dest='command')
+    show = commands.add_parser('show', help='list the chunks of a trace')
+    show.add_argument('trace')
+    show.add_argument('--hex', action='store_true', help='dump the bytes')
+    replay = commands.add_parser(
+        'replay', help='send the commands of a trace again through the driver')
+    replay.add_argument('trace')
+    replay.add_argument('--pace', choices=('fast', 'original'),
+                        default='fast')
+    replay.add_argument('--speed', type=float, default=1.)
+    args = parser.parse_args(argv)
+
+    if args.command == 'show':
+        chunks = load(args.trace)
+        start = chunks[0][0] if chunks else 0
+        for timestamp, direction, data in chunks:
+            print('{:10.6f} {} {}'.format(
+                timestamp - start, '>' if direction == WRITE else '<',
+                fps._Hex(data) if args.hex else describe(data, direction)))
+        return 0
+    if args.command == 'replay':
+        results, seconds = replay_commands(args.trace,
+                                           args.pace == 'original',
+                                           args.speed)
+        for result in results:
+            print('{} {}{}'.format(
+                result.command, 'ACK' if result.response.ACK else 'NACK ' +
+                result.response.Error.name,
+                ' +{} bytes'.format(len(result.data.Data))
+                if result.data is not None else ''))
+        print('{} commands in {:.3f} s'.format(len(results), seconds))
+        return 0
+    parser.print_help()
+    return 2
+
+
+if __name__ == '__main__':
+    sys.exit(main())
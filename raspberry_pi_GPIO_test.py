@@ -26,24 +26,18 @@ This may be works fine, if don't, try to change the fingerprint baud rate with b
 
 
 '''
-import FPS, sys
+import logging
+import fps
 
 if __name__ == '__main__':
-    fps =  FPS.FPS_GT511C3(device_name='/dev/ttyAMA0',baud=9600,timeout=2,is_com=False)
-    fps.UseSerialDebug = True
-    fps.SetLED(True) # Turns ON the CMOS LED
-    FPS.delay(1) # wait 1 second
-    print 'Put your finger in the scan'
-    counter = 0 # simple counter for wait 10 seconds
-    while counter < 10:
-        if fps.IsPressFinger():  #verify if the finger is in the scan
-            print 'Your finger is in the scan'
-            fps.SetLED(False) # Turns OFF the CMOS LED
-            break
-        else:
-            FPS.delay(1) #wait 1 second
-            counter = counter + 1
-    
-    fps.Close() # Closes serial connection
-    pass
-
+    logging.basicConfig(level=logging.DEBUG) # shows the packets of serial_dbg
+    scanner = fps.FPS_GT511C3(device_name='/dev/ttyAMA0', baud=9600, timeout=2)
+    scanner.serial_dbg = True
+    scanner.set_led(True) # Turns ON the CMOS LED
+    print('Put your finger in the scan')
+    # waits up to 10 seconds, polling fast enough to react within 100 ms
+    if scanner.wait_finger(True, timeout=10):  #verify if the finger is in the scan
+        print('Your finger is in the scan')
+    scanner.set_led(False) # Turns OFF the CMOS LED
+
+    scanner.close() # Closes serial connection
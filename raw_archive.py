@@ -0,0 +1,252 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+'''
+Append-only archive of fingerprint captures
+
+One file holds any number of images of one size: GetRawImage (160x120) or
+GetImage (258x202). Little endian layout: a 64 byte header (magic, version,
+width, height, number of frames, capacity), the index table (one 32 byte
+entry per frame: timestamp, device, ID, quality, room for capacity entries)
+and, from the next page boundary on, the frame block: the frames back to
+back, so that all of them form one C-contiguous array.
+
+Readers memory map the file, and frames and index come out as NumPy views
+into the map, so nothing is copied or decoded. Frames are only ever
+appended; the frame count in the header is updated after the frame and its
+entry are written, so a reader never sees a partial frame. When the index
+table is full the archive is rewritten with twice the capacity into a new
+file that replaces the old one (readers still mapping the old one are not
+disturbed, refresh moves them over).
+
+SAMPLE CODE:
+
+    archive = CaptureArchive('captures.gta', 'a')
+    scanner.archive = archive               # downloads are added as they come
+    scanner.get_raw_image()
+    archive.append(raw, device='/dev/ttyUSB0', ID=7)   # or by hand
+
+    archive = CaptureArchive('captures.gta')
+    for frame, entry in zip(archive.frames, archive.index):
+        print(entry['timestamp'], entry['id'], frame.mean())
+'''
+
+import mmap
+import os
+import struct
+import time
+
+import numpy as np
+
+RAW_SIZE = (160, 120)       # GetRawImage
+IMAGE_SIZE = (258, 202)     # GetImage
+
+ENTRY = np.dtype([('timestamp', '<f8'),     # time.time() of the capture
+                  ('device', 'S16'),        # port name, truncated
+                  ('id', '<i2'),            # enrolled ID, -1 if unknown
+                  ('reserved', '<u2'),
+                  ('quality', '<f4')])      # NaN if not rated
+
+
+class CaptureArchive(object):
+    '''
+        Memory mapped capture archive
+    '''
+    MAGIC = b'GT511RA\x00'
+    VERSION = 2
+    # Magic, version, width, height, count, capacity
+    HEADER = struct.Struct('<8sHHHII')
+    HEADER_SIZE = 64
+    COUNT = struct.Struct('<I')
+    COUNT_OFFSET = 14
+    PAGE = 4096             # The frame block starts on a page boundary
+
+    def __init__(self, path, mode='r', size=RAW_SIZE, capacity=256):
+        '''
+        Opens an archive
+        Parameter: mode - 'r' to read, 'a' to append (creating the file if
+                   it doesn't exist)
+        Parameter: size - (width, height) of the frames of a new archive
+        Parameter: capacity - index entries to make room for in a new
+                   archive (it grows when they are used up)
+        Raises: ValueError if the file is not a capture archive
+        '''
+        self.path = path
+        self._writable = mode == 'a'
+        self._map = None
+        if self._writable and not os.path.exists(path):
+            self._create(path, size, max(1, capacity), 0)
+        self._open()
+
+    def __len__(self):
+        return self._count
+
+    def __getitem__(self, n):
+        '''
+        Returns: frame n as a (height, width) uint8 view
+        '''
+        return self.frames[n]
+
+    def entry(self, n):
+        '''
+        Returns: the index entry of frame n (numpy record)
+        '''
+        return self.index[n]
+
+    def refresh(self):
+        '''
+        Picks up frames appended (by another process) since the archive was
+        opened
+        '''
+        if os.stat(self.path).st_ino != os.fstat(self._file.fileno()).st_ino:
+            # Grown by the writer: the file was replaced
+            self._file.close()
+            self._open()
+            return
+        # Past the buffering of self._file, which may hold the old header
+        fd = self._file.fileno()
+        os.lseek(fd, self.COUNT_OFFSET, os.SEEK_SET)
+        self._count, = self.COUNT.unpack(os.read(fd, self.COUNT.size))
+        self._remap()
+
+    def append(self, frame, device='', ID=-1, quality=float('nan'),
+               timestamp=None):
+        '''
+        Adds a frame at the end of the archive
+        Parameter: frame - frame_size bytes (bytes, memoryview, array, ...)
+        Returns: the number of the new frame
+        Raises: ValueError if the frame has the wrong size
+        '''
+        if not self._writable:
+            raise IOError('{} is open for reading'.format(self.path))
+        data = memoryview(frame).cast('B') if not isinstance(
+            frame, np.ndarray) else np.ascontiguousarray(frame).reshape(-1)
+        if len(data) != self.frame_size:
+            raise ValueError('Frame must be {} bytes'.format(self.frame_size))
+        if self._count == self.capacity:
+            self._grow()
+        entry = np.zeros(1, ENTRY)
+        entry['timestamp'] = time.time() if timestamp is None else timestamp
+        entry['device'] = device.encode('ascii', 'replace')[:16]
+        entry['id'] = ID
+        entry['quality'] = quality
+        self._file.seek(self.HEADER_SIZE + self._count * ENTRY.itemsize)
+        self._file.write(entry.tobytes())
+        self._file.seek(self._frames_offset + self._count * self.frame_size)
+        self._file.write(data)
+        self._file.flush()
+        # The count is written last: until then readers don't see the frame
+        self._count += 1
+        self._file.seek(self.COUNT_OFFSET)
+        self._file.write(self.COUNT.pack(self._count))
+        self._file.flush()
+        self._map_stale = True
+        return self._count - 1
+
+    @property
+    def frames(self):
+        '''
+        All frames as a C-contiguous (count, height, width) uint8 view into
+        the file
+        '''
+        self._fresh()
+        return self._frames
+
+    @property
+    def index(self):
+        '''
+        All index entries as a structured array view (see ENTRY)
+        '''
+        self._fresh()
+        return self._index
+
+    def close(self):
+        '''
+        Closes the archive (frames and index handed out become invalid)
+        '''
+        # The map itself goes away with the last view into it
+        self._frames = self._index = self._map = None
+        self._file.close()
+
+    @classmethod
+    def _frames_at(cls, capacity):
+        '''
+        Returns: the offset of the frame block after an index of capacity
+                 entries
+        '''
+        end = cls.HEADER_SIZE + capacity * ENTRY.itemsize
+        return -(-end // cls.PAGE) * cls.PAGE
+
+    def _create(self, path, size, capacity, count):
+        '''
+        Writes the header of an archive with room for capacity entries
+        '''
+        with open(path, 'wb') as f:
+            f.write(self.HEADER.pack(self.MAGIC, self.VERSION, size[0],
+                                     size[1], count, capacity)
+                    .ljust(self.HEADER_SIZE, b'\x00'))
+            f.truncate(self._frames_at(capacity))
+
+    def _open(self):
+        '''
+        Opens the file and reads its header
+        '''
+        self._file = open(self.path, 'r+b' if self._writable else 'rb')
+        header = self._file.read(self.HEADER_SIZE)
+        if len(header) < self.HEADER_SIZE:
+            header = b''
+        magic, version, width, height, count, capacity = (
+            self.HEADER.unpack_from(header) if header else (None,) * 6)
+        if magic != self.MAGIC or version != self.VERSION:
+            self._file.close()
+            raise ValueError('{} is not a capture archive'.format(
+                self.path))
+        self.size = (width, height)
+        self.frame_size = width * height
+        self.capacity = capacity
+        self._frames_offset = self._frames_at(capacity)
+        self._count = count
+        self._remap()
+
+    def _grow(self):
+        '''
+        Rewrites the archive with twice the capacity and swaps it in
+        '''
+        tmp = '{}.{}.tmp'.format(self.path, os.getpid())
+        self._create(tmp, self.size, 2 * self.capacity, self._count)
+        index, frames = self.index, self.frames
+        with open(tmp, 'r+b') as f:
+            f.seek(self.HEADER_SIZE)
+            f.write(index.tobytes())
+            f.seek(self._frames_at(2 * self.capacity))
+            for frame in frames:
+                f.write(frame.data)
+        del index, frames
+        self._frames = self._index = self._map = None
+        self._file.close()
+        os.replace(tmp, self.path)
+        self._open()
+
+    def _fresh(self):
+        if self._map_stale:
+            self._remap()
+
+    def _remap(self):
+        '''
+        Maps the file up to the last complete frame and rebuilds the views
+        '''
+        self._map_stale = False
+        # Views handed out keep the old map alive
+        self._frames = self._index = self._map = None
+        width, height = self.size
+        if not self._count:
+            self._frames = np.zeros((0, height, width), np.uint8)
+            self._index = np.zeros(0, ENTRY)
+            return
+        end = self._frames_offset + self._count * self.frame_size
+        self._map = mmap.mmap(self._file.fileno(), end,
+                              access=mmap.ACCESS_READ)
+        self._index = np.ndarray((self._count,), ENTRY, self._map,
+                                 self.HEADER_SIZE)
+        self._frames = np.ndarray((self._count, height, width), np.uint8,
+                                  self._map, self._frames_offset)
@@ -0,0 +1,190 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+'''
+Reprocesses archived raw captures on every core
+
+Runs raw_pipeline.process and the bifurcation count of every capture (and
+matchBif against a reference, if given) in a process pool, writing one
+row per capture to CSV or JSON Lines. Rows come out in input order (sorted
+file names) however the work is spread, and progress goes to stderr.
+
+Captures are raw 160x120 images as returned by get_raw_image, either one
+per .raw file (19200 bytes) in a directory or the frames of a
+raw_archive.CaptureArchive.
+
+SAMPLE CODE:
+
+    python raw_batch.py captures/ -r fingerprint7.raw.binar.bmp -o out.csv
+    python raw_batch.py captures.gta -r fingerprint7.raw.binar.bmp -o out.csv
+    python raw_batch.py captures/ --format jsonl -j 4 > out.jsonl
+'''
+
+import argparse
+import csv
+import json
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+import raw_archive
+import raw_pipeline
+
+RAW_IMAGE_SIZE = raw_pipeline.RAW_SIZE[0] * raw_pipeline.RAW_SIZE[1]
+FIELDS = ('capture', 'bifurcations', 'other', 'match', 'delta', 'error')
+
+_reference = None       # (binary, (bifurcations, other)) in every worker
+_archives = {}          # path -> CaptureArchive opened by a worker
+
+
+def _init_worker(reference):
+    global _reference
+    if reference is not None:
+        _reference = (reference, raw_pipeline.count_bifurcations(reference))
+
+
+def _process(capture):
+    '''
+    Reads and processes one capture in a worker
+    Parameter: capture - path of a .raw file, or (archive path, frame)
+    Returns: row (dict) of FIELDS
+    '''
+    row = dict.fromkeys(FIELDS)
+    if isinstance(capture, tuple):
+        path, n = capture
+        archive = _archives.get(path)
+        if archive is None:
+            archive = _archives[path] = raw_archive.CaptureArchive(path)
+        raw = archive[n].reshape(-1)
+        row['capture'] = '{}#{}'.format(os.path.basename(path), n)
+    else:
+        with open(capture, 'rb') as f:
+            raw = f.read()
+        row['capture'] = os.path.basename(capture)
+    if len(raw) != RAW_IMAGE_SIZE:
+        row['error'] = 'not a raw image ({} bytes)'.format(len(raw))
+        return row
+    binary = raw_pipeline.process(raw)
+    row['bifurcations'], row['other'] = raw_pipeline.count_bifurcations(binary)
+    if _reference is not None:
+        reference, counts = _reference
+        row['match'] = raw_pipeline.match_bif(binary, reference)
+        row['delta'] = row['bifurcations'] - counts[0]
+    return row
+
+
+def list_captures(path):
+    '''
+    Returns: the paths of the .raw files of a directory, sorted by name, or
+             (path, frame) for every frame of a capture archive
+    '''
+    if not os.path.isdir(path):
+        archive = raw_archive.CaptureArchive(path)
+        count = len(archive)
+        archive.close()
+        return [(path, n) for n in range(count)]
+    return [os.path.join(path, name) for name in sorted(os.listdir(path))
+            if name.endswith('.raw')]
+
+
+def load_reference(path):
+    '''
+    Returns the binarized reference image from a raw capture or from an
+    image saved by test_raw / raw_pipeline.save_binary
+    '''
+    if path.endswith('.raw'):
+        with open(path, 'rb') as f:
+            return raw_pipeline.process(f.read())
+    binary = raw_pipeline.load_binary(path)
+    if binary is None:
+        raise IOError('Cannot read reference {}'.format(path))
+    return binary
+
+
+class _Writer(object):
+    '''
+        Writes rows as CSV (with a header) or JSON Lines
+    '''
+
+    def __init__(self, out, fmt):
+        self._out = out
+        self._csv = None
+        if fmt == 'csv':
+            self._csv = csv.DictWriter(out, FIELDS)
+            self._csv.writeheader()
+
+    def write(self, row):
+        if self._csv is not None:
+            self._csv.writerow(row)
+        else:
+            self._out.write(json.dumps(row) + '\n')
+
+
+def run(captures, out, fmt='csv', reference=None, jobs=None, chunksize=16,
+        progress=None):
+    '''
+    Processes captures in a process pool and writes their rows in order
+    Parameter: captures - from list_captures (read by the workers)
+    Parameter: out - text file to write to
+    Parameter: fmt - 'csv' or 'jsonl'
+    Parameter: reference - binarized image to match every capture against
+    Parameter: jobs - worker processes, default one per core
+    Parameter: progress - called with the number of rows written so far
+    Returns: the number of rows written
+    '''
+    writer = _Writer(out, fmt)
+    done = 0
+    with ProcessPoolExecutor(jobs, initializer=_init_worker,
+                             initargs=(reference,)) as pool:
+        for row in pool.map(_process, captures, chunksize=chunksize):
+            writer.write(row)
+            done += 1
+            if progress is not None:
+                progress(done)
+    return done
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Reprocess raw fingerprint captures in parallel')
+    parser.add_argument('input',
+                        help='directory of .raw captures or capture archive')
+    parser.add_argument('-r', '--reference',
+                        help='.raw capture or .binar.bmp to match against')
+    parser.add_argument('-o', '--output', help='output file (default stdout)')
+    parser.add_argument('--format', choices=('csv', 'jsonl'),
+                        help='output format (default from the output '
+                             'extension, else csv)')
+    parser.add_argument('-j', '--jobs', type=int,
+                        help='worker processes (default one per core)')
+    parser.add_argument('-q', '--quiet', action='store_true',
+                        help='no progress on stderr')
+    args = parser.parse_args(argv)
+
+    fmt = args.format
+    if fmt is None:
+        fmt = ('jsonl' if args.output and
+               args.output.endswith(('.jsonl', '.json')) else 'csv')
+    reference = load_reference(args.reference) if args.reference else None
+    captures = list_captures(args.input)
+    total = len(captures)
+
+    def progress(done):
+        if done == total or done % 50 == 0:
+            sys.stderr.write('\r{}/{}'.format(done, total))
+            if done == total:
+                sys.stderr.write('\n')
+            sys.stderr.flush()
+
+    out = open(args.output, 'w', newline='') if args.output else sys.stdout
+    try:
+        run(captures, out, fmt, reference, args.jobs,
+            progress=None if args.quiet else progress)
+    finally:
+        if out is not sys.stdout:
+            out.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,25 +1,27 @@
 import fps
-import time
+
+
+def show(event):
+	if event.pressed:
+		fps.debug_msg('Finger detected!', ':)')
+	else:
+		fps.debug_msg('No finger', ':(')
 
 
 def test_finger_press():
 	scanner = fps.FPS_GT511C3(baud=115200)
-	scanner.set_led(True)
 	scanner.serial_dbg = False
 
+	# Turns the LED on while watching and off again when stopped
+	watcher = scanner.watch_finger(show).start()
 	try:
-		while True:
-			finger_status = scanner.is_press_finger()
-			if finger_status:
-				fps.debug_msg('Finger detected!', ':)')
-			else:
-				fps.debug_msg('No finger', ':(')
-			time.sleep(1)
+		for event in watcher:
+			pass
 
 	except KeyboardInterrupt:
 		print('\nExitting')
 
-	scanner.set_led(False)
+	watcher.stop()
 	scanner.close()
 
 
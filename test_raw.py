@@ -1,8 +1,14 @@
 import fps
-from PIL import Image, ImageEnhance
+import raw_pipeline
+from PIL import Image
 import numpy as np
 import time
 
+# Processed references of the enrolled fingers, by id (read from the
+# .binar.bmp saved by Enroll on a miss)
+references = raw_pipeline.ReferenceCache(
+    lambda id: raw_pipeline.load_binary('fingerprint'+id+'.raw.binar.bmp'))
+
 def desplazarImagen(image,image2,delta):
     "Roll an image sideways"
     xsize, ysize = image.size
@@ -21,24 +27,8 @@ def cortarImagen(img, image2):
     return img2
 
 
-def normalize(arr):
-    """
-    Linear normalization
-    http://en.wikipedia.org/wiki/Normalization_%28image_processing%29
-    """
-    arr = arr.astype('float')
-    # Do not touch the alpha channel
-    for i in range(3):
-        minval = arr[...,i].min()
-        maxval = arr[...,i].max()
-        if minval != maxval:
-            arr[...,i] -= minval
-            arr[...,i] *= (255.0/(maxval-minval))
-    return arr
-
 def normalizeImage(img,image2):
-    arr=np.array(np.asarray(img).astype('float'))
-    new_img = Image.fromarray(normalize(arr).astype('uint8'))
+    new_img = Image.fromarray(raw_pipeline.normalize(np.asarray(img)))
     new_img.save(image2)
     return new_img
     
@@ -52,98 +42,65 @@ def rotateImage(img,image2):
     img.save(image2)
     return img
 
-def pixelesVecinos(image,pixel):
-    x = pixel[0]
-    y = pixel[1]
-    vecinos = [(x-1,y-1),
-               (x-1,y),
-               (x-1,y+1),
-               (x,y+1),
-               (x+1,y+1),
-               (x+1,y),
-               (x+1,y-1),
-               (x,y-1)]
-    return [image.getpixel(v) for v in vecinos]
-
 def segmentacion(im,image2):
-    im = im.point(lambda i: i*0.9 if i >=sum(list(im.getdata()))/(list(im.getdata()).__len__())  else 255)
-    enh = ImageEnhance.Contrast(im)
-    im = enh.enhance(1.2)
+    im = Image.fromarray(raw_pipeline.segment(np.asarray(im)))
     im.save(image2)
     return im
 
+def binaryArray(image):
+    return np.asarray(image.convert('L'))
+
 def bifurcaciones(image,size):
-    bifurcacion = [0,0,255,0,0,255,0,255]
-    inicioFin =   [0,0,255,0,0,0,0,0]
-    sizeX = size[0]-2
-    sizeY = size[1]-2
-    pixs = []
-    for x in range(1,sizeX):
-        for y in range (1,sizeY):
-            pixs.append((x,y))
-    return [1 if pixelesVecinos(image, (x1,y1) ) == bifurcacion else -1  for (x1,y1) in pixs]
-
-def contarBifurcaciones(bifurcaciones):
-    return sum(filter(lambda x: x==1, bifurcaciones))
-
-def contarNoBifurcaciones(bifurcaciones):
-    return sum(map(lambda m: -1*m,filter(lambda x: not x==1, bifurcaciones)))
+    mask = raw_pipeline.bifurcations(binaryArray(image))
+    return np.where(mask, 1, -1).T.ravel().tolist()
 
 def matchBif(im1,im2):
-    bif1 = (contarBifurcaciones(bifurcaciones(im1,im1.size)),
-           contarNoBifurcaciones(bifurcaciones(im1,im1.size)))
-    bif2 = (contarBifurcaciones(bifurcaciones(im2,im2.size)),
-           contarNoBifurcaciones(bifurcaciones(im2,im2.size)))
+    bif1 = raw_pipeline.count_bifurcations(binaryArray(im1))
+    bif2 = raw_pipeline.count_bifurcations(binaryArray(im2))
     tolerance = 0.1
-    print bif1
-    print bif2
+    print(bif1)
+    print(bif2)
     return True if bif2[0]-bif1[0] <= bif2[0]*tolerance or bif2[1]-bif1[1] <= bif2[0]*tolerance else False
 
 def GetRawImg(fps):
     ret = bytes()
-    if fps.SetLED(True):
-        if fps.GetRawImage():
-            response = fps._lastResponse.RawBytes[16:]
-            print fps.serializeToSend(response)
-            print u'Size %s' % str(response.__len__())
-            ret = bytes(response)
+    if fps.set_led(True):
+        if fps.get_raw_image():
+            response = fps._lastData.Data
+            print(fps.serializeToSend(response))
+            print(u'Size %s' % str(response.__len__()))
+            ret = response.tobytes()
     time.sleep(0.1)
-    fps.SetLED(False)
+    fps.set_led(False)
     return ret
 
 def SavedImg(imgName):    
     img = Image.open(imgName + '.binar.bmp')
     return img
 
-def processImage(imgName,imgRaw):
-    img = Image.fromstring(mode='L',size=(160,120),data= imgRaw)
-    enh = ImageEnhance.Brightness(img)
-    img = enh.enhance(1.2)
-    enh = ImageEnhance.Contrast(img)
-    img = enh.enhance(4)
-    enh = ImageEnhance.Sharpness(img)
-    img = enh.enhance(1.2)
-    img.save(imgName + '.bmp','BMP')
-#    img = rotateImage(img, imgName  + '.rotate.bmp')
-    img = normalizeImage(img,imgName + '.norm.bmp')
-    img = segmentacion(img,imgName + '.seg.bmp')
-    img = cortarImagen(img,imgName   + '.crop.bmp')
-    img = binarizeImage(img,imgName  + '.binar.bmp')
-    return img
+def processImage(imgName,imgRaw,debug=False):
+    """
+    Binarized finger area of a raw image; every stage is saved as
+    imgName.bmp, imgName.norm.bmp, ... only with debug
+    """
+    binary = raw_pipeline.process(imgRaw, debug=imgName if debug else None)
+    return Image.fromarray(binary).convert('1', dither=Image.NONE)
 
-def SaveImage(imgName,imgRaw):
+def SaveImage(imgName,imgRaw,debug=False):
     """
-    f = open(imgName, "w")
-    f.write(imgRaw)
-    f.close()
+    Processes a raw image and saves the result as imgName.binar.bmp
+    Returns: the binarized image (array)
     """
-    processImage(imgName,imgRaw)
+    binary = raw_pipeline.process(imgRaw, debug=imgName if debug else None)
+    if not debug:
+        raw_pipeline.save_binary(imgName + '.binar.bmp', binary)
+    return binary
 
-def Enroll(fps,id):
+def Enroll(fps,id,debug=False):
     imgRaw = GetRawImg(fps)
     if imgRaw.__len__()>0:
         time.sleep(3)
-        SaveImage('fingerprint'+id+'.raw', imgRaw)
+        references.put(id, SaveImage('fingerprint'+id+'.raw', imgRaw, debug))
     """
         imgRaw2 = GetRawImg(fps)
         if imgRaw2.__len__()>0:
@@ -155,13 +112,41 @@ def Enroll(fps,id):
                 SaveImage('fingerprint3.raw', imgRaw3)
     """
 
-def Verify(fps,id):
+def ArchiveRawImg(fps,archive,id=-1):
+    """
+    Downloads a raw image into a raw_archive.CaptureArchive, with its id
+    (setting fps.archive instead adds every download, without id)
+    Returns: number of the frame in the archive, None if nothing was captured
+    """
     imgRaw = GetRawImg(fps)
     if imgRaw.__len__()>0:
+        return archive.append(imgRaw, device=fps._device_name, ID=int(id))
+
+def processArchived(archive,index,debug=None):
+    """
+    Binarized finger area of a frame of a raw_archive.CaptureArchive
+    """
+    return raw_pipeline.process(archive[index], archive.size, debug)
+
+def EnrollArchived(archive,index,id):
+    references.put(id, SaveImage('fingerprint'+id+'.raw', archive[index]))
+
+def VerifyArchived(archive,index,id):
+    reference = references.get(id)
+    if reference is not None:
+        binary = processArchived(archive, index)
+        return 'Verified is: %s' % (str(raw_pipeline.match_bif(binary, reference)))
+    else:
+        return 'Not Verified'
+
+def Verify(fps,id,debug=False):
+    imgRaw = GetRawImg(fps)
+    reference = references.get(id)
+    if imgRaw.__len__()>0 and reference is not None:
         time.sleep(3)
-        img = processImage('fingerprint_verify_'+id+'.raw',imgRaw)
-        savedImg1 = SavedImg('fingerprint'+id+'.raw')
-        return 'Verified is: %s' % (str(matchBif(img, savedImg1)))
+        binary = raw_pipeline.process(
+            imgRaw, debug='fingerprint_verify_'+id+'.raw' if debug else None)
+        return 'Verified is: %s' % (str(raw_pipeline.match_bif(binary, reference)))
     else:
         return 'Not Verified'
 
@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+
+'''
+Fixtures shared by the emulator-backed tests
+'''
+
+import pytest
+
+import fps
+import fps_emulator
+
+
+@pytest.fixture
+def emulator(request):
+    emulator = fps_emulator.Emulator(115200, timing=False,
+                                     name=request.node.name)
+    yield emulator
+    emulator.close()
+
+
+@pytest.fixture
+def scanner(emulator):
+    scanner = fps.FPS_GT511C3(emulator.url, 115200, timeout=.2,
+                              baud_cache=None)
+    # Keep the resynchronization after a timeout short
+    scanner.RESYNC_QUIET = .2
+    yield scanner
+    scanner._serial.close()
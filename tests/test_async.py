@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+
+'''
+fps_async.AsyncFPS_GT511C3 against fps_emulator, through an asyncio stream
+pair that hands the bytes written to the emulator and feeds its replies back
+after their latency
+'''
+
+import asyncio
+
+import pytest
+
+import fps_async
+import fps_emulator
+from fps_emulator import template_of
+
+
+class EmulatorWriter(object):
+    '''
+        Minimal StreamWriter: every write goes to the emulator, the replies
+        are fed to reader once their latency has passed
+    '''
+    transport = None
+
+    def __init__(self, emulator, reader):
+        self._emulator = emulator
+        self._reader = reader
+        self._loop = asyncio.get_running_loop()
+
+    def write(self, data):
+        for latency, reply in self._emulator.feed(bytes(data)):
+            self._loop.call_later(latency, self._reader.feed_data, reply)
+
+    async def drain(self):
+        pass
+
+    def close(self):
+        pass
+
+
+def run(emulator, test, timeout=.3):
+    '''
+    Runs the coroutine function test(scanner) on an async client talking to
+    the emulator
+    '''
+    async def main():
+        reader = asyncio.StreamReader()
+        scanner = fps_async.AsyncFPS_GT511C3(
+            reader, EmulatorWriter(emulator, reader), emulator.url, timeout)
+        # Keep the resynchronization after a timeout short
+        scanner.RESYNC_QUIET = .2
+        return await test(scanner)
+    return asyncio.run(main())
+
+
+def test_commands(emulator):
+    emulator.enroll(3, 30)
+    emulator.press(30)
+
+    async def test(scanner):
+        assert await scanner.open()
+        assert await scanner.check_enrolled(3)
+        assert not await scanner.check_enrolled(4)
+        assert await scanner.get_enroll_count() == 1
+        assert await scanner.set_led(True)
+        assert await scanner.is_press_finger()
+        assert await scanner.capture_finger(False)
+        assert await scanner.identify1_N() == 3
+        assert await scanner.get_template(3) == 0
+        assert bytes(scanner._lastData.Data) == template_of(30)
+        assert await scanner.set_template(template_of(31), 7) == 200
+        assert await scanner.verify_template1_1(template_of(31), 7) == 0
+    run(emulator, test)
+    assert emulator.templates[7] == template_of(31)
+
+
+def test_streams(emulator):
+    emulator.enroll(2, 20)
+    emulator.press(5)
+
+    async def test(scanner):
+        await scanner.set_led(True)
+        image = bytearray()
+        async for chunk in scanner.iter_raw_image(5000):
+            image += chunk
+        template = bytearray()
+        async for chunk in scanner.iter_template(2, 100):
+            template += chunk
+        return bytes(image), bytes(template)
+    image, template = run(emulator, test)
+    assert image == fps_emulator.synthetic_image(5, fps_emulator.RAW_SIZE)
+    assert template == template_of(20)
+
+
+def test_late_reply_is_not_taken_for_the_next_response(emulator):
+    emulator.enroll(4, 1)
+
+    async def test(scanner):
+        # The ACK comes after the timeout, within the default quiet period
+        scanner.RESYNC_QUIET = fps_async.AsyncFPS_GT511C3.RESYNC_QUIET
+        emulator.latency = .5
+        assert not await scanner.set_led(True)
+        assert not await scanner.check_enrolled(150)
+        assert not await scanner.check_enrolled(4)
+        emulator.latency = 0
+        assert await scanner.check_enrolled(4)
+        assert await scanner.get_enroll_count() == 1
+    run(emulator, test)
+
+
+def test_stale_reply_is_flushed(emulator):
+    emulator.enroll(4, 1)
+
+    async def test(scanner):
+        # A reply nobody waits for any more, already buffered
+        scanner._send_command('GetEnrollCount', 0)
+        await asyncio.sleep(.05)
+        assert not await scanner.check_enrolled(150)
+        assert await scanner.check_enrolled(4)
+    run(emulator, test)
+
+
+@pytest.mark.parametrize('fault', ['drop', 'truncate', 'corrupt'])
+def test_recovers_after_fault(emulator, fault):
+    emulator.enroll(8, 1)
+    emulator.latency = .05
+
+    async def test(scanner):
+        emulator.inject(fault)
+        assert not await scanner.check_enrolled(8)
+        assert await scanner.check_enrolled(8)
+        assert not await scanner.check_enrolled(9)
+        assert await scanner.get_enroll_count() == 1
+    run(emulator, test)
+
+
+@pytest.mark.parametrize('fault', ['drop', 'truncate', 'corrupt'])
+def test_recovers_after_data_fault(emulator, fault):
+    emulator.enroll(2, 3)
+    emulator.latency = .05
+
+    async def test(scanner):
+        emulator.inject(fault)
+        failed = await scanner.get_template(2)
+        assert failed or not scanner._lastResponse.ACK
+        assert await scanner.get_template(2) == 0
+        assert bytes(scanner._lastData.Data) == template_of(3)
+    run(emulator, test)
+
+
+def test_truncated_stream_raises_and_recovers(emulator):
+    emulator.enroll(2, 3)
+
+    async def test(scanner):
+        emulator.inject('truncate')
+        with pytest.raises(IOError):
+            async for chunk in scanner.iter_template(2, 100):
+                pass
+        assert await scanner.check_enrolled(2)
+        assert not await scanner.check_enrolled(3)
+    run(emulator, test)
@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+
+'''
+Baud rate probing, the baud cache and auto_baud against fps_emulator
+'''
+
+import time
+
+import pytest
+
+import fps
+import fps_emulator
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return str(tmp_path / 'baud.json')
+
+
+@pytest.fixture
+def device(request):
+    emulator = fps_emulator.Emulator(38400, timing=False,
+                                     name=request.node.name)
+    yield emulator
+    emulator.close()
+
+
+def test_probe(device):
+    assert fps.probe(device.url, timeout=.05) == 38400
+    assert fps.probe(device.url, (9600, 115200), timeout=.05) is None
+    assert fps.probe('gt511://nothing-here', timeout=.05) is None
+
+
+def test_probe_tries_the_cached_rate_first(device, cache):
+    fps.save_baud_cache(device.url, 38400, cache)
+    start = time.time()
+    assert fps.probe(device.url, timeout=.2, baud_cache=cache) == 38400
+    # Not a single rate had to time out
+    assert time.time() - start < .2
+
+
+def test_probe_caches_the_rate_found(device, cache):
+    fps.save_baud_cache(device.url, 9600, cache)
+    fps.save_baud_cache('/dev/other', 57600, cache)
+    assert fps.probe(device.url, timeout=.05, baud_cache=cache) == 38400
+    assert fps.load_baud_cache(cache) == {device.url: 38400,
+                                          '/dev/other': 57600}
+
+
+def test_unreadable_cache(tmp_path, cache):
+    with open(cache, 'w') as f:
+        f.write('{not json')
+    assert fps.load_baud_cache(cache) == {}
+    assert fps.load_baud_cache(str(tmp_path / 'missing.json')) == {}
+    fps.save_baud_cache('/dev/ttyUSB0', 9600, cache)
+    assert fps.load_baud_cache(cache) == {'/dev/ttyUSB0': 9600}
+
+
+@pytest.mark.parametrize('auto_baud, baud', [(True, 115200), (57600, 57600)])
+def test_auto_baud(device, cache, auto_baud, baud):
+    scanner = fps.FPS_GT511C3(device.url, 9600, timeout=.2,
+                              auto_baud=auto_baud, baud_cache=cache)
+    assert device.baud == baud
+    assert scanner._serial.baudrate == baud
+    assert scanner.set_led(True)
+    assert fps.load_baud_cache(cache) == {device.url: baud}
+    scanner._serial.close()
+
+
+def test_auto_baud_silent_device(device, cache):
+    device.baud = 4800
+    scanner = fps.FPS_GT511C3(device.url, 9600, timeout=.05,
+                              auto_baud=True, baud_cache=cache)
+    assert device.commands['ChangeBaudrate'] == 0
+    assert fps.load_baud_cache(cache) == {}
+    scanner._serial.close()
+
+
+def test_unverified_rate_is_not_cached(device, cache):
+    scanner = fps.FPS_GT511C3(device.url, 9600, timeout=.2,
+                              auto_baud=57600, baud_cache=cache)
+    scanner.RESYNC_QUIET = .2
+    # ChangeBaudrate is ACKed, the Open that checks the new rate is lost
+    device.inject('drop', after=1)
+    assert not scanner.change_baud_rate(115200)
+    assert fps.load_baud_cache(cache) == {device.url: 57600}
+    scanner._serial.close()
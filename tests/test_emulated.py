@@ -0,0 +1,414 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+'''
+Driver tests against fps_emulator (no hardware needed)
+
+    python -m pytest
+'''
+
+import time
+
+import pytest
+
+import fps
+import fps_emulator
+import fps_store
+from fps_emulator import response_packet, data_packet, template_of
+
+
+# Framing
+
+def test_command_packet_layout():
+    packet = fps.Command_Packet.Pack('CheckEnrolled', 0x01020304)
+    assert packet[:4] == b'\x55\xaa\x01\x00'
+    assert packet[4:8] == b'\x04\x03\x02\x01'
+    assert packet[8:10] == b'\x21\x00'
+    assert packet[10] + (packet[11] << 8) == sum(bytearray(packet[:10]))
+
+
+def test_response_packet_ack():
+    rp = fps.Response_Packet(response_packet(True, 1234))
+    assert rp.ACK and rp.ChecksumOK
+    assert rp.Parameter == 1234
+    assert rp.Error == fps.ErrorCode.NO_ERROR
+
+
+def test_response_packet_bad_checksum():
+    packet = bytearray(response_packet(True))
+    packet[-1] ^= 0xFF
+    rp = fps.Response_Packet(packet)
+    assert not rp.ACK and not rp.ChecksumOK
+    assert rp.Error == fps.ErrorCode.INVALID
+
+
+def test_response_packet_short():
+    rp = fps.Response_Packet(response_packet(True)[:7])
+    assert not rp.ACK and rp.Error == fps.ErrorCode.INVALID
+
+
+def test_data_packet_round_trip():
+    payload = template_of(7)
+    dp = fps.Data_Packet(data_packet(payload))
+    assert dp.IsValid()
+    assert bytes(dp.Data) == payload
+    assert bytes(fps.Data_Packet(data=payload).GetPacketBytes()) == \
+        data_packet(payload)
+
+
+def test_download_template(scanner, emulator):
+    emulator.enroll(3, 42)
+    assert scanner.get_template(3) == 0
+    assert bytes(scanner._lastData.Data) == template_of(42)
+
+
+def test_download_raw_image_streamed(scanner, emulator):
+    emulator.press(5)
+    assert scanner.set_led(True)
+    image = b''.join(bytes(c) for c in scanner.iter_raw_image(5000))
+    assert image == fps_emulator.synthetic_image(5, fps_emulator.RAW_SIZE)
+
+
+def test_stream_checksum_is_checked_before_the_last_chunk(scanner, emulator,
+                                                          monkeypatch):
+    emulator.enroll(2, 3)
+    good = fps_emulator.data_packet
+    monkeypatch.setattr(fps_emulator, 'data_packet',
+                        lambda payload: good(payload)[:-1] + b'\x00')
+    stream = scanner.iter_template(2, 400)
+    assert len(next(stream)) == 400
+    with pytest.raises(IOError, match='checksum'):
+        next(stream)
+    assert scanner.check_enrolled(2)
+
+
+def test_stream_closed_after_the_last_chunk(scanner, emulator):
+    emulator.enroll(2, 3)
+    stream = scanner.iter_template(2, 400)
+    chunks = [next(stream), next(stream)]
+    stream.close()
+    assert b''.join(chunks) == template_of(3)
+    # The checksum didn't stay behind for the next response
+    assert scanner._serial.in_waiting == 0
+    assert scanner.check_enrolled(2)
+
+
+def test_upload_template(scanner, emulator):
+    assert scanner.set_template(template_of(9), 12,
+                                duplicate_check=False) == 200
+    assert emulator.templates[12] == template_of(9)
+
+
+# NACK decoding
+
+@pytest.mark.parametrize('error', [fps.ErrorCode.NACK_INVALID_POS,
+                                   fps.ErrorCode.NACK_IS_NOT_USED,
+                                   fps.ErrorCode.NACK_DB_IS_EMPTY,
+                                   fps.ErrorCode.NACK_FINGER_IS_NOT_PRESSED])
+def test_response_packet_nack(error):
+    rp = fps.Response_Packet(response_packet(False, error))
+    assert not rp.ACK and rp.ChecksumOK
+    assert rp.Error == error
+
+
+def test_nack_unknown_error_is_invalid():
+    rp = fps.Response_Packet(response_packet(False, 0x7777))
+    assert not rp.ACK
+    assert rp.Error == fps.ErrorCode.INVALID
+
+
+def test_nack_return_codes(scanner, emulator):
+    assert scanner.get_template(5) == 2
+    assert scanner.get_template(250) == 1
+    assert not scanner.check_enrolled(5)
+    emulator.enroll(5, 1)
+    assert scanner.set_template(template_of(1), 6) == 5
+
+
+def test_injected_nack(scanner, emulator):
+    emulator.inject('nack')
+    assert not scanner.set_led(True)
+    assert scanner._lastResponse.Error == fps.ErrorCode.NACK_DEV_ERR
+    assert scanner.set_led(True)
+
+
+# Desync and timeouts
+
+def test_late_reply_is_not_taken_for_the_next_response(emulator, scanner):
+    emulator.enroll(4, 1)
+    # The ACK comes after the timeout, within the default quiet period
+    scanner.RESYNC_QUIET = fps.FPS_GT511C3.RESYNC_QUIET
+    emulator.latency = {'CmosLed': .5}
+    assert not scanner.set_led(True)
+    assert not scanner.check_enrolled(150)
+    assert scanner.check_enrolled(4)
+    assert scanner.get_enroll_count() == 1
+
+
+@pytest.mark.parametrize('fault', ['drop', 'truncate', 'corrupt'])
+def test_recovers_after_fault(scanner, emulator, fault):
+    emulator.enroll(8, 1)
+    emulator.inject(fault)
+    assert not scanner.check_enrolled(8)
+    assert scanner.check_enrolled(8)
+    assert not scanner.check_enrolled(9)
+
+
+def test_truncated_data_packet(scanner, emulator):
+    emulator.enroll(2, 3)
+    emulator.inject('truncate')
+    assert scanner.get_template(2) != 0
+    assert scanner.get_template(2) == 0
+    assert bytes(scanner._lastData.Data) == template_of(3)
+
+
+def test_timeout_is_bounded(scanner, emulator):
+    emulator.inject('drop')
+    start = time.time()
+    assert not scanner.set_led(True)
+    # One serial timeout for the response, one quiet period to resync
+    assert time.time() - start < .2 + .2 + .3
+
+
+# run_batch
+
+@pytest.mark.parametrize('window', [1, 2, 3])
+def test_run_batch(scanner, emulator, window):
+    emulator.enroll(1, 11)
+    results = scanner.run_batch([('CmosLed', 1),
+                                 ('CheckEnrolled', 1),
+                                 ('CheckEnrolled', 2),
+                                 ('GetTemplate', 1),
+                                 ('GetEnrollCount', 0),
+                                 ('CmosLed', 0)], window)
+    assert [r.command for r in results] == [
+        'CmosLed', 'CheckEnrolled', 'CheckEnrolled', 'GetTemplate',
+        'GetEnrollCount', 'CmosLed']
+    assert [r.response.ACK for r in results] == [True, True, False, True,
+                                                 True, True]
+    assert results[2].response.Error == fps.ErrorCode.NACK_IS_NOT_USED
+    assert bytes(results[3].data.Data) == template_of(11)
+    assert results[4].response.Parameter == 1
+    assert not emulator.led
+
+
+def test_batch_updates_occupancy(scanner, emulator):
+    emulator.enroll(0, 1)
+    scanner.occupancy()
+    with scanner.batch() as b:
+        b.delete_id(0)
+    assert b.results[0].response.ACK
+    assert not scanner.occupancy() & 1
+
+
+# Occupancy
+
+def test_occupancy(scanner, emulator):
+    for ID in (0, 5, 199):
+        emulator.enroll(ID, ID)
+    assert scanner.occupancy() == 1 | 1 << 5 | 1 << 199
+    assert scanner.next_free_id() == 1
+
+
+def test_occupancy_scan_stops_at_enroll_count(scanner, emulator):
+    emulator.enroll(3, 1)
+    scanner.refresh_occupancy()
+    assert emulator.commands['CheckEnrolled'] == 4
+
+
+@pytest.mark.parametrize('fault', ['drop', 'corrupt', 'nack'])
+def test_occupancy_scan_failing_enroll_count(scanner, emulator, fault):
+    emulator.enroll(3, 1)
+    assert scanner.occupancy() == 1 << 3
+    emulator.inject(fault)
+    with pytest.raises(IOError, match='GetEnrollCount'):
+        scanner.refresh_occupancy()
+    assert scanner.occupancy() == 1 << 3
+
+
+@pytest.mark.parametrize('fault', ['drop', 'corrupt', 'nack'])
+def test_occupancy_scan_failing_check(scanner, emulator, fault):
+    emulator.enroll(3, 1)
+    # GetEnrollCount goes through, CheckEnrolled 0 fails
+    emulator.inject(fault, after=1)
+    with pytest.raises(IOError, match='CheckEnrolled 0'):
+        scanner.occupancy()
+    assert scanner._occupancy is None
+
+
+# Backup and restore
+
+def test_backup_and_restore(scanner, emulator, tmp_path):
+    for ID, finger in ((0, 10), (7, 17), (199, 29)):
+        emulator.enroll(ID, finger)
+    saved = dict(emulator.templates)
+    path = str(tmp_path / 'backup.db')
+    assert scanner.backup_database(path) == 3
+    assert scanner.delete_all()
+    emulator.enroll(50, 99)
+    assert scanner.restore_database(path, prune=True) == []
+    assert emulator.templates == saved
+
+
+@pytest.mark.parametrize('fault', ['drop', 'corrupt', 'nack'])
+def test_backup_failing_enroll_count(scanner, emulator, tmp_path, fault):
+    emulator.enroll(0, 10)
+    path = tmp_path / 'backup.db'
+    path.write_bytes(b'previous backup')
+    emulator.inject(fault)
+    with pytest.raises(IOError, match='GetEnrollCount'):
+        scanner.backup_database(str(path))
+    assert path.read_bytes() == b'previous backup'
+    assert [p.name for p in tmp_path.iterdir()] == ['backup.db']
+
+
+@pytest.mark.parametrize('fault', ['drop', 'truncate', 'corrupt', 'nack'])
+def test_backup_failing_download(scanner, emulator, tmp_path, fault):
+    emulator.enroll(0, 10)
+    emulator.enroll(1, 11)
+    path = str(tmp_path / 'backup.db')
+    # GetEnrollCount and GetTemplate 0 go through, GetTemplate 1 fails
+    emulator.inject(fault, after=2)
+    with pytest.raises(IOError, match='GetTemplate 1'):
+        scanner.backup_database(path)
+    assert not list(tmp_path.iterdir())
+    assert scanner.backup_database(path) == 2
+
+
+def test_restore_compare_skips_identical(scanner, emulator, tmp_path):
+    emulator.enroll(3, 13)
+    emulator.enroll(4, 14)
+    path = str(tmp_path / 'backup.db')
+    scanner.backup_database(path)
+    emulator.enroll(4, 41)
+    uploads = emulator.commands['SetTemplate']
+    assert scanner.restore_database(path, compare=True) == []
+    assert emulator.commands['SetTemplate'] == uploads + 1
+    assert emulator.templates[4] == template_of(14)
+
+
+def test_restore_releases_records_on_error(scanner, emulator, tmp_path):
+    emulator.enroll(1, 1)
+    path = str(tmp_path / 'backup.db')
+    scanner.backup_database(path)
+
+    def fail(*args, **kwargs):
+        raise IOError('upload failed')
+    scanner.set_template = fail
+    with pytest.raises(IOError, match='upload failed'):
+        scanner.restore_database(path)
+
+
+# SlotCache
+
+@pytest.fixture
+def store(tmp_path):
+    store = fps_store.TemplateStore(str(tmp_path / 'users.db'))
+    for key in range(5):
+        store.put(key, template_of(100 + key))
+    yield store
+    store.close()
+
+
+def test_slot_cache_evicts_least_recently_used(scanner, emulator, store):
+    cache = fps_store.SlotCache(scanner, slots=[10, 11])
+    assert cache.capacity == 2
+    assert cache.load(0, store.get(0)) == 10
+    assert cache.load(1, store.get(1)) == 11
+    cache.touch(0)
+    assert cache.load(2, store.get(2)) == 11
+    assert 1 not in cache and 0 in cache and 2 in cache
+    assert emulator.templates[11] == template_of(102)
+    assert cache.user(10) == 0 and cache.user(11) == 2
+
+
+def test_slot_cache_leaves_enrolled_ids_alone(scanner, emulator, store):
+    emulator.enroll(10, 1)
+    cache = fps_store.SlotCache(scanner, slots=[10, 11])
+    assert cache.capacity == 1
+    cache.load(0, store.get(0))
+    cache.load(1, store.get(1))
+    assert emulator.templates[10] == template_of(1)
+    assert emulator.templates[11] == template_of(101)
+
+
+def test_slot_cache_adopts_after_restart(scanner, emulator, store):
+    cache = fps_store.SlotCache(scanner, slots=[10, 11])
+    cache.load(3, store.get(3))
+    again = fps_store.SlotCache(scanner, slots=[10, 11])
+    assert again.capacity == 1
+    assert again.adopt(store) == 1
+    uploads = emulator.commands['SetTemplate']
+    assert again.load(3, store.get(3)) == 10
+    assert emulator.commands['SetTemplate'] == uploads
+
+
+def test_slot_cache_checks_slots_behind_a_stale_bitmap(scanner, emulator,
+                                                       store):
+    cache = fps_store.SlotCache(scanner, slots=[10, 11])
+    # Enrolled behind the back of the scanner object
+    emulator.enroll(10, 1)
+    assert cache.load(0, store.get(0)) == 11
+    assert emulator.templates[10] == template_of(1)
+    assert cache.load(1, store.get(1)) == 11
+    assert emulator.templates[10] == template_of(1)
+
+
+def test_slot_cache_refuses_a_failed_scan(scanner, emulator):
+    emulator.inject('nack')
+    with pytest.raises(IOError):
+        fps_store.SlotCache(scanner, slots=[10, 11])
+
+
+def test_slot_cache_failed_check_keeps_the_slot(scanner, emulator, store):
+    cache = fps_store.SlotCache(scanner, slots=[10])
+    emulator.inject('nack')
+    with pytest.raises(IOError, match='CheckEnrolled 10'):
+        cache.load(0, store.get(0))
+    assert 10 not in emulator.templates
+    assert cache.load(0, store.get(0)) == 10
+    assert emulator.templates[10] == template_of(100)
+
+
+def test_enroll_from_keeps_the_enrolled_slot(scanner, emulator, store):
+    index = fps_store.TemplateIndex(store, [scanner], slots=[10, 11])
+    cache = index.cache(7)
+    emulator.enroll(11, 70)
+    assert index.enroll_from(scanner, 7, 11)
+    assert store.get(7) == template_of(70)
+    uploads = emulator.commands['SetTemplate']
+    assert cache.load(7, store.get(7)) == 11
+    assert emulator.commands['SetTemplate'] == uploads
+    assert index.identify(template_of(70)) == 7
+
+
+def test_enroll_from_replaces_the_loaded_copy(scanner, emulator, store):
+    index = fps_store.TemplateIndex(store, [scanner], slots=[10, 11])
+    cache = index.cache(0)
+    assert cache.load(0, store.get(0)) == 10
+    emulator.enroll(11, 50)
+    assert index.enroll_from(scanner, 0, 11)
+    assert 10 not in emulator.templates
+    assert cache.load(0, store.get(0)) == 11
+    assert cache.capacity == 2
+
+
+def test_enroll_from_outside_the_slots(scanner, emulator, store):
+    index = fps_store.TemplateIndex(store, [scanner], slots=[10, 11])
+    emulator.enroll(50, 70)
+    assert index.enroll_from(scanner, 7, 50)
+    assert index.cache(7).user(50) == 7
+    assert 7 not in index.cache(7)
+    assert index.identify(template_of(70), candidates=[0]) == 7
+
+
+def test_index_identifies_by_paging(scanner, emulator, store):
+    index = fps_store.TemplateIndex(store, [scanner], slots=[0, 1])
+    assert index.identify(template_of(104)) is None
+    assert index.identify(template_of(104), exhaustive=True) == 4
+
+
+def test_index_without_slots_gives_up(scanner, emulator, store):
+    emulator.enroll(0, 1)
+    index = fps_store.TemplateIndex(store, [scanner], slots=[0])
+    assert index.identify(template_of(104), exhaustive=True) is None
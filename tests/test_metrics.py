@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+
+'''
+fps.Metrics, on its own and collecting from a driver talking to
+fps_emulator
+'''
+
+import pytest
+
+import fps
+from fps_emulator import template_of
+
+DEVICE = '/dev/ttyUSB0'
+
+
+def timing(command, seconds, error=None, device=DEVICE):
+    return fps.Command_Timing(device, command, seconds, 12, 12, error)
+
+
+def test_finished():
+    seen = []
+    metrics = fps.Metrics(seen.append)
+    metrics.finished(timing('Open', .003))
+    metrics.finished(timing('Open', 20.))
+    metrics.finished(timing('Verify1_1', .2, 'NACK_VERIFY_FAILED'))
+    metrics.finished(timing('Verify1_1', 2., 'TIMEOUT'))
+    assert metrics.commands == {(DEVICE, 'Open'): 2,
+                                (DEVICE, 'Verify1_1'): 2}
+    histogram = metrics.latency[DEVICE, 'Open']
+    assert histogram[fps.Metrics.BUCKETS.index(.005)] == 1
+    assert histogram[len(fps.Metrics.BUCKETS)] == 1     # +Inf
+    assert histogram[-1] == pytest.approx(20.003)
+    assert metrics.nacks == {(DEVICE, 'Verify1_1', 'NACK_VERIFY_FAILED'): 1}
+    assert len(seen) == 4
+
+
+def test_reset_keeps_hooks():
+    seen = []
+    metrics = fps.Metrics()
+    metrics.add_hook(seen.append)
+    metrics.sent(DEVICE, 12)
+    metrics.retry(DEVICE, 'Open')
+    metrics.reset()
+    assert not metrics.bytes_out and not metrics.retries
+    metrics.finished(timing('Open', .01))
+    metrics.remove_hook(seen.append)
+    metrics.finished(timing('Open', .01))
+    assert len(seen) == 1
+
+
+def test_snapshot():
+    metrics = fps.Metrics()
+    metrics.finished(timing('GetTemplate', .03, 'NACK_IS_NOT_USED'))
+    metrics.received(DEVICE, 12)
+    metrics.timeout(DEVICE, 'GetTemplate')
+    snapshot = metrics.snapshot()
+    assert snapshot['commands'] == {DEVICE: {'GetTemplate': 1}}
+    assert snapshot['latency'][DEVICE]['GetTemplate']['sum'] == .03
+    assert sum(snapshot['latency'][DEVICE]['GetTemplate']['counts']) == 1
+    assert snapshot['nacks'] == {
+        DEVICE: {'GetTemplate': {'NACK_IS_NOT_USED': 1}}}
+    assert snapshot['bytes_in'] == {DEVICE: 12}
+    assert snapshot['timeouts'] == {DEVICE: {'GetTemplate': 1}}
+
+
+def test_prometheus():
+    metrics = fps.Metrics()
+    metrics.finished(timing('Open', .003, device='a"b'))
+    metrics.finished(timing('Open', .2, device='a"b'))
+    text = metrics.prometheus()
+    assert '# TYPE gt511c3_command_seconds histogram' in text
+    assert ('gt511c3_commands_total{device="a\\"b",command="Open"} 2'
+            in text.splitlines())
+    buckets = [line for line in text.splitlines()
+               if line.startswith('gt511c3_command_seconds_bucket')]
+    assert len(buckets) == len(fps.Metrics.BUCKETS) + 1
+    # Cumulative counts
+    assert buckets[0].endswith(' 0') and buckets[2].endswith(' 1')
+    assert buckets[-1] == ('gt511c3_command_seconds_bucket{device="a\\"b",'
+                           'command="Open",le="+Inf"} 2')
+    assert text.endswith('\n')
+
+
+# Collected from the driver
+
+@pytest.fixture
+def metrics(scanner):
+    seen = []
+    metrics = scanner.metrics = fps.Metrics(seen.append)
+    metrics.seen = seen
+    return metrics
+
+
+def test_driver_commands(scanner, emulator, metrics):
+    device = emulator.url
+    emulator.enroll(3, 1)
+    assert scanner.set_led(True)
+    assert scanner.get_template(3) == 0
+    assert scanner.get_template(4) == 2
+    assert scanner.set_template(template_of(2), 5) == 200
+    assert [(t.command, t.bytes_out, t.bytes_in, t.error)
+            for t in metrics.seen] == [
+        ('CmosLed', 12, 12, None),
+        ('GetTemplate', 12, 12 + 6 + 498, None),
+        ('GetTemplate', 12, 12, 'NACK_IS_NOT_USED'),
+        ('SetTemplate', 12 + 6 + 498, 24, None)]
+    assert metrics.bytes_out[device] == 3 * 12 + 12 + 6 + 498
+    assert metrics.bytes_in[device] == 12 + 12 + 6 + 498 + 12 + 24
+    assert metrics.nacks == {(device, 'GetTemplate', 'NACK_IS_NOT_USED'): 1}
+
+
+def test_driver_streams(scanner, emulator, metrics):
+    emulator.enroll(3, 1)
+    assert b''.join(scanner.iter_template(3, 100)) == template_of(1)
+    image = bytearray(scanner.RAW_IMAGE_SIZE)
+    assert scanner.get_raw_image_into(image)
+    assert [(t.command, t.bytes_in, t.error) for t in metrics.seen] == [
+        ('GetTemplate', 12 + 6 + 498, None),
+        ('GetRawImage', 12 + 6 + scanner.RAW_IMAGE_SIZE, None)]
+
+
+def test_driver_timeout(scanner, emulator, metrics):
+    emulator.inject('drop')
+    assert not scanner.set_led(True)
+    assert metrics.timeouts == {(emulator.url, 'CmosLed'): 1}
+    assert metrics.seen[0].error == 'TIMEOUT'
+    assert not metrics.nacks
+
+
+def test_finger_polls_are_not_retries(scanner, emulator, metrics):
+    scanner.set_led(True)
+    assert not scanner.wait_finger(True, timeout=.1)
+    assert metrics.commands[emulator.url, 'IsPressFinger'] > 1
+    assert not metrics.retries
@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+
+'''
+FPS_GT511C3.enroll and identify against fps_emulator, the prompt callback
+playing the user
+'''
+
+import threading
+
+from fps_emulator import template_of
+
+
+def user(emulator, finger):
+    '''
+    Returns: a prompt that presses or lifts finger as asked
+    '''
+    def prompt(message):
+        if message.startswith('Remove'):
+            emulator.release()
+        else:
+            emulator.press(finger)
+    return prompt
+
+
+def test_enroll(scanner, emulator):
+    emulator.enroll(0, 1)
+    result = scanner.enroll(timeout=2, prompt=user(emulator, 42))
+    assert (result.ID, result.stage, result.code) == (1, None, 0)
+    assert emulator.templates[1] == template_of(42)
+    assert [stage for stage, _ in result.timings] == [
+        'start', 'press1', 'capture1', 'enroll1', 'release1', 'press2',
+        'capture2', 'enroll2', 'release2', 'press3', 'capture3', 'enroll3']
+    assert not emulator.led
+    assert scanner.occupancy() == 0b11
+
+
+def test_enroll_used_id(scanner, emulator):
+    emulator.enroll(4, 1)
+    result = scanner.enroll(4, timeout=.5, prompt=user(emulator, 42))
+    assert (result.stage, result.code) == ('start', 3)
+    assert emulator.commands['CmosLed'] == 0
+
+
+def test_enroll_other_finger(scanner, emulator):
+    fingers = iter([5, 5, 6])
+
+    def prompt(message):
+        if message.startswith('Remove'):
+            emulator.release()
+        else:
+            emulator.press(next(fingers))
+    result = scanner.enroll(2, timeout=2, prompt=prompt)
+    assert (result.stage, result.code) == ('enroll3', 1)
+    assert 2 not in emulator.templates
+    assert not emulator.led
+
+
+def test_enroll_duplicate(scanner, emulator):
+    emulator.enroll(7, 42)
+    result = scanner.enroll(2, timeout=2, prompt=user(emulator, 42))
+    assert (result.stage, result.code) == ('enroll3', 3)
+    assert not emulator.led
+
+
+def test_enroll_times_out(scanner, emulator):
+    result = scanner.enroll(2, timeout=.3)
+    assert (result.stage, result.code) == ('press1', None)
+    assert not emulator.led
+
+
+def test_enroll_leaves_the_device_to_others_while_waiting(scanner,
+                                                          emulator):
+    counts = []
+
+    def prompt(message):
+        # Another thread gets through while the enrollment waits
+        other = threading.Thread(
+            target=lambda: counts.append(scanner.get_enroll_count()))
+        other.start()
+        other.join(1)
+        user(emulator, 42)(message)
+    result = scanner.enroll(timeout=2, prompt=prompt)
+    assert result.code == 0
+    assert len(counts) == 5
+
+
+def test_identify(scanner, emulator):
+    emulator.enroll(5, 42)
+    result = scanner.identify(timeout=2, prompt=user(emulator, 42))
+    assert (result.ID, result.stage, result.code) == (5, None, 0)
+    assert [stage for stage, _ in result.timings] == ['press', 'identify']
+    assert not emulator.led
+
+
+def test_identify_unknown_finger(scanner, emulator):
+    emulator.enroll(5, 42)
+    result = scanner.identify(timeout=2, prompt=user(emulator, 43))
+    assert (result.ID, result.stage, result.code) == (200, None, 0)
+    assert not emulator.led
+
+
+def test_identify_times_out(scanner, emulator):
+    emulator.enroll(5, 42)
+    result = scanner.identify(timeout=.3)
+    assert (result.ID, result.stage) == (200, 'press')
+    assert emulator.commands['Identify1_N'] == 0
+    assert not emulator.led
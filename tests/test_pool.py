@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+
+'''
+ScannerPool over several emulated scanners
+'''
+
+import pytest
+
+import fps
+import fps_emulator
+import fps_pool
+from fps_emulator import template_of
+
+
+@pytest.fixture
+def emulators(request):
+    emulators = [fps_emulator.Emulator(baud, timing=False, name='{}-{}'.format(
+        request.node.name, baud)) for baud in (9600, 115200)]
+    yield emulators
+    for emulator in emulators:
+        emulator.close()
+
+
+@pytest.fixture
+def pool(emulators, tmp_path):
+    ports = [e.url for e in emulators] + ['gt511://nothing-here']
+    pool = fps_pool.ScannerPool(ports, timeout=.2, probe_timeout=.05,
+                                baud_cache=str(tmp_path / 'baud.json'))
+    yield pool
+    pool.close()
+
+
+def test_discover(pool, emulators, tmp_path):
+    slow, fast = emulators
+    assert pool.discover() == {slow.url: 9600, fast.url: 115200}
+    assert fps.load_baud_cache(str(tmp_path / 'baud.json')) == {
+        slow.url: 9600, fast.url: 115200}
+    # Cached until asked to probe again
+    fast.close()
+    assert fast.url in pool.discover()
+    assert pool.discover(refresh=True) == {slow.url: 9600}
+
+
+def test_get(pool, emulators):
+    slow, fast = emulators
+    scanner = pool.get(fast.url)
+    assert scanner is pool.get(fast.url)
+    assert scanner._serial.baudrate == 115200
+    assert set(pool.scanners()) == {slow.url, fast.url}
+    with pytest.raises(KeyError):
+        pool.get('gt511://nothing-here')
+
+
+def test_identify(pool, emulators):
+    slow, fast = emulators
+    slow.enroll(3, 42)
+    fast.enroll(7, 42)
+    fast.enroll(8, 43)
+    slow.press(42)
+    assert pool.identify() == {slow.url: 3, fast.url: 200}
+    assert not slow.led and not fast.led
+    assert pool.identify_template(template_of(43)) == {slow.url: 200,
+                                                      fast.url: 8}
+
+
+def test_close(pool, emulators):
+    slow, fast = emulators
+    scanner = pool.get(slow.url)
+    pool.close()
+    assert not scanner._serial.is_open
+    assert pool.get(slow.url) is not scanner
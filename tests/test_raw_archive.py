@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+
+'''
+raw_archive.CaptureArchive
+'''
+
+import os
+
+import numpy as np
+import pytest
+
+import fps_emulator
+import raw_archive
+
+
+def frame(n, size=raw_archive.RAW_SIZE):
+    return np.full((size[1], size[0]), n, np.uint8)
+
+
+@pytest.fixture
+def path(tmp_path):
+    return str(tmp_path / 'captures.gta')
+
+
+def test_empty(path):
+    archive = raw_archive.CaptureArchive(path, 'a')
+    assert len(archive) == 0
+    assert archive.frames.shape == (0, 120, 160)
+    assert len(archive.index) == 0
+    archive.close()
+    assert len(raw_archive.CaptureArchive(path)) == 0
+
+
+def test_append_and_read(path):
+    archive = raw_archive.CaptureArchive(path, 'a')
+    assert archive.append(frame(1).tobytes(), '/dev/ttyUSB0', 7, .5,
+                          timestamp=100.) == 0
+    assert archive.append(frame(2), ID=8) == 1
+    assert archive.append(memoryview(frame(3).tobytes())) == 2
+    archive.close()
+    archive = raw_archive.CaptureArchive(path)
+    assert len(archive) == 3
+    assert [int(archive[n][0, 0]) for n in range(3)] == [1, 2, 3]
+    entry = archive.entry(0)
+    assert (entry['timestamp'], entry['device'], entry['id'],
+            entry['quality']) == (100., b'/dev/ttyUSB0', 7, .5)
+    assert list(archive.index['id']) == [7, 8, -1]
+    assert np.isnan(archive.index['quality'][2])
+
+
+def test_frames_are_one_contiguous_view(path):
+    archive = raw_archive.CaptureArchive(path, 'a', capacity=4)
+    for n in range(3):
+        archive.append(frame(n))
+    frames = archive.frames
+    assert frames.shape == (3, 120, 160)
+    assert frames.flags['C_CONTIGUOUS'] and not frames.flags['WRITEABLE']
+    assert frames.mean(axis=(1, 2)).tolist() == [0, 1, 2]
+    assert archive._frames_offset % archive.PAGE == 0
+
+
+def test_grow(path):
+    archive = raw_archive.CaptureArchive(path, 'a', capacity=2)
+    for n in range(5):
+        archive.append(frame(n), ID=n)
+    assert archive.capacity == 8
+    assert archive.frames.flags['C_CONTIGUOUS']
+    assert archive.frames[:, 0, 0].tolist() == list(range(5))
+    assert archive.index['id'].tolist() == list(range(5))
+    assert os.listdir(os.path.dirname(path)) == ['captures.gta']
+    archive.close()
+    assert raw_archive.CaptureArchive(path).frames[:, 5, 5].tolist() == \
+        list(range(5))
+
+
+def test_reader_refresh(path):
+    writer = raw_archive.CaptureArchive(path, 'a', capacity=2)
+    writer.append(frame(1))
+    reader = raw_archive.CaptureArchive(path)
+    old = reader.frames
+    writer.append(frame(2))
+    assert len(reader) == 1
+    reader.refresh()
+    assert reader.frames[:, 0, 0].tolist() == [1, 2]
+    # Grown: the writer replaces the file, views of the old one stay valid
+    writer.append(frame(3))
+    reader.refresh()
+    assert len(reader) == 3 and reader.capacity == 4
+    assert old[0, 0, 0] == 1
+
+
+def test_image_size(path):
+    archive = raw_archive.CaptureArchive(path, 'a',
+                                         size=raw_archive.IMAGE_SIZE)
+    archive.append(frame(9, raw_archive.IMAGE_SIZE))
+    assert archive.frames.shape == (1, 202, 258)
+    with pytest.raises(ValueError):
+        archive.append(frame(9))
+
+
+def test_errors(path, tmp_path):
+    with pytest.raises(IOError):
+        raw_archive.CaptureArchive(path)
+    other = tmp_path / 'other.bin'
+    other.write_bytes(b'not an archive')
+    with pytest.raises(ValueError):
+        raw_archive.CaptureArchive(str(other))
+    raw_archive.CaptureArchive(path, 'a').close()
+    with pytest.raises(IOError):
+        raw_archive.CaptureArchive(path).append(frame(1))
+
+
+def test_scanner_archives_downloads(scanner, emulator, path):
+    scanner.archive = raw_archive.CaptureArchive(path, 'a')
+    emulator.press(4)
+    scanner.set_led(True)
+    assert scanner.get_raw_image()
+    image = np.empty((120, 160), np.uint8)
+    assert scanner.get_raw_image_into(image)
+    # Templates and images of another size are not archived
+    assert scanner.get_image()
+    assert len(scanner.archive) == 2
+    assert scanner.archive[1].tobytes() == fps_emulator.synthetic_image(
+        4, fps_emulator.RAW_SIZE)
+    # Port names are truncated to 16 bytes
+    assert scanner.archive.entry(0)['device'] == emulator.url.encode()[:16]
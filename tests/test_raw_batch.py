@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+
+'''
+raw_batch over directories of captures and capture archives
+'''
+
+import csv
+import json
+
+import pytest
+
+import fps_emulator
+import raw_archive
+import raw_batch
+import raw_pipeline
+
+
+def capture(finger):
+    return fps_emulator.synthetic_image(finger, raw_pipeline.RAW_SIZE)
+
+
+@pytest.fixture
+def captures(tmp_path):
+    folder = tmp_path / 'captures'
+    folder.mkdir()
+    for finger in (3, 1, 2):
+        (folder / 'f{}.raw'.format(finger)).write_bytes(capture(finger))
+    (folder / 'f4.raw').write_bytes(b'short')
+    (folder / 'notes.txt').write_text('not a capture')
+    return folder
+
+
+def expected(finger, reference=None):
+    binary = raw_pipeline.process(capture(finger))
+    found, other = raw_pipeline.count_bifurcations(binary)
+    row = {'bifurcations': found, 'other': other, 'match': None,
+           'delta': None, 'error': None}
+    if reference is not None:
+        row['match'] = raw_pipeline.match_bif(binary, reference)
+        row['delta'] = found - raw_pipeline.count_bifurcations(reference)[0]
+    return row
+
+
+def test_list_captures(captures):
+    assert [p.rsplit('/', 1)[-1] for p in
+            raw_batch.list_captures(str(captures))] == [
+        'f1.raw', 'f2.raw', 'f3.raw', 'f4.raw']
+
+
+def test_run_in_order(captures, tmp_path):
+    reference = raw_pipeline.process(capture(2))
+    out = tmp_path / 'out.jsonl'
+    done = []
+    with open(str(out), 'w') as f:
+        assert raw_batch.run(raw_batch.list_captures(str(captures)), f,
+                             'jsonl', reference, jobs=2, chunksize=1,
+                             progress=done.append) == 4
+    rows = [json.loads(line) for line in out.read_text().splitlines()]
+    assert [row.pop('capture') for row in rows] == [
+        'f1.raw', 'f2.raw', 'f3.raw', 'f4.raw']
+    assert rows[:3] == [expected(n, reference) for n in (1, 2, 3)]
+    assert rows[1]['match'] and rows[1]['delta'] == 0
+    assert rows[3]['error'] == 'not a raw image (5 bytes)'
+    assert done == [1, 2, 3, 4]
+
+
+def test_archive_input(tmp_path):
+    path = str(tmp_path / 'captures.gta')
+    archive = raw_archive.CaptureArchive(path, 'a')
+    for finger in (1, 2):
+        archive.append(capture(finger))
+    archive.close()
+    assert raw_batch.list_captures(path) == [(path, 0), (path, 1)]
+    out = tmp_path / 'out.csv'
+    assert raw_batch.main([path, '-o', str(out), '-j', '1', '-q']) == 0
+    rows = list(csv.DictReader(out.read_text().splitlines()))
+    assert [row['capture'] for row in rows] == ['captures.gta#0',
+                                                'captures.gta#1']
+    assert [int(row['bifurcations']) for row in rows] == [
+        expected(n)['bifurcations'] for n in (1, 2)]
+
+
+def test_main_formats_and_references(captures, tmp_path, capsys):
+    raw_reference = captures / 'f2.raw'
+    bmp_reference = str(tmp_path / 'f2.binar.bmp')
+    raw_pipeline.save_binary(bmp_reference,
+                             raw_pipeline.process(capture(2)))
+    outputs = []
+    for reference in (str(raw_reference), bmp_reference):
+        out = tmp_path / 'out.json'
+        assert raw_batch.main([str(captures), '-r', reference, '-o',
+                               str(out), '-j', '2']) == 0
+        outputs.append(out.read_text())
+    assert outputs[0] == outputs[1]
+    assert json.loads(outputs[0].splitlines()[1])['match'] is True
+    assert capsys.readouterr().err == '\r4/4\n' * 2
+    with pytest.raises(IOError):
+        raw_batch.load_reference(str(tmp_path / 'missing.bmp'))
@@ -0,0 +1,241 @@
+# -*- coding: utf-8 -*-
+
+'''
+raw_pipeline against the PIL and per pixel code of test_raw it replaced
+(kept below as the reference, ported to Python 3)
+'''
+
+import numpy as np
+import pytest
+from PIL import Image, ImageEnhance
+
+import fps_emulator
+import raw_pipeline
+
+
+# The original test_raw functions, without their BMP writes
+
+def ref_normalize(arr):
+    arr = arr.astype('float')
+    for i in range(3):
+        minval = arr[..., i].min()
+        maxval = arr[..., i].max()
+        if minval != maxval:
+            arr[..., i] -= minval
+            arr[..., i] *= (255.0 / (maxval - minval))
+    return arr
+
+
+def ref_normalizeImage(img):
+    arr = np.array(np.asarray(img).astype('float'))
+    return Image.fromarray(ref_normalize(arr).astype('uint8'))
+
+
+def ref_segmentacion(im):
+    # The mean was computed inside the lambda, once per grey level
+    pixels = list(im.tobytes())
+    mean = sum(pixels) / (pixels.__len__())
+    im = im.point(lambda i: i * 0.9 if i >= mean else 255)
+    enh = ImageEnhance.Contrast(im)
+    return enh.enhance(1.2)
+
+
+def ref_pixelesVecinos(image, pixel):
+    x = pixel[0]
+    y = pixel[1]
+    vecinos = [(x - 1, y - 1),
+               (x - 1, y),
+               (x - 1, y + 1),
+               (x, y + 1),
+               (x + 1, y + 1),
+               (x + 1, y),
+               (x + 1, y - 1),
+               (x, y - 1)]
+    return [image.getpixel(v) for v in vecinos]
+
+
+def ref_bifurcaciones(image, size):
+    bifurcacion = [0, 0, 255, 0, 0, 255, 0, 255]
+    sizeX = size[0] - 2
+    sizeY = size[1] - 2
+    pixs = []
+    for x in range(1, sizeX):
+        for y in range(1, sizeY):
+            pixs.append((x, y))
+    return [1 if ref_pixelesVecinos(image, (x1, y1)) == bifurcacion else -1
+            for (x1, y1) in pixs]
+
+
+def ref_contar(bifurcaciones):
+    return (sum(filter(lambda x: x == 1, bifurcaciones)),
+            sum(map(lambda m: -1 * m,
+                    filter(lambda x: not x == 1, bifurcaciones))))
+
+
+def ref_matchBif(im1, im2):
+    bif1 = ref_contar(ref_bifurcaciones(im1, im1.size))
+    bif2 = ref_contar(ref_bifurcaciones(im2, im2.size))
+    tolerance = 0.1
+    return (bif2[0] - bif1[0] <= bif2[0] * tolerance or
+            bif2[1] - bif1[1] <= bif2[0] * tolerance)
+
+
+def ref_processImage(imgRaw):
+    img = Image.frombytes(mode='L', size=(160, 120), data=imgRaw)
+    enh = ImageEnhance.Brightness(img)
+    img = enh.enhance(1.2)
+    enh = ImageEnhance.Contrast(img)
+    img = enh.enhance(4)
+    enh = ImageEnhance.Sharpness(img)
+    img = enh.enhance(1.2)
+    img = ref_normalizeImage(img)
+    img = ref_segmentacion(img)
+    img = img.crop((8, 7, 141, 112))
+    return img.convert('1')
+
+
+def raw_images():
+    rnd = np.random.RandomState(1)
+    return [fps_emulator.synthetic_image(finger, raw_pipeline.RAW_SIZE)
+            for finger in (1, 2, 3)] + [
+        rnd.randint(0, 256, 160 * 120).astype(np.uint8).tobytes(),
+        bytes(bytearray([230]) * (160 * 120))]
+
+
+@pytest.fixture(params=range(5))
+def raw(request):
+    return raw_images()[request.param]
+
+
+def test_from_raw(raw):
+    arr = raw_pipeline.from_raw(raw)
+    assert arr.shape == (120, 160)
+    assert np.array_equal(arr, np.asarray(
+        Image.frombytes('L', (160, 120), raw)))
+    assert raw_pipeline.from_raw(bytearray(raw)).base is not None
+
+
+@pytest.mark.parametrize('shape', [(120, 160), (20, 30, 3), (20, 30, 4)])
+def test_normalize(shape):
+    arr = np.random.RandomState(2).randint(20, 200, shape).astype(np.uint8)
+    arr[..., 1] = 7
+    assert np.array_equal(raw_pipeline.normalize(arr),
+                          ref_normalize(arr).astype('uint8'))
+
+
+def test_segment(raw):
+    arr = raw_pipeline.enhance(raw_pipeline.from_raw(raw))
+    assert np.array_equal(raw_pipeline.segment(arr),
+                          np.asarray(ref_segmentacion(Image.fromarray(arr))))
+
+
+def test_process(raw):
+    binary = raw_pipeline.process(raw)
+    assert np.array_equal(binary,
+                          np.asarray(ref_processImage(raw).convert('L')))
+
+
+def test_bifurcations(raw):
+    binary = raw_pipeline.process(raw)
+    img = Image.fromarray(binary).convert('1')
+    mask = raw_pipeline.bifurcations(binary)
+    assert np.where(mask, 1, -1).T.ravel().tolist() == \
+        ref_bifurcaciones(img, img.size)
+    assert raw_pipeline.count_bifurcations(binary) == \
+        ref_contar(ref_bifurcaciones(img, img.size))
+
+
+def test_bifurcation_pattern():
+    binary = np.full((6, 7), 255, np.uint8)
+    # Pixel (x 2, y 3) gets the exact pattern of test_raw
+    for (row, col), value in zip(raw_pipeline.NEIGHBOURS,
+                                 raw_pipeline.BIFURCATION):
+        binary[3 - 1 + row, 2 - 1 + col] = value
+    mask = raw_pipeline.bifurcations(binary)
+    assert list(zip(*np.nonzero(mask))) == [(2, 1)]
+    img = Image.fromarray(binary).convert('1')
+    assert np.where(mask, 1, -1).T.ravel().tolist() == \
+        ref_bifurcaciones(img, img.size)
+
+
+def test_match_bif():
+    images = [raw_pipeline.process(raw) for raw in raw_images()]
+    for a in images:
+        for b in images:
+            assert raw_pipeline.match_bif(a, b) == ref_matchBif(
+                Image.fromarray(a).convert('1'),
+                Image.fromarray(b).convert('1'))
+
+
+# In memory pipeline
+
+def ref_stages(imgRaw, imgName):
+    '''
+    test_raw.processImage with its BMP writes
+    '''
+    img = Image.frombytes(mode='L', size=(160, 120), data=imgRaw)
+    img = ImageEnhance.Brightness(img).enhance(1.2)
+    img = ImageEnhance.Contrast(img).enhance(4)
+    img = ImageEnhance.Sharpness(img).enhance(1.2)
+    img.save(imgName + '.bmp', 'BMP')
+    img = ref_normalizeImage(img)
+    img.save(imgName + '.norm.bmp')
+    img = ref_segmentacion(img)
+    img.save(imgName + '.seg.bmp')
+    img = img.crop((8, 7, 141, 112))
+    img.save(imgName + '.crop.bmp')
+    img = img.convert('1')
+    img.save(imgName + '.binar.bmp')
+    return img
+
+
+SUFFIXES = ('.bmp', '.norm.bmp', '.seg.bmp', '.crop.bmp', '.binar.bmp')
+
+
+def test_process_writes_nothing(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    raw_pipeline.process(raw_images()[0])
+    assert not list(tmp_path.iterdir())
+
+
+def test_process_debug_stages(tmp_path):
+    raw = raw_images()[0]
+    ref_stages(raw, str(tmp_path / 'ref'))
+    raw_pipeline.process(raw, debug=str(tmp_path / 'new'))
+    for suffix in SUFFIXES:
+        ref = Image.open(str(tmp_path / ('ref' + suffix)))
+        new = Image.open(str(tmp_path / ('new' + suffix)))
+        assert ref.mode == new.mode and ref.size == new.size
+        assert ref.tobytes() == new.tobytes()
+
+
+def test_save_and_load_binary(tmp_path):
+    raw = raw_images()[1]
+    binary = raw_pipeline.process(raw)
+    path = str(tmp_path / 'finger.binar.bmp')
+    raw_pipeline.save_binary(path, binary)
+    assert np.array_equal(raw_pipeline.load_binary(path), binary)
+    # The files test_raw saved load the same
+    ref_stages(raw, str(tmp_path / 'ref'))
+    assert np.array_equal(
+        raw_pipeline.load_binary(str(tmp_path / 'ref.binar.bmp')), binary)
+    assert raw_pipeline.load_binary(str(tmp_path / 'missing.bmp')) is None
+
+
+def test_reference_cache():
+    loads = []
+
+    def loader(ID):
+        loads.append(ID)
+        return None if ID == 'none' else np.full((2, 2), len(loads))
+    cache = raw_pipeline.ReferenceCache(loader, maxsize=2)
+    assert cache.get('a')[0, 0] == 1
+    assert cache.get('a')[0, 0] == 1
+    assert cache.get('none') is None and 'none' not in cache
+    cache.put('b', np.zeros(1))
+    cache.get('a')
+    cache.put('c', np.zeros(1))
+    assert 'a' in cache and 'b' not in cache and len(cache) == 2
+    cache.discard('a')
+    assert cache.get('a')[0, 0] == 3
+    assert loads == ['a', 'none', 'a']
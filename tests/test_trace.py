@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+
+'''
+fps.WireTrace and fps_trace: recording the traffic with fps_emulator and
+replaying it without
+'''
+
+import time
+
+import pytest
+
+import fps
+import fps_trace
+from fps_emulator import template_of
+
+
+def test_wire_trace_ring_buffer():
+    wire = fps.WireTrace(size=2)
+    wire.record(wire.WRITE, b'\x55\xaa')
+    wire.record(wire.READ, memoryview(b'\x01\x02'))
+    wire.record(wire.READ, bytearray(b'\xff'))
+    assert [(d, data) for _, d, data in wire.chunks] == [
+        (wire.READ, b'\x01\x02'), (wire.READ, b'\xff')]
+    lines = wire.dump().splitlines()
+    assert len(lines) == 2 and lines[1].split(' ', 1)[1] == '< ff'
+
+
+def test_wire_trace_file(tmp_path):
+    path = str(tmp_path / 'wire.trace')
+    with fps_trace.record(path, size=1) as wire:
+        wire.record(wire.WRITE, b'abc')
+        wire.record(wire.READ, b'')
+        wire.record(wire.READ, b'de')
+    chunks = list(fps.WireTrace.read(path))
+    assert [(d, data) for _, d, data in chunks] == [
+        (fps.WireTrace.WRITE, b'abc'), (fps.WireTrace.READ, b''),
+        (fps.WireTrace.READ, b'de')]
+    assert chunks[0][0] <= chunks[1][0] <= chunks[2][0]
+    assert [(d, data) for _, d, data in fps_trace.load(path)] == [
+        (fps.WireTrace.WRITE, b'abc'), (fps.WireTrace.READ, b'de')]
+    # A capture cut short ends at its last whole chunk
+    with open(path, 'rb+') as f:
+        f.truncate(len(open(path, 'rb').read()) - 1)
+    assert len(list(fps.WireTrace.read(path))) == 2
+    (tmp_path / 'other').write_bytes(b'something else')
+    with pytest.raises(ValueError):
+        list(fps.WireTrace.read(str(tmp_path / 'other')))
+
+
+def session(scanner):
+    '''
+    The commands recorded and replayed, with what they return
+    '''
+    results = [scanner.set_led(True),
+               scanner.check_enrolled(3),
+               scanner.check_enrolled(4),
+               scanner.get_template(3),
+               bytes(scanner._lastData.Data),
+               scanner.set_template(template_of(5), 6, duplicate_check=False),
+               b''.join(scanner.iter_raw_image()),
+               [r.response.ACK for r in scanner.run_batch(
+                   [('CheckEnrolled', 6), ('CmosLed', 0)])]]
+    return results
+
+
+@pytest.fixture
+def trace(emulator, tmp_path):
+    path = str(tmp_path / 'session.trace')
+    emulator.enroll(3, 30)
+    emulator.press(2)
+    emulator.latency = {'CmosLed': .1}
+    with fps_trace.record(path) as wire:
+        scanner = fps.FPS_GT511C3(emulator.url, 115200, timeout=.5,
+                                  baud_cache=None, wire=wire)
+        recorded = session(scanner)
+        scanner._serial.close()
+    return path, recorded
+
+
+def test_replay(trace):
+    path, recorded = trace
+    assert recorded[:4] == [True, True, False, 0]
+    scanner = fps.FPS_GT511C3('replay://' + path, 115200, timeout=.5)
+    start = time.time()
+    assert session(scanner) == recorded
+    # As fast as possible, not at the recorded pace
+    assert time.time() - start < .2
+    assert scanner._serial.done
+
+
+def test_replay_at_the_original_pace(trace):
+    path, recorded = trace
+    scanner = fps.FPS_GT511C3('replay://{}?pace=original'.format(path),
+                              115200, timeout=.5)
+    start = time.time()
+    assert session(scanner) == recorded
+    # The two CmosLed took .1 s each to answer
+    assert time.time() - start >= .18
+
+
+def test_replay_detects_other_writes(trace):
+    path, _ = trace
+    scanner = fps.FPS_GT511C3('replay://' + path, 115200, timeout=.5)
+    with pytest.raises(fps_trace.ReplayError, match='CheckEnrolled'):
+        scanner.check_enrolled(3)
+    scanner = fps.FPS_GT511C3('replay://{}?strict=0'.format(path), 115200,
+                              timeout=.5)
+    assert scanner.check_enrolled(3)
+
+
+def test_replay_commands(trace):
+    path, recorded = trace
+    results, seconds = fps_trace.replay_commands(path, baud=115200)
+    assert [r.command for r in results] == [
+        'Open', 'CmosLed', 'CheckEnrolled', 'CheckEnrolled', 'GetTemplate',
+        'SetTemplate', 'SetTemplate', 'GetRawImage', 'CheckEnrolled',
+        'CmosLed']
+    assert [r.response.ACK for r in results] == [
+        True, True, True, False, True, True, True, True, True, True]
+    assert bytes(results[4].data.Data) == template_of(30)
+    assert bytes(results[7].data.Data) == recorded[6]
+
+
+def test_show(trace, capsys):
+    path, _ = trace
+    assert fps_trace.main(['show', path]) == 0
+    lines = capsys.readouterr().out.splitlines()
+    assert lines[0].split()[1:] == ['>', 'Open(1)']
+    assert lines[1].split()[1:] == ['<', 'ACK(0)', 'data(24', 'bytes)']
+    assert any(line.endswith('< NACK(NACK_IS_NOT_USED)') for line in lines)
+    assert fps_trace.main(['replay', path]) == 0
+    assert capsys.readouterr().out.splitlines()[-1].startswith(
+        '10 commands in ')
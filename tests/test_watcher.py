@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+
+'''
+FingerWatcher against fps_emulator
+'''
+
+import asyncio
+import time
+
+
+def wait_for(condition, timeout=2):
+    deadline = time.time() + timeout
+    while not condition():
+        assert time.time() < deadline, 'timed out'
+        time.sleep(.01)
+
+
+def test_events(scanner, emulator):
+    with scanner.watch_finger() as watcher:
+        wait_for(lambda: watcher.pressed is not None)
+        assert emulator.led
+        emulator.press(1)
+        event = watcher.events.get(timeout=2)
+        assert event.pressed
+        emulator.release()
+        assert not watcher.events.get(timeout=2).pressed
+    assert not emulator.led
+    assert watcher.events.get(timeout=2) is None
+    assert watcher.error is None
+
+
+def test_first_poll_is_not_an_event(scanner, emulator):
+    emulator.press(1)
+    with scanner.watch_finger() as watcher:
+        wait_for(lambda: watcher.pressed is not None)
+        assert watcher.pressed
+    assert watcher.events.get(timeout=2) is None
+
+
+def test_callback(scanner, emulator):
+    events = []
+    with scanner.watch_finger(events.append) as watcher:
+        wait_for(lambda: watcher.pressed is not None)
+        emulator.press(1)
+        wait_for(lambda: events)
+    assert [e.pressed for e in events] == [True]
+
+
+def test_raising_callback_turns_the_led_off(scanner, emulator):
+    def callback(event):
+        raise ValueError('callback failed')
+    watcher = scanner.watch_finger(callback).start()
+    wait_for(lambda: watcher.pressed is not None)
+    emulator.press(1)
+    watcher._thread.join(2)
+    assert not watcher._thread.is_alive()
+    assert isinstance(watcher.error, ValueError)
+    assert not emulator.led
+
+
+def test_without_led(scanner, emulator):
+    scanner.set_led(True)
+    with scanner.watch_finger(led=False) as watcher:
+        wait_for(lambda: watcher.pressed is not None)
+    assert emulator.led
+    assert emulator.commands['CmosLed'] == 1
+
+
+def test_iterates_until_stopped(scanner, emulator):
+    watcher = scanner.watch_finger().start()
+    wait_for(lambda: watcher.pressed is not None)
+    emulator.press(1)
+    presses = []
+    for event in watcher:
+        presses.append(event.pressed)
+        if event.pressed:
+            emulator.release()
+        else:
+            watcher.stop(wait=False)
+    assert presses == [True, False]
+
+
+def test_async_iteration(scanner, emulator):
+    watcher = scanner.watch_finger()
+
+    async def main():
+        presses = []
+        async for event in watcher.start():
+            presses.append(event.pressed)
+            if len(presses) == 2:
+                watcher.stop(wait=False)
+            else:
+                emulator.release()
+        return presses
+    watcher.start()
+    wait_for(lambda: watcher.pressed is not None)
+    emulator.press(1)
+    assert asyncio.run(main()) == [True, False]
+    assert not emulator.led
+
+
+def test_restart_drops_old_events(scanner, emulator):
+    watcher = scanner.watch_finger()
+    with watcher:
+        wait_for(lambda: watcher.pressed is not None)
+        emulator.press(1)
+        wait_for(lambda: not watcher.events.empty())
+    with watcher:
+        wait_for(lambda: watcher.pressed is not None)
+        assert watcher.events.empty()